@@ -36,13 +36,18 @@ Examples
 """
 from __future__ import print_function, division
 
-from scipy import ndimage, optimize, stats
+from scipy import ndimage, optimize, spatial, stats
 from os import path as osp
 import itertools
 import numpy as np
 import logging
 import json
 
+try:
+    from numba import jit
+except ImportError:
+    jit = None
+
 # using Qt5Agg causes "window focus loss" in interpreter for some reason
 import matplotlib
 
@@ -78,6 +83,80 @@ def bead_centroids(img, labeled, nlabels):
     return [ndimage.center_of_mass(img, labeled, l) for l in range(1, nlabels + 1)]
 
 
+def _find(parent, p):
+    while parent[p] != p:
+        parent[p] = parent[parent[p]]
+        p = parent[p]
+    return p
+
+
+def _component_counts(im, order):
+    """number of connected components (4-connected, as ndimage.label) of the
+    set of pixels order[:k + 1], for each k.
+
+    Pixels are added one at a time and merged with their neighbors in a
+    union-find forest, so the whole curve costs a single pass.
+    """
+    ny, nx = im.shape
+    parent = np.full(ny * nx, -1, np.int32)
+    size = np.ones(ny * nx, np.int32)
+    counts = np.empty(len(order), np.int64)
+    n = 0
+    for k in range(len(order)):
+        p = order[k]
+        parent[p] = p
+        n += 1
+        root = p
+        y = p // nx
+        x = p % nx
+        for dy, dx in ((-1, 0), (1, 0), (0, -1), (0, 1)):
+            yy = y + dy
+            xx = x + dx
+            if yy < 0 or yy >= ny or xx < 0 or xx >= nx:
+                continue
+            q = yy * nx + xx
+            if parent[q] < 0:
+                continue
+            rq = _find(parent, q)
+            if rq != root:
+                # the smaller tree goes under the larger one
+                if size[rq] < size[root]:
+                    rq, root = root, rq
+                parent[root] = rq
+                size[rq] += size[root]
+                root = rq
+                n -= 1
+        counts[k] = n
+    return counts
+
+
+if jit is not None:
+    _find = jit(nopython=True, nogil=True)(_find)
+    _component_counts = jit(nopython=True, nogil=True)(_component_counts)
+
+
+def count_objects(im, thresholds):
+    """number of objects that ndimage.label finds in im > t, for each t in
+    thresholds.  im must be 2D."""
+    thresholds = np.asarray(thresholds)
+    if jit is None:
+        return np.array([ndimage.label(im > t)[1] for t in thresholds])
+    tsort = np.argsort(thresholds)
+    # number of thresholds below each pixel: pixels are only ever compared to
+    # the thresholds, so sorting them by this level is enough
+    levels = np.searchsorted(thresholds[tsort], im.ravel(), "left")
+    dtype = np.uint8 if len(thresholds) < 256 else np.int64
+    # highest level first, raster order within a level (stable radix sort)
+    order = np.argsort(len(thresholds) - levels.astype(dtype), kind="stable")
+    counts = _component_counts(im, order)
+    # pixels above the i-th threshold are the first `above[i]` of order
+    above = np.cumsum(np.bincount(levels, minlength=len(thresholds) + 1)[::-1])
+    above = above[::-1][1:]
+    result = np.empty(len(thresholds), np.int64)
+    result[tsort] = np.where(above > 0, counts[np.maximum(above - 1, 0)], 0)
+    return result
+
+
 def get_thresh(im, mincount=None, steps=100):
     """intelligently find coordinates of local maxima in an image
     by searching a range of threshold parameters to find_local_maxima
@@ -94,15 +173,16 @@ def get_thresh(im, mincount=None, steps=100):
     if mincount is None:
         mincount = 20
     threshrange = np.linspace(im.min(), im.max(), steps)
-    object_count = [ndimage.label(im > t)[1] for t in threshrange]
-    object_count = np.array(object_count)
+    object_count = count_objects(im, threshrange)
     if mincount > object_count.max():
         raise RegistrationError(
             "Could not detect minimum number of beads specified ({}), found: {}".format(
                 mincount, object_count.max()
             )
         )
-    modecount = stats.mode(object_count[(object_count >= mincount)], axis=None).mode[0]
+    modecount = np.atleast_1d(
+        stats.mode(object_count[(object_count >= mincount)], axis=None)[0]
+    )[0]
     logging.debug(
         "Threshold detected: {}".format(
             threshrange[np.argmax(object_count == modecount)]
@@ -125,18 +205,15 @@ def mad(arr, axis=None, method="median"):
 
 
 def get_closest_points(pc1, pc2):
-    """returns the distance and index of the closest matching point in pc2
-    for each point in pc1.
+    """returns the squared distance and index of the closest matching point
+    in pc2 for each point in pc1.
 
     len(nn) == len(pc1)
 
     can be used to eliminate points in pc2 that don't have a partner in pc1
     """
-    pc1 = pc1.T
-    pc2 = pc2.T
-    d = [((pc2 - point) ** 2).sum(axis=1) for point in pc1]
-    nn = [(np.min(p), np.argmin(p)) for p in d]
-    return nn
+    d, idx = spatial.cKDTree(pc2.T).query(pc1.T)
+    return np.column_stack((d * d, idx))
 
 
 def get_matching_points(pc1, pc2, method=None):
@@ -157,6 +234,25 @@ def get_matching_points(pc1, pc2, method=None):
     return goodpc1.T, goodpc2.T
 
 
+def get_mutual_matches(pc1, pc2, maxd=None):
+    """return the points of pc1 and pc2 that are each other's nearest
+    neighbor, in matching order, using KD-trees (O(N log N) for N points)
+
+    Pairs further apart than maxd are rejected.  By default maxd is the
+    median pair distance plus 4 median absolute deviations.
+    """
+    if not pc1.shape[1] or not pc2.shape[1]:
+        return pc1[:, :0], pc2[:, :0]
+    d12, nn12 = spatial.cKDTree(pc2.T).query(pc1.T)
+    _, nn21 = spatial.cKDTree(pc1.T).query(pc2.T)
+    mutual = nn21[nn12] == np.arange(pc1.shape[1])
+    if maxd is None:
+        dist = d12[mutual]
+        maxd = np.median(dist) + 4 * mad(dist) if len(dist) else 0
+    passing = mutual & (d12 <= maxd * (1 + 1e-9))
+    return pc1[:, passing], pc2[:, nn12[passing]]
+
+
 def mat2to3(mat2):
     """ 2D to 3D matrix:
         | a b c |       | a b 0 c |
@@ -365,6 +461,106 @@ def FitModelWeighted(modelFcn, startParameters, data, sigmas, *args):
     )
 
 
+def _gauss3d_jacobian(p, X, Y, Z):
+    """f_Gauss3d and its derivatives for a batch of fits
+
+    p has shape (n, 7) and X, Y, Z (n, m).  Returns the model, of shape (n, m)
+    and its jacobian with respect to p, of shape (n, m, 7).
+    """
+    A, x0, y0, z0, wxy, wz, b = [p[:, i, None] for i in range(7)]
+    dX = X - x0
+    dY = Y - y0
+    dZ = Z - z0
+    r2 = dX * dX + dY * dY
+    E = np.exp(-r2 / (2 * wxy * wxy) - dZ * dZ / (2 * wz * wz))
+    AE = A * E
+    jac = np.stack(
+        [
+            E,
+            AE * dX / (wxy * wxy),
+            AE * dY / (wxy * wxy),
+            AE * dZ / (wz * wz),
+            AE * r2 / (wxy * wxy * wxy),
+            AE * dZ * dZ / (wz * wz * wz),
+            np.ones_like(E),
+        ],
+        axis=-1,
+    )
+    return AE + b, jac
+
+
+def _solve_batch(M, v):
+    """solve the linear systems M x = v of a batch, least squares if singular"""
+    try:
+        return np.linalg.solve(M, v[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        return (np.linalg.pinv(M) @ v[..., None])[..., 0]
+
+
+def fit_gauss3d_batch(p0, data, weights, X, Y, Z, maxiter=100, ftol=1.49e-8):
+    """Weighted least squares fit of f_Gauss3d to a batch of ROIs at once
+
+    All arrays have one row per ROI: p0 (n, 7) start parameters, and
+    data, weights and coordinates (n, m) flattened ROIs.  Voxels with zero
+    weight (e.g. padding) are ignored.  Each fit runs its own
+    Levenberg-Marquardt iteration, vectorized across the fits that have not
+    converged yet.
+
+    Returns:
+        tuple: (parameters (n, 7), fit errors (n, 7), result codes (n,))
+            codes are 1 for converged fits and 5 when maxiter was reached,
+            as with :func:`scipy.optimize.leastsq`
+    """
+    p = np.array(p0, dtype=np.float64)
+    n = len(p)
+
+    def evaluate(p, idx):
+        model, jac = _gauss3d_jacobian(p, X[idx], Y[idx], Z[idx])
+        res = (data[idx] - model) * weights[idx]
+        return jac * weights[idx, :, None], res, (res * res).sum(1)
+
+    J, res, cost = evaluate(p, slice(None))
+    lam = np.full(n, 1e-3)
+    codes = np.full(n, 5)
+    active = np.flatnonzero(np.isfinite(cost))
+    for _ in range(maxiter):
+        if not len(active):
+            break
+        Ja = J[active]
+        JT = Ja.transpose(0, 2, 1)
+        JTJ = JT @ Ja
+        JTr = (JT @ res[active, :, None])[..., 0]
+        diag = np.maximum(np.einsum("nii->ni", JTJ), 1e-12)
+        damped = JTJ + (lam[active, None] * diag)[..., None] * np.eye(7)
+        trial = p[active] + _solve_batch(damped, JTr)
+        J_t, res_t, cost_t = evaluate(trial, active)
+        better = np.isfinite(cost_t) & (cost_t < cost[active])
+        done = better & (cost[active] - cost_t <= ftol * cost[active])
+        # no better point within a tiny trust region: this is the minimum
+        done |= ~better & (lam[active] > 1e10)
+        keep = active[better]
+        p[keep] = trial[better]
+        J[keep] = J_t[better]
+        res[keep] = res_t[better]
+        cost[keep] = cost_t[better]
+        lam[active] = np.where(better, lam[active] / 10, lam[active] * 10)
+        codes[active[done]] = 1
+        active = active[~done]
+
+    # covariance as returned by leastsq, scaled by the residual variance
+    JTJ = J.transpose(0, 2, 1) @ J
+    dof = np.maximum((weights > 0).sum(1) - 7, 1)
+    with np.errstate(invalid="ignore"):
+        fitErr = np.sqrt(
+            np.einsum("nii->ni", np.linalg.pinv(JTJ)) * (cost / dof)[:, None]
+        )
+    return p, fitErr, codes
+
+
+def _fit_gauss3d_batch(args):
+    return fit_gauss3d_batch(*args)
+
+
 class GaussFitResult:
     def __init__(self, fitResults, dx, dz, slicekey=None, resultCode=None, fitErr=None):
         self.fitResults = fitResults
@@ -470,6 +666,83 @@ class GaussFitter3D(object):
 
         return GaussFitResult(res1, self.dx, self.dz, key, resCode, fitErrors)
 
+    def _batch(self, keys):
+        """start parameters, data, weights and coordinates of the ROIs defined
+        by keys, padded to a common shape with zero weight"""
+        shape = np.max([[s.stop - s.start for s in key] for key in keys], 0)
+        size = int(np.prod(shape))
+        n = len(keys)
+        data = np.zeros((n, size), "f")
+        weights = np.zeros((n, size), "f")
+        coords = np.zeros((3, n, size))
+        p0 = np.zeros((n, 7))
+        for i, key in enumerate(keys):
+            dataROI = self.data[key].astype("f")
+            Z, Y, X = np.mgrid[key]
+            m = dataROI.size
+            data[i, :m] = dataROI.ravel()
+            coords[:, i, :m] = [
+                self.dx * X.ravel(),
+                self.dx * Y.ravel(),
+                self.dz * Z.ravel(),
+            ]
+
+            drc = dataROI - dataROI.min()
+            drc = np.maximum(drc - drc.max() / 2, 0)
+            drc = (drc / drc.sum()).ravel()
+            p0[i] = [
+                3 * (dataROI.max() - dataROI.min()),
+                (coords[0, i, :m] * drc).sum(),
+                (coords[1, i, :m] * drc).sum(),
+                (coords[2, i, :m] * drc).sum(),
+                self.wx,
+                self.wz,
+                dataROI.min(),
+            ]
+            # same noise model as __getitem__
+            sigma = np.sqrt(1.2 * 1.2 + 0.5 * np.maximum(dataROI, 1)) / 0.5
+            weights[i, :m] = (1.0 / sigma).astype("f").ravel()
+        return (p0, data, weights) + tuple(coords)
+
+    def fit_all(self, keys, batchsize=256, processes=None):
+        """gaussian fits of many ROIs, each a 3-tuple of slices
+
+        Equivalent to ``[self[k] for k in keys]``, but the ROIs are fitted in
+        batches with :func:`fit_gauss3d_batch`.  ROIs of similar size are
+        batched together to limit padding.  With processes > 1, batches are
+        spread over a pool of that many processes, which pays off for very
+        large clouds.
+
+        Returns:
+            list: :obj:`GaussFitResult` for each key, None if the fit failed or
+            the ROI has fewer voxels than the 7 fit parameters
+        """
+        keys = list(keys)
+        sizes = [np.prod([s.stop - s.start for s in key]) for key in keys]
+        # leastsq cannot fit 7 parameters to fewer voxels, those ROIs are skipped
+        order = sorted(
+            (i for i in range(len(keys)) if sizes[i] >= 7), key=sizes.__getitem__
+        )
+        batches = [order[i : i + batchsize] for i in range(0, len(order), batchsize)]
+        args = [self._batch([keys[i] for i in b]) for b in batches]
+        if processes and processes > 1 and len(batches) > 1:
+            from concurrent.futures import ProcessPoolExecutor
+            from multiprocessing import get_context
+
+            with ProcessPoolExecutor(processes, mp_context=get_context("spawn")) as ex:
+                fits = list(ex.map(_fit_gauss3d_batch, args))
+        else:
+            fits = [_fit_gauss3d_batch(a) for a in args]
+
+        results = [None] * len(keys)
+        for batch, (params, errors, codes) in zip(batches, fits):
+            for i, res, err, code in zip(batch, params, errors, codes):
+                if np.all(np.isfinite(res)):
+                    results[i] = GaussFitResult(
+                        res, self.dx, self.dz, keys[i], code, err
+                    )
+        return results
+
 
 class FiducialCloud(object):
     """Generate a 3D point cloud of XYZ locations of fiducial markers
@@ -493,6 +766,8 @@ class FiducialCloud(object):
         filtertype ({'blur', 'log'}): type of blur to use prior to bead detection.
             log = laplacian of gaussian
             blur = gaussian
+        processes (:obj:`int`): number of processes fitting beads, for very
+            large clouds.  By default beads are fitted in this process.
 
     """
 
@@ -507,6 +782,7 @@ class FiducialCloud(object):
         mincount=None,
         imref=None,
         filtertype="blur",
+        processes=None,
     ):
         # data is a numpy array or filename
         self.data = None
@@ -540,6 +816,7 @@ class FiducialCloud(object):
         self.imref = imref
         self.coords = None
         self.filtertype = filtertype
+        self.processes = processes
 
         logger.debug("New fiducial cloud created with dx: {},  dz: {}".format(dx, dz))
         if self.data is not None:
@@ -607,23 +884,20 @@ class FiducialCloud(object):
         # FIXME: pass sigmas to wx and wz parameters of GaussFitter
         fitter = GaussFitter3D(self.data, dz=self.dz, dx=self.dx)
         gaussfits = []
-        for chunk in objects:
-            try:
-                # TODO: filter by bead intensity as well to reject bright clumps
-                F = fitter[chunk]
-                if (
-                    (F.x(0) < self.data.shape[2])
-                    and (F.x(0) > 0)
-                    and (F.y(0) < self.data.shape[1])
-                    and (F.y(0) > 0)
-                    and (F.z(0) < self.data.shape[0])
-                    and (F.z(0) > 0)
-                ):
-                    gaussfits.append(F)
-            except Exception:
-                pass
-                # import warnings
-                # warnings.warn('skipped a spot')
+        objects = [chunk for chunk in objects if chunk is not None]
+        # TODO: filter by bead intensity as well to reject bright clumps
+        for F in fitter.fit_all(objects, processes=self.processes):
+            if F is None:
+                continue
+            if (
+                (F.x(0) < self.data.shape[2])
+                and (F.x(0) > 0)
+                and (F.y(0) < self.data.shape[1])
+                and (F.y(0) > 0)
+                and (F.z(0) < self.data.shape[0])
+                and (F.z(0) > 0)
+            ):
+                gaussfits.append(F)
         self.coords = np.array([[n.x(0), n.y(0), n.z(0)] for n in gaussfits]).T
         if not len(self.coords):
             logging.warning(
@@ -800,7 +1074,7 @@ class CloudSet(object):
             #   self.clouds[0], self.clouds[n] = get_matching_points(
             #       self.clouds[0], self.clouds[n])
             for m, n in itertools.combinations(range(self.N), 2):
-                coords[m], coords[n] = get_matching_points(coords[m], coords[n])
+                coords[m], coords[n] = get_mutual_matches(coords[m], coords[n])
             if len({c.shape for c in coords}) == 1:
                 break
         if not all([len(c) for c in coords]):
@@ -986,10 +1260,11 @@ class CloudSet(object):
                 else:
                     moving = self.clouds[movIdx].coords.T
                     fixed = self.clouds[fixIdx].coords.T
+                # kwargs are options of CPDregistration, e.g. truncate
                 if "2step" in mode:
-                    tform = funcDict[mode](moving, fixed)
+                    tform = funcDict[mode](moving, fixed, **kwargs)
                 else:
-                    reg = funcDict[mode](moving, fixed)
+                    reg = funcDict[mode](moving, fixed, **kwargs)
                     tform = reg.register(None)[4]
             else:
                 matching = self._get_matching(inworld=inworld)
@@ -1244,21 +1519,36 @@ class RegFile(object):
 ###############################################################################
 
 
-def cpd_2step(moving, fixed):
+def cpd_2step(moving, fixed, **kwargs):
     fixXYZ = fixed
     fixXY = fixXYZ[:, :2]
     movXY = moving[:, :2]
     movZ = moving[:, 2:]
-    reg1 = CPDaffine(fixXY, movXY)
+    reg1 = CPDaffine(fixXY, movXY, **kwargs)
     TmovXY, _, _, _, M = reg1.register(None)
     M = mat2to3(M)
-    reg2 = CPDrigid(fixXYZ, np.concatenate((TmovXY, movZ), axis=1))
+    reg2 = CPDrigid(fixXYZ, np.concatenate((TmovXY, movZ), axis=1), **kwargs)
     tR = reg2.register(None)[3]
     M[2, 3] = tR[2]
     return M
 
 
 class CPDregistration(object):
+    """Coherent point drift registration of point cloud Y onto X (N x D and
+    M x D arrays).
+
+    The E-step never holds the full M x N matrix of correspondence
+    probabilities: pairs are evaluated in blocks of columns of at most
+    blocksize elements, in the floating point type dtype (float32 halves the
+    memory and time of the distance kernel).  With truncate (in standard
+    deviations), once the gaussians are narrower than the clouds only the
+    pairs within truncate * sigma of each other are evaluated, using a
+    KD-tree.  truncate defaults to 4 for clouds with more than
+    DENSE_PAIRS pairs and to exact evaluation otherwise.
+    """
+
+    DENSE_PAIRS = 1 << 24
+
     def __init__(
         self,
         X,
@@ -1270,6 +1560,9 @@ class CPDregistration(object):
         maxIterations=100,
         tolerance=0.001,
         w=0,
+        dtype=np.float64,
+        blocksize=1 << 22,
+        truncate=None,
     ):
         if X.shape[1] != Y.shape[1]:
             raise ValueError(
@@ -1291,6 +1584,11 @@ class CPDregistration(object):
         self.w = w
         self.q = 0
         self.err = 0
+        self.dtype = dtype
+        self.blocksize = blocksize
+        if truncate is None and self.M * self.N > self.DENSE_PAIRS:
+            truncate = 4
+        self.truncate = truncate
 
     @property
     def matrix(self):
@@ -1336,44 +1634,84 @@ class CPDregistration(object):
             self.t, self.M, axis=0
         )
         if not self.sigma2:
-            XX = np.reshape(self.X, (1, self.N, self.D))
-            YY = np.reshape(self.Y, (self.M, 1, self.D))
-            XX = np.tile(XX, (self.M, 1, 1))
-            YY = np.tile(YY, (1, self.N, 1))
-            diff = XX - YY
-            err = np.multiply(diff, diff)
-            self.sigma2 = np.sum(err) / (self.D * self.M * self.N)
+            # sum of the squared distances of all pairs, without forming them
+            err = (
+                self.M * np.sum(self.X * self.X)
+                + self.N * np.sum(self.Y * self.Y)
+                - 2 * np.dot(self.X.sum(0), self.Y.sum(0))
+            )
+            self.sigma2 = err / (self.D * self.M * self.N)
 
         self.err = self.tolerance + 1
         self.q = -self.err - self.N * self.D / 2 * np.log(self.sigma2)
 
     def EStep(self):
-        P = np.zeros((self.M, self.N))
-
-        for i in range(0, self.M):
-            diff = self.X - np.tile(self.TY[i, :], (self.N, 1))
-            diff = np.multiply(diff, diff)
-            P[i, :] = P[i, :] + np.sum(diff, axis=1)
-
+        """correspondence probabilities P (M x N), stored as P1 = P 1,
+        Pt1 = P' 1 and PX = P X, which is all the M-step needs"""
         c = (2 * np.pi * self.sigma2) ** (self.D / 2)
         c = c * self.w / (1 - self.w)
         c = c * self.M / self.N
 
-        P = np.exp(-P / (2 * self.sigma2))
-        den = np.sum(P, axis=0)
-        den = np.tile(den, (self.M, 1))
-        den[den == 0] = np.finfo(float).eps
-
-        self.P = np.divide(P, den)
-        self.Pt1 = np.sum(self.P, axis=0)
-        self.P1 = np.sum(self.P, axis=1)
+        self.P1 = np.zeros(self.M)
+        self.Pt1 = np.zeros(self.N)
+        self.PX = np.zeros((self.M, self.D))
+        sparse = False
+        if self.truncate:
+            radius = self.truncate * np.sqrt(self.sigma2)
+            extent = np.ptp(np.concatenate((self.X, self.TY)), axis=0)
+            # the KD-tree only pays off when few points are within range
+            sparse = np.prod(np.minimum(2 * radius / extent, 1)) < 0.1
+        if sparse:
+            self._sparse_estep(radius, c)
+        else:
+            self._dense_estep(c)
         self.Np = np.sum(self.P1)
 
-        def updateTransform(self):
-            raise NotImplementedError()
+    def _dense_estep(self, c):
+        X = self.X.astype(self.dtype)
+        TY = self.TY.astype(self.dtype)
+        Y2 = np.sum(TY * TY, axis=1)[:, None]
+        step = max(1, self.blocksize // self.M)
+        # each block of columns holds the complete normalization of its points
+        for j in range(0, self.N, step):
+            Xj = X[j : j + step]
+            d2 = Y2 + np.sum(Xj * Xj, axis=1) - 2 * np.dot(TY, Xj.T)
+            P = np.exp(-np.maximum(d2, 0) / (2 * self.sigma2))
+            den = np.sum(P, axis=0, dtype=np.float64) + c
+            den[den == 0] = np.finfo(float).eps
+            P = P / den.astype(self.dtype)
+            self.Pt1[j : j + step] = np.sum(P, axis=0)
+            self.P1 += np.sum(P, axis=1)
+            self.PX += np.dot(P, self.X[j : j + step])
+
+    def _sparse_estep(self, radius, c):
+        pairs = spatial.cKDTree(self.TY).sparse_distance_matrix(
+            spatial.cKDTree(self.X), radius, output_type="ndarray"
+        )
+        i, j, d = pairs["i"], pairs["j"], pairs["v"]
+        P = np.exp(-d * d / (2 * self.sigma2))
+        den = np.bincount(j, P, minlength=self.N) + c
+        den[den == 0] = np.finfo(float).eps
+        P = P / den[j]
+        self.Pt1 = np.bincount(j, P, minlength=self.N)
+        self.P1 = np.bincount(i, P, minlength=self.M)
+        for dim in range(self.D):
+            self.PX[:, dim] = np.bincount(i, P * self.X[j, dim], minlength=self.M)
+
+    def _centered(self):
+        """weighted means of the clouds, centered clouds and A = XX' P' YY"""
+        muX = np.dot(self.Pt1, self.X) / self.Np
+        muY = np.dot(self.P1, self.Y) / self.Np
+        self.XX = self.X - muX
+        YY = self.Y - muY
+        self.A = np.dot(np.transpose(self.PX - np.outer(self.P1, muX)), YY)
+        return muX, muY, YY
+
+    def updateTransform(self):
+        raise NotImplementedError()
 
-        def updateVariance(self):
-            raise NotImplementedError()
+    def updateVariance(self):
+        raise NotImplementedError()
 
 
 class CPDsimilarity(CPDregistration):
@@ -1381,12 +1719,7 @@ class CPDsimilarity(CPDregistration):
         super(CPDsimilarity, self).__init__(*args, **kwargs)
 
     def updateTransform(self):
-        muX = np.divide(np.sum(np.dot(self.P, self.X), axis=0), self.Np)
-        muY = np.divide(np.sum(np.dot(np.transpose(self.P), self.Y), axis=0), self.Np)
-        self.XX = self.X - np.tile(muX, (self.N, 1))
-        YY = self.Y - np.tile(muY, (self.M, 1))
-        self.A = np.dot(np.transpose(self.XX), np.transpose(self.P))
-        self.A = np.dot(self.A, YY)
+        muX, muY, YY = self._centered()
         U, _, V = np.linalg.svd(self.A, full_matrices=True)
         C = np.ones((self.D,))
         C[self.D - 1] = np.linalg.det(np.dot(U, V))
@@ -1423,12 +1756,7 @@ class CPDrigid(CPDsimilarity):
         return M
 
     def updateTransform(self):
-        muX = np.divide(np.sum(np.dot(self.P, self.X), axis=0), self.Np)
-        muY = np.divide(np.sum(np.dot(np.transpose(self.P), self.Y), axis=0), self.Np)
-        self.XX = self.X - np.tile(muX, (self.N, 1))
-        YY = self.Y - np.tile(muY, (self.M, 1))
-        self.A = np.dot(np.transpose(self.XX), np.transpose(self.P))
-        self.A = np.dot(self.A, YY)
+        muX, muY, YY = self._centered()
         U, _, V = np.linalg.svd(self.A, full_matrices=True)
         C = np.ones((self.D,))
         C[self.D - 1] = np.linalg.det(np.dot(U, V))
@@ -1454,12 +1782,7 @@ class CPDaffine(CPDregistration):
         super(CPDaffine, self).__init__(*args, **kwargs)
 
     def updateTransform(self):
-        muX = np.divide(np.sum(np.dot(self.P, self.X), axis=0), self.Np)
-        muY = np.divide(np.sum(np.dot(np.transpose(self.P), self.Y), axis=0), self.Np)
-        self.XX = self.X - np.tile(muX, (self.N, 1))
-        YY = self.Y - np.tile(muY, (self.M, 1))
-        self.A = np.dot(np.transpose(self.XX), np.transpose(self.P))
-        self.A = np.dot(self.A, YY)
+        muX, muY, YY = self._centered()
         self.YPY = np.dot(np.transpose(YY), np.diag(self.P1))
         self.YPY = np.dot(self.YPY, YY)
         Rt = np.linalg.solve(np.transpose(self.YPY), np.transpose(self.A))
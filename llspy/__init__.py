@@ -25,10 +25,10 @@ from .parse import parse_filename, filter_files
 from .camera import CameraROI, CameraParameters, selectiveMedianFilter
 from .schema import procParams, printOptions
 from .util import imread, imsave, imshow
+from .arrayfun import deskew
 
 # libcuda functions
 try:
-    from .libcudawrapper import deskewGPU as deskew
     from .libcudawrapper import affineGPU as affine
     from .libcudawrapper import quickDecon as decon
     from .libcudawrapper import rotateGPU as rotate
@@ -1,8 +1,9 @@
 from __future__ import print_function, division
-from .libcudawrapper import deskewGPU as deskew
-from .util import imread
+from . import libcudawrapper as libcu
 
+import math
 import numpy as np
+from numba import jit, prange
 from scipy.ndimage.filters import gaussian_filter
 from scipy.stats import mode
 
@@ -102,7 +103,7 @@ def imcontentbounds(im, sigma=2):
     # get rid of the first two planes in case of high dark noise
     if im.ndim == 3:
         im = np.squeeze(np.max(im[2:], 0))
-    im = im.astype(np.float)
+    im = im.astype(float)
     fullwidth = im.shape[-1]
     # from scipy.ndimage.filters import median_filter
     # mm = median_filter(b.astype(float),3)
@@ -128,7 +129,7 @@ def feature_width(E, background=None, pad=50, t=0):
     # first and last timepoint
     maxT = max(P.tset)
     minT = min(P.tset)
-    raw_stacks = [imread(f) for f in E.get_files(t=(minT, maxT))]
+    raw_stacks = [E.imread(f) for f in E.get_files(t=(minT, maxT))]
     raw_stacks = [sub_background(f, background) for f in raw_stacks]
     if P.samplescan:
         deskewed_stacks = [deskew(s, P.dz, P.dx, P.angle) for s in raw_stacks]
@@ -153,18 +154,152 @@ def detect_background(im):
         im = im[0][2]
     if im.ndim == 3:
         im = im[1]  # pick the third plane... avoid noise in first plane on lattice
-    return mode(im.flatten())[0][0]
+    im = np.asarray(im)
+    if np.issubdtype(im.dtype, np.unsignedinteger):
+        return np.bincount(im.ravel()).argmax()
+    return np.atleast_1d(mode(im, axis=None)[0])[0]
 
 
 def sub_background(im, background=None):
     """ subtract provided background or autodetct as mode of the first plane"""
     if background is None:
         background = detect_background(im)
-    out = im.astype(np.float) - background
+    out = im.astype(np.float32) - background
     out[out < 0] = 0
     return out
 
 
+def deskewed_nx(nx, nz, dz, dr, angle):
+    """Width of the deskewed image, as calculated by libcudaDeconv."""
+    return int(nx + np.floor(nz * dz * abs(np.cos(angle * np.pi / 180)) / dr))
+
+
+# NOTE: once a parallel kernel has run, numba's default threading layer is not
+# fork-safe: a forked child that runs numba code can deadlock.  Worker pools in
+# llspy therefore use the "spawn" start method (see llspy.procpool)
+@jit(nopython=True, nogil=True, parallel=True)
+def _deskew_kernel(im, out, deskewFactor, shift, padVal):
+    nz, ny, nx = im.shape
+    nxOut = out.shape[2]
+    # each Y slab is independent, so they are spread over all threads
+    for y in prange(ny):
+        for z in range(nz):
+            xoffset = -nxOut / 2.0 + shift - deskewFactor * (z - nz / 2.0) + nx / 2.0
+            for xout in range(nxOut):
+                xin = xout + xoffset
+                if xin >= 0 and xin <= nx - 1:
+                    xi = int(math.floor(xin))
+                    if xi < nx - 1:
+                        frac = xin - xi
+                        out[z, y, xout] = (1 - frac) * im[z, y, xi] + frac * im[
+                            z, y, xi + 1
+                        ]
+                    else:
+                        out[z, y, xout] = im[z, y, xi]
+                else:
+                    out[z, y, xout] = padVal
+
+
+def deskew_cpu(im, dz=0.5, dr=0.102, angle=31.5, width=0, shift=0, padVal=0.0):
+    """Deskew data acquired in stage-scanning mode on the CPU
+
+    Mirrors the geometry of libcudawrapper.deskewGPU (output width, width/shift
+    cropping and padVal), using linear interpolation along X.  Work is split
+    across Y slabs on all available threads.
+    """
+    nz, ny, nx = im.shape
+    if not np.issubdtype(im.dtype, np.float32):
+        im = im.astype(np.float32)
+    if width == 0:
+        deskewedNx = deskewed_nx(nx, nz, dz, dr, angle)
+    else:
+        deskewedNx = width
+
+    deskewFactor = np.cos(angle * np.pi / 180) * dz / dr
+    result = np.empty((nz, ny, deskewedNx), dtype=np.float32)
+    _deskew_kernel(im, result, deskewFactor, shift, padVal)
+    return result
+
+
+def deskew(im, dz=0.5, dr=0.102, angle=31.5, width=0, shift=0, padVal=0.0):
+    """Deskew image volume, on the GPU if libcudaDeconv is available,
+    falling back to deskew_cpu otherwise."""
+    if libcu.cudaLib:
+        return libcu.deskewGPU(im, dz, dr, angle, width, shift, padVal)
+    return deskew_cpu(im, dz, dr, angle, width, shift, padVal)
+
+
+@jit(nopython=True, nogil=True, parallel=True)
+def _affine_kernel(im, out, tmat, dz, dy, dx):
+    nz, ny, nx = im.shape
+    # output planes are independent, so they are spread over all threads
+    for z in prange(nz):
+        wz = 0.5 + z * dz
+        for y in range(ny):
+            wy = 0.5 + y * dy
+            for x in range(nx):
+                wx = 0.5 + x * dx
+                # world coordinates of the source point, back to voxel indices
+                u = tmat[0, 0] * wx + tmat[0, 1] * wy + tmat[0, 2] * wz + tmat[0, 3]
+                v = tmat[1, 0] * wx + tmat[1, 1] * wy + tmat[1, 2] * wz + tmat[1, 3]
+                w = tmat[2, 0] * wx + tmat[2, 1] * wy + tmat[2, 2] * wz + tmat[2, 3]
+                u = (u - 0.5) / dx
+                v = (v - 0.5) / dy
+                w = (w - 0.5) / dz
+                x0 = int(math.floor(u))
+                y0 = int(math.floor(v))
+                z0 = int(math.floor(w))
+                fx = u - x0
+                fy = v - y0
+                fz = w - z0
+                # trilinear interpolation, with zeros outside of the volume
+                val = 0.0
+                for k in range(2):
+                    zi = z0 + k
+                    if zi < 0 or zi >= nz:
+                        continue
+                    wk = fz if k else 1 - fz
+                    for j in range(2):
+                        yi = y0 + j
+                        if yi < 0 or yi >= ny:
+                            continue
+                        wj = fy if j else 1 - fy
+                        for i in range(2):
+                            xi = x0 + i
+                            if xi < 0 or xi >= nx:
+                                continue
+                            wi = fx if i else 1 - fx
+                            val += wk * wj * wi * im[zi, yi, xi]
+                out[z, y, x] = val
+
+
+def affine_cpu(im, tmat, dzyx=None):
+    """Affine transformation of an image volume on the CPU
+
+    Mirrors libcudawrapper.affineGPU: tmat is a 4x4 matrix in XYZ order that
+    maps output coordinates to input coordinates (i.e. the inverse of the
+    transformation applied to the image), in world coordinates if the voxel
+    size dzyx is provided.  Uses linear interpolation, and the volume is
+    split across Z planes on all available threads.
+    """
+    if not np.issubdtype(im.dtype, np.float32):
+        im = im.astype(np.float32)
+    tmat = np.asarray(tmat, dtype=np.float64)
+    if dzyx is None or len(dzyx) != 3:
+        dzyx = (1.0, 1.0, 1.0)
+    result = np.empty(im.shape, dtype=np.float32)
+    _affine_kernel(im, result, tmat, *[float(d) for d in dzyx])
+    return result
+
+
+def affine(im, tmat, dzyx=None):
+    """Affine transformation of image volume, on the GPU if libcudaDeconv is
+    available, falling back to affine_cpu otherwise."""
+    if libcu.cudaLib:
+        return libcu.affineGPU(im, tmat, dzyx)
+    return affine_cpu(im, tmat, dzyx)
+
+
 def deskew_gputools(rawdata, dz=0.5, dx=0.102, angle=31.5, filler=0):
     try:
         import gputools
@@ -177,7 +312,7 @@ def deskew_gputools(rawdata, dz=0.5, dx=0.102, angle=31.5, filler=0):
     (nz, ny, nx) = rawdata.shape
     # Francois' method:
     # nxOut = math.ceil((nz - 1) * deskewFactor) + nx
-    nxOut = np.int(np.floor((nz - 1) * dz * abs(np.cos(angle * np.pi / 180)) / dx) + nx)
+    nxOut = int(np.floor((nz - 1) * dz * abs(np.cos(angle * np.pi / 180)) / dx) + nx)
     # +1 to pad left side with 1 column of filler pixels
     # otherwise, edge pixel values are smeared across the image
     paddedData = np.ones((nz, ny, nxOut), rawdata.dtype) * filler
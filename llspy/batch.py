@@ -0,0 +1,211 @@
+"""Concurrent batch processing of many LLS folders.
+
+Processing a folder has three stages that stress different resources:
+extracting the raw data (disk), correcting, deskewing and deconvolving it
+(a GPU, or the CPU worker pool) and compressing the raw data again (disk).
+:class:`BatchScheduler` runs every folder through these stages in its own
+thread, with a fixed number of slots per resource class, so that folder N+1
+is decompressed while folder N is processed and folder N-1 is compressed.
+"""
+
+import logging
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from . import compress
+from .cudabinwrapper import CUDAbin, CUDAbinException, nGPU
+from .exceptions import LLSpyError
+from .llsdir import LLSdir
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("decompress", "process", "compress")
+
+
+def _folder_size(path):
+    size = 0
+    for root, _, files in os.walk(str(path)):
+        for f in files:
+            try:
+                size += os.path.getsize(os.path.join(root, f))
+            except OSError:
+                pass
+    return size
+
+
+class BatchReport(object):
+    """Timing of a batch run, see :meth:`BatchScheduler.run`.
+
+    Attributes:
+        folders (list): paths of the folders that were processed
+        errors (dict): exceptions raised while processing, by folder path
+        nbytes (int): size of the processed folders before processing
+        elapsed (float): wall time of the batch in seconds
+        busy (dict): summed time spent in each stage in seconds
+    """
+
+    def __init__(self):
+        self.folders = []
+        self.errors = {}
+        self.nbytes = 0
+        self.elapsed = 0
+        self.busy = dict.fromkeys(STAGES, 0.0)
+        self._lock = threading.Lock()
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            self.busy[stage] += seconds
+
+    @property
+    def throughput(self):
+        """processed data in MB per second of wall time"""
+        return self.nbytes / 2**20 / self.elapsed if self.elapsed else 0
+
+    def summary(self):
+        lines = [
+            "Processed {} folder(s), {:.1f} MB in {:.1f} s: {:.2f} MB/s".format(
+                len(self.folders) - len(self.errors),
+                self.nbytes / 2**20,
+                self.elapsed,
+                self.throughput,
+            )
+        ]
+        if self.elapsed:
+            # a busy time above the wall time means the stage overlapped itself
+            lines.append(
+                "Stage time: "
+                + ", ".join(
+                    "{} {:.1f} s ({:.0%})".format(
+                        s, self.busy[s], self.busy[s] / self.elapsed
+                    )
+                    for s in STAGES
+                )
+            )
+        if self.errors:
+            lines.append("{} folder(s) failed".format(len(self.errors)))
+        return "\n".join(lines)
+
+
+class BatchScheduler(object):
+    """Process several LLS folders concurrently with per-resource limits.
+
+    Args:
+        cpu (int): folders processed at the same time on the CPU (with
+            deconBackend 'cpu' or without a GPU).  They share the worker
+            processes of :mod:`llspy.procpool`.
+        gpus (int, list): number or indices of the GPUs to use, one folder
+            per GPU at a time.  By default all GPUs that cudaDeconv detects.
+        disk (int): folders decompressed or compressed at the same time
+    """
+
+    def __init__(self, cpu=1, gpus=None, disk=1):
+        if gpus is None:
+            try:
+                gpus = nGPU(CUDAbin().path)
+            except CUDAbinException:
+                gpus = 0
+        if isinstance(gpus, int):
+            gpus = list(range(gpus))
+        if cpu < 1 or disk < 1:
+            raise ValueError("Batch processing needs at least one cpu and disk slot")
+        self.cpu = cpu
+        self.gpus = list(gpus)
+        self.disk = disk
+        self._cpuSlots = threading.Semaphore(cpu)
+        self._diskSlots = threading.Semaphore(disk)
+        self._gpuSlots = queue.Queue()
+        for device in self.gpus:
+            self._gpuSlots.put(device)
+
+    @property
+    def maxInFlight(self):
+        """folders in flight: one per processing slot, plus the folders
+        waiting on or using the disk before and after processing"""
+        return self.cpu + len(self.gpus) + 2 * self.disk
+
+    def _stage(self, report, name, slots, func, *args, **kwargs):
+        with slots:
+            start = time.time()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                report.add_time(name, time.time() - start)
+
+    def _process(self, report, exp, options):
+        if options.get("deconBackend") != "cpu" and self.gpus:
+            device = self._gpuSlots.get()
+            start = time.time()
+            try:
+                binary = CUDAbin(device=device)
+                logger.info("Processing {} on GPU {}".format(exp.path, device))
+                return exp.autoprocess(binary=binary, **options)
+            finally:
+                report.add_time("process", time.time() - start)
+                self._gpuSlots.put(device)
+        return self._stage(
+            report, "process", self._cpuSlots, exp.autoprocess, **options
+        )
+
+    def _run_folder(self, report, exp, options):
+        options = dict(options)
+        compressRaw = options.pop("compressRaw", False)
+        if exp.is_compressed() and not options.get("streaming"):
+            self._stage(report, "decompress", self._diskSlots, exp.decompress)
+        # compressing is left to the disk stage
+        self._process(report, exp, dict(options, compressRaw=False))
+        if compressRaw and not exp.is_compressed():
+            ctype = options.get("compressionType")
+            if ctype not in compress.availableCompression:
+                ctype = None
+            self._stage(
+                report, "compress", self._diskSlots, exp.compress, compression=ctype
+            )
+
+    def run(self, jobs, callback=None):
+        """Process (LLSdir, options) pairs, options being keyword arguments to
+        :meth:`LLSdir.autoprocess`.
+
+        Exceptions are collected per folder in the returned
+        :class:`BatchReport` instead of stopping the batch.  callback, if
+        provided, is called with (exp, exception or None) as each folder
+        finishes.
+        """
+        report = BatchReport()
+        for exp, _ in jobs:
+            report.folders.append(str(exp.path))
+            report.nbytes += _folder_size(exp.path)
+
+        def work(exp, options):
+            path = str(exp.path)
+            error = None
+            try:
+                self._run_folder(report, exp, options)
+            except Exception as e:
+                logger.error("Error processing {}: {}".format(path, e))
+                report.errors[path] = error = e
+            if callback is not None:
+                callback(exp, error)
+
+        start = time.time()
+        with ThreadPoolExecutor(max_workers=self.maxInFlight) as executor:
+            # submission order is the order in which folders queue for slots
+            futures = [executor.submit(work, exp, opts) for exp, opts in jobs]
+            for future in futures:
+                future.result()
+        report.elapsed = time.time() - start
+        return report
+
+
+def process_batch(folders, cpu=1, gpus=None, disk=1, **options):
+    """Process LLS folders concurrently, see :class:`BatchScheduler`.
+
+    options are passed to :meth:`LLSdir.autoprocess` for every folder.
+    Returns a :class:`BatchReport`.
+    """
+    if not folders:
+        raise LLSpyError("No folders to process")
+    jobs = [(LLSdir(f), options) for f in folders]
+    return BatchScheduler(cpu, gpus, disk).run(jobs)
@@ -8,7 +8,8 @@ except ImportError:
     sys.path.append(os.path.join(thisDirectory, os.pardir, os.pardir))
     import llspy
 
-from llspy import llsdir, util, schema, otf, libinstall, exceptions
+from llspy import batch, llsdir, util, schema, otf, libinstall, exceptions, procpool
+from llspy.compress import availableCompression
 import os
 import sys
 import click
@@ -538,6 +539,34 @@ def check_iters(ctx, param, value):
     show_default=True,
     help="Compress raw files after processing",
 )
+@click.option(
+    "--streaming",
+    "streaming",
+    is_flag=True,
+    default=DEFAULTS["streaming"][0],
+    show_default=True,
+    help="Process one timepoint at a time in memory: a single read and write "
+    "per stack, no intermediate Corrected folder",
+)
+@click.option(
+    "--cache",
+    "stageCache",
+    is_flag=True,
+    default=DEFAULTS["stageCache"][0],
+    show_default=True,
+    help="With --streaming: reuse corrected, deskewed and deconvolved stacks "
+    "of previous runs with the same upstream parameters (see cache_dir and "
+    "cache_quota in the config file)",
+)
+@click.option(
+    "--format",
+    "outputFormat",
+    type=click.Choice(["tiff", "zarr"]),
+    default=DEFAULTS["outputFormat"][0],
+    show_default=True,
+    help="Write processed stacks as individual tiffs, or into one chunked "
+    "Zarr store per output type",
+)
 @click.option(
     "-r",
     "--reprocess",
@@ -547,6 +576,13 @@ def check_iters(ctx, param, value):
     help="Process even if the folder already has a processingLog JSON file, "
     "(otherwise skip)",
 )
+@click.option(
+    "--resume/--no-resume",
+    "resume",
+    default=None,
+    help="Skip stacks that the completion journal of an interrupted run "
+    "records as done with the same parameters  [default: resume]",
+)
 @click.option(
     "--batch",
     is_flag=True,
@@ -554,6 +590,29 @@ def check_iters(ctx, param, value):
     help="batch process folder: Recurse through all subfolders with a "
     "Settings.txt file",
 )
+@click.option(
+    "--cpu-slots",
+    "cpuSlots",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Batch: number of folders processed at once on the CPU",
+)
+@click.option(
+    "--gpus",
+    type=int,
+    default=None,
+    help="Batch: number of GPUs to use, one folder per GPU at a time "
+    "(default: all detected GPUs)",
+)
+@click.option(
+    "--disk-slots",
+    "diskSlots",
+    type=int,
+    default=1,
+    show_default=True,
+    help="Batch: number of folders decompressed or compressed at once",
+)
 @click.option(
     "--yes/--no",
     "useAlreadyCorrected",
@@ -561,9 +620,26 @@ def check_iters(ctx, param, value):
     default=None,
     help="autorespond to prompts",
 )
+@click.option(
+    "--workers",
+    type=int,
+    default=None,
+    help="Number of worker processes for CPU-parallel steps, shared by all "
+    "folders of a batch (default: one per core)",
+)
+@click.option(
+    "--worker-mem",
+    "workerMemory",
+    type=int,
+    default=None,
+    help="Memory budget per worker process in MB (limits the number of workers)",
+)
 @pass_config
 def decon(config, path, **kwargs):
     """Deskew and deconvolve data in LLSDIR."""
+    if kwargs["workers"] or kwargs["workerMemory"]:
+        procpool.configure(kwargs["workers"], kwargs["workerMemory"])
+
     # update config with relevant values from
 
     # raw deskewed MIPs imply saving Deskewed Raw files
@@ -591,7 +667,8 @@ def decon(config, path, **kwargs):
     # elif options.otfdir is None:
     #     options.otfdir = default_otfdir
 
-    def procfolder(dirpath, options):
+    def prepare(dirpath, options):
+        """checks and prompts before processing, returns the LLSdir or None"""
         E = llsdir.LLSdir(dirpath)
 
         # check whether folder has already been processed by the presence of a
@@ -599,7 +676,7 @@ def decon(config, path, **kwargs):
         if E.has_been_processed() and not options["reprocess"]:
             print("Folder already appears to be processed: {}".format(E.path))
             print("Skipping ... use the '--reprocess' flag to force reprocessing")
-            return 0
+            return None
 
         if options["reprocess"] and E.is_compressed():
             # uncompress the raw files first...
@@ -640,37 +717,54 @@ def decon(config, path, **kwargs):
                     E.path = E.path.joinpath("Corrected")
                 else:
                     click.echo("recreating corrected files...")
+        return E
 
-        try:
-            # try:
+    def procfolder(dirpath, options):
+        E = prepare(dirpath, options)
+        if E is not None:
             E.autoprocess(**options)
-            # logdict = None
-            # except Exception as e:
-            #     raise click.ClickException(e)
-        except Exception:
-            raise
+
+    def report_error(e):
+        if isinstance(e, voluptuous.error.MultipleInvalid):
+            e = str(e).replace("@ data['", "for ")
+            e = e.strip("'][0]")
+            click.secho("VALIDATION ERROR: %s" % e, fg="red")
+        else:
+            click.secho("ERROR: %s" % e, fg="red")
 
     if kwargs["batch"]:
-        try:
-            subfolders = util.get_subfolders_containing_filepattern(
-                path, filepattern="*Settings.txt"
-            )
-            click.secho("found the following LLS data folders:", fg="magenta")
-            for folder in subfolders:
-                click.secho(folder.split(path)[1], fg="yellow")
-            for folder in subfolders:
-                try:
-                    procfolder(folder, config)
-                except voluptuous.error.MultipleInvalid as e:
-                    e = str(e).replace("@ data['", "for ")
-                    e = e.strip("'][0]")
-                    click.secho("VALIDATION ERROR: %s" % e, fg="red")
-                except exceptions.LLSpyError as e:
-                    click.secho("ERROR: %s" % e, fg="red")
-            click.echo("\n\nDone batch processing!")
-            sys.exit(0)
-        except Exception:
-            raise
+        subfolders = util.get_subfolders_containing_filepattern(
+            path, filepattern="*Settings.txt"
+        )
+        click.secho("found the following LLS data folders:", fg="magenta")
+        for folder in subfolders:
+            click.secho(folder.split(path)[1], fg="yellow")
+        # prompts are answered up front, then folders are processed concurrently
+        jobs = []
+        for folder in subfolders:
+            options = dict(config)
+            try:
+                E = prepare(folder, options)
+            except (voluptuous.error.MultipleInvalid, exceptions.LLSpyError) as e:
+                report_error(e)
+                continue
+            if E is not None:
+                jobs.append((E, options))
+
+        def finished(E, error):
+            if error is None:
+                click.secho("finished: {}".format(E.path), fg="green")
+            else:
+                click.secho("{}:".format(E.path), fg="red")
+                report_error(error)
+
+        scheduler = batch.BatchScheduler(
+            cpu=kwargs["cpuSlots"], gpus=kwargs["gpus"], disk=kwargs["diskSlots"]
+        )
+        report = scheduler.run(jobs, callback=finished)
+        click.echo("\n\nDone batch processing!")
+        click.secho(report.summary(), fg="cyan")
+        sys.exit(0)
     else:
         try:
             procfolder(path, config)
@@ -790,6 +884,15 @@ def camera(calibrate):
     default=False,
     help="Decompress folder if already compress.",
 )
+@click.option(
+    "-t",
+    "--type",
+    "compression",
+    type=click.Choice(availableCompression),
+    default=None,
+    help="Compression program, or llsz for an indexed per-stack archive "
+    "that needs no external binaries",
+)
 @click.option(
     "--keepmips/--removemips",
     "keepmips",
@@ -824,7 +927,16 @@ def camera(calibrate):
     show_default=True,
 )
 def compress(
-    paths, freeze, _reduce, decompress, recurse, minage, keepmips, depth, dryrun
+    paths,
+    freeze,
+    _reduce,
+    decompress,
+    compression,
+    recurse,
+    minage,
+    keepmips,
+    depth,
+    dryrun,
 ):
     """Compression & decompression of LLSdir"""
     exclusive(
@@ -876,12 +988,12 @@ def compress(
                     click.secho("    freeze:", nl=False, underline=False, fg="yellow")
                     click.echo("{}".format(path))
                     if not dryrun:
-                        E.freeze(keepmip=keepmips)
+                        E.freeze(keepmip=keepmips, compression=compression)
                 else:
                     click.secho("  compress:", nl=False, underline=False, fg="yellow")
                     click.echo("{}".format(path))
                     if not dryrun:
-                        E.compress()
+                        E.compress(compression=compression)
         except exceptions.CompressionError as e:
             logger.warn(e)
 
@@ -1,10 +1,10 @@
 from . import util
 from . import llsdir
+from . import procpool
 import numpy as np
 import os
 import glob
 import tifffile as tf
-import multiprocessing
 from scipy.optimize import least_squares
 from numba import jit
 import warnings
@@ -77,10 +77,9 @@ def parallel_fit(xdata, ydata, callback=None):
     first plane = paramater a = plateau of exponential association
     second plane = parameter b = rate of exponential association
     """
-    pool = multiprocessing.Pool()
     M = xdata.shape[1]
     N = xdata.shape[2]
-    imap_iter = pool.imap(
+    imap_iter = procpool.get_pool().imap(
         splat_fit,
         ((xdata[:, i, j], ydata[:, i, j], i, j) for i in range(M) for j in range(N)),
         chunksize=8,
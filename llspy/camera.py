@@ -7,38 +7,122 @@ import os
 import re
 import warnings
 import numpy as np
-from numba import jit
+from numba import jit, prange
 import math
 
 
-# #THIS ONE WORKS BEST SO FAR
-@jit(nopython=True, nogil=True)
+@jit(nopython=True, nogil=True, parallel=True)
+def _flash_kernel(stack, a, b, offset, dampening, z0, y0, x0, out):
+    nzo, nyo, nxo = out.shape
+    for yo in prange(nyo):
+        y = yo + y0
+        # planes are visited last to first, so that out may be the input
+        # buffer: each plane is corrected using the raw plane before it
+        for zo in range(nzo - 1, -1, -1):
+            z = zo + z0
+            for xo in range(nxo):
+                x = xo + x0
+                d = np.float32(stack[z, y, x]) - offset[y, x]
+                if z > 0:
+                    prev = np.float32(stack[z - 1, y, x]) - offset[y, x]
+                    d -= dampening * a[y, x] * (1 - math.exp(-b[y, x] * prev))
+                out[zo, yo, xo] = d if d > 0 else 0
+
+
+def flash_correct(
+    stack,
+    a,
+    b,
+    offset,
+    dampening=0.88,
+    trim=((0, 0), (0, 0), (0, 0)),
+    ninterleaved=1,
+    inplace=False,
+):
+    """correct "sticky" Flash pixels in an interleaved stack.
+
+    Offset subtraction, correction, clipping at zero, trimming (see
+    arrayfun.trimedges) and the cast back to the dtype of stack happen in a
+    single parallel pass.  With inplace=True and no trimming, stack itself is
+    overwritten and returned.
+    """
+    nz, ny, nx = stack.shape
+    z0, z1 = trim[0][0] * ninterleaved, nz - trim[0][1] * ninterleaved
+    y0, y1 = trim[1][0], ny - trim[1][1]
+    x0, x1 = trim[2][0], nx - trim[2][1]
+    if inplace and not any([any(i) for i in trim]):
+        out = stack
+    else:
+        out = np.empty((z1 - z0, y1 - y0, x1 - x0), stack.dtype)
+    a, b, offset = [np.asarray(p, np.float32) for p in (a, b, offset)]
+    _flash_kernel(stack, a, b, offset, np.float32(dampening), z0, y0, x0, out)
+    return out
+
+
 def calc_correction(stack, a, b, offset):
-    res = np.empty_like(stack)
-    for i in range(stack.shape[0]):
-        for j in range(stack.shape[1]):
-            for k in range(stack.shape[2]):
-                if i == 0:
-                    d = stack[i, j, k] - offset[j, k]
-                    res[i, j, k] = d if d > 0 else 0
-                else:
-                    cor = a[j, k] * (
-                        1 - math.exp(-b[j, k] * (stack[i - 1, j, k] - offset[j, k]))
-                    )
-                    d = stack[i, j, k] - offset[j, k] - 0.88 * cor
-                    res[i, j, k] = d if d > 0 else 0
-    return res
+    return flash_correct(stack, a, b, offset)
 
 
 def selectiveMedianFilter(
-    stack, backgroundValue, medianRange=3, verbose=False, withMean=False
+    stack,
+    backgroundValue,
+    medianRange=3,
+    verbose=False,
+    withMean=False,
+    cache=None,
+    inplace=False,
 ):
     """correct bad pixels on sCMOS camera.
     based on MATLAB code by Philipp J. Keller,
     HHMI/Janelia Research Campus, 2011-2014
 
+    Bad pixels are replaced by the median of their medianRange x medianRange
+    neighbourhood (reflected at the edges), which is only computed at the bad
+    pixels.  Bad pixels are a property of the camera, so the mask can be
+    detected once and reused: cache is a dict kept per camera and ROI by the
+    caller (see CameraParameters.correct_stacks), in which the mask detected
+    for the first stack of a given frame shape is stored for later stacks.
+    With inplace=True, stack itself is corrected and returned.
     """
-    from scipy.ndimage.filters import median_filter
+    key = (stack.shape[1:], medianRange, withMean)
+    if cache is not None and key in cache:
+        pixelMatrix, pixelCorrection = cache[key]
+    else:
+        pixelMatrix, pixelCorrection = _detectBadPixels(
+            stack, backgroundValue, medianRange, withMean
+        )
+        if cache is not None:
+            cache[key] = (pixelMatrix, pixelCorrection)
+
+    if verbose:
+        pixpercent = 100 * np.sum(pixelMatrix) / float(pixelMatrix.size)
+        print("Bad pixels detected: {} {:0.2f}".format(np.sum(pixelMatrix), pixpercent))
+
+    out = stack if inplace else np.array(stack)
+    ys, xs = np.nonzero(pixelMatrix)
+    if len(ys):
+        # gather the neighbourhoods of all bad pixels in many planes at once
+        r = medianRange // 2
+        offsets = np.arange(-r, r + 1)
+        ny, nx = pixelMatrix.shape
+        yy = _reflect(ys[:, np.newaxis, np.newaxis] + offsets[:, np.newaxis], ny)
+        xx = _reflect(xs[:, np.newaxis, np.newaxis] + offsets, nx)
+        nplanes = max(1, 2**22 // (len(ys) * medianRange**2))
+        for z in range(0, stack.shape[0], nplanes):
+            neighbours = np.asarray(stack[z : z + nplanes, yy, xx], np.float32)
+            neighbours = neighbours.reshape(neighbours.shape[:2] + (-1,))
+            out[z : z + nplanes, ys, xs] = np.median(neighbours, -1).astype(out.dtype)
+    return out, pixelCorrection
+
+
+def _reflect(idx, n):
+    """mirror indices at the edges, like scipy.ndimage mode='reflect'"""
+    idx = np.where(idx < 0, -idx - 1, idx)
+    return np.where(idx >= n, 2 * n - idx - 1, idx)
+
+
+def _detectBadPixels(stack, backgroundValue, medianRange=3, withMean=False):
+    from scipy.ndimage import median_filter
 
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
@@ -47,7 +131,7 @@ def selectiveMedianFilter(
         devProjMedFiltered = median_filter(devProj, medianRange, mode="constant")
         deviationDistances = np.abs(devProj - devProjMedFiltered)
         deviationDistances[deviationDistances == np.inf] = 0
-        deviationThreshold = determineThreshold(sorted(deviationDistances.flatten()))
+        deviationThreshold = determineThreshold(deviationDistances.ravel())
 
         deviationMatrix = deviationDistances > deviationThreshold
 
@@ -56,7 +140,7 @@ def selectiveMedianFilter(
             meanProjMedFiltered = median_filter(meanProj, medianRange)
             meanDistances = np.abs(meanProj - meanProjMedFiltered / meanProjMedFiltered)
             meanDistances[meanDistances == np.inf] = 0
-            meanThreshold = determineThreshold(sorted(meanDistances.flatten()))
+            meanThreshold = determineThreshold(meanDistances.ravel())
 
             meanMatrix = meanDistances > meanThreshold
 
@@ -70,31 +154,13 @@ def selectiveMedianFilter(
         else:
             pixelMatrix = deviationMatrix
             pixelCorrection = [deviationDistances, deviationThreshold]
-
-        if verbose:
-            pixpercent = (
-                100 * np.sum(pixelMatrix.flatten()) / float(len(pixelMatrix.flatten()))
-            )
-            print(
-                "Bad pixels detected: {} {:0.2f}".format(
-                    np.sum(pixelMatrix.flatten()), pixpercent
-                )
-            )
-
-        dt = stack.dtype
-        out = np.zeros(stack.shape, dt)
-        # apply pixelMatrix to correct insensitive pixels
-        for z in range(stack.shape[0]):
-            frame = np.asarray(stack[z], "Float32")
-            filteredFrame = median_filter(frame, medianRange)
-            frame[pixelMatrix == 1] = filteredFrame[pixelMatrix == 1]
-            out[z] = np.asarray(frame, dt)
-
-        return out, pixelCorrection
+    return pixelMatrix, pixelCorrection
 
 
 def determineThreshold(array, maxSamples=50000):
-    array = np.array(array)
+    """threshold at the knee of the sorted values of array"""
+    # np.sort is a small fraction of the cost of sorted() on numpy scalars
+    array = np.sort(np.asarray(array), axis=None)
     elements = len(array)
 
     if elements > maxSamples:  # subsample
@@ -204,7 +270,8 @@ class CameraParameters(object):
         if data is None and fname is None:
             raise ValueError("Must provide either filename or data array")
         if data is not None:
-            self.data = data.astype(np.float32)
+            # no copy for float32 data, e.g. a view on shared memory
+            self.data = data.astype(np.float32, copy=False)
             self.path = None
             self.basename = None
         else:
@@ -216,7 +283,7 @@ class CameraParameters(object):
                 roi = [int(r) for r in roi.groups()]
             self.basename = os.path.basename(fname)
             # TODO: ignore warnings from tifffile
-            self.data = imread(fname).astype(np.float64)
+            self.data = imread(fname).astype(np.float32)
 
         if roi is None or not len(roi):
             raise ValueError(
@@ -247,6 +314,8 @@ class CameraParameters(object):
         self.a = self.data[0]
         self.b = self.data[1]
         self.offset = self.data[2]
+        # bad pixel masks of selectiveMedianFilter, reused for every stack
+        self._badPixels = {}
 
     def get_subroi(self, subroi):
         # make sure the Parameter ROI contains the data ROI
@@ -284,10 +353,14 @@ class CameraParameters(object):
             e.g. [stack_ch0, stack_ch1, stack_ch2, ...]
 
         Returns a corrected list of np.ndarrays of the same
-        shape and length as the input ... unless trimedges is used
+        shape and length as the input ... unless trimedges is used.
+        The arrays are strided views into a single interleaved buffer.
         trim edges is a tuple of 2tuples that controls how many pixels are trimmed
         from the ((1stplane,lastplane),(top,bottom), (left, right))
         by default: trim first Z plane and single pixel from X-edges
+
+        The medianFilter bad pixel mask is detected on the first call and
+        reused by later calls with the same frame shape.
         """
 
         if not len(stacks):
@@ -302,18 +375,32 @@ class CameraParameters(object):
         nz, ny, nx = stacks[0].shape
         numStacks = len(stacks)
         typ = stacks[0].dtype
+        interleaved = np.empty((nz * numStacks, ny, nx), typ)
+        channels = interleaved.reshape((nz, numStacks, ny, nx))
+        for q, S in enumerate(stacks):
+            channels[:, q] = S
 
         if flashCorrectTarget == "cuda" or flashCorrectTarget == "gpu":
             # this must be called before! but better to do it outside of this function
             # libcu.camcor_init(interleaved.shape, self.a, self.b, self.offset)
-            interleaved = np.stack(stacks, 1).reshape((-1, ny, nx))
             interleaved = libcu.camcor(interleaved)
         else:
-            interleaved = np.stack(stacks, 1).reshape((-1, ny, nx))
-
             if flashCorrectTarget == "cpu":
-                # JIT VERSION
-                interleaved = calc_correction(interleaved, self.a, self.b, self.offset)
+                # JIT VERSION.  Trimming is fused into the correction, unless
+                # the median filter, which looks at whole frames, runs first
+                notrim = ((0, 0), (0, 0), (0, 0))
+                interleaved = flash_correct(
+                    interleaved,
+                    self.a,
+                    self.b,
+                    self.offset,
+                    dampening,
+                    notrim if medianFilter else trim,
+                    numStacks,
+                    inplace=True,
+                )
+                if not medianFilter:
+                    trim = notrim
             elif flashCorrectTarget == "numpy":
                 # NUMPY VERSION
                 interleaved = np.subtract(interleaved, self.offset)
@@ -333,7 +420,9 @@ class CameraParameters(object):
 
         # do Philpp Keller medianFilter Filter
         if medianFilter:
-            interleaved, pixCorrection = selectiveMedianFilter(interleaved, 0)
+            interleaved, pixCorrection = selectiveMedianFilter(
+                interleaved, 0, cache=self._badPixels, inplace=True
+            )
 
         # sometimes the columns on the very edge are brighter than the rest
         # (particularly if an object is truncated and there's more content
@@ -346,15 +435,58 @@ class CameraParameters(object):
             warnings.warn("CONVERTING")
             interleaved = interleaved.astype(typ)
 
-        deinterleaved = [s for s in np.split(interleaved, interleaved.shape[0])]
-        deinterleaved = [
-            np.concatenate(deinterleaved[q::numStacks]) for q in range(numStacks)
-        ]
+        # deinterleave as views: plane z of channel q is plane z * numStacks + q
+        channels = interleaved.reshape((-1, numStacks) + interleaved.shape[1:])
+        return [channels[:, q] for q in range(numStacks)]
 
-        return deinterleaved
+
+def _correct_stacks_copying(camparams, stacks):
+    """previous implementation of correct_stacks (without medianFilter or trim),
+    kept for the benchmark below"""
+    numStacks = len(stacks)
+    interleaved = np.stack(stacks, 1).reshape((-1,) + stacks[0].shape[1:])
+    interleaved = flash_correct(interleaved, camparams.a, camparams.b, camparams.offset)
+    deinterleaved = [s for s in np.split(interleaved, interleaved.shape[0])]
+    return [np.concatenate(deinterleaved[q::numStacks]) for q in range(numStacks)]
 
 
 if __name__ == "__main__":
+    import sys
+    import time
+
+    if len(sys.argv) > 1 and sys.argv[1] == "interleave":
+        # python -m llspy.camera interleave
+        # peak memory and time of correct_stacks with 3 channels of 200 planes
+        import tracemalloc
+
+        ny, nx = 256, 256
+        rng = np.random.RandomState(0)
+        corrector = CameraParameters(
+            data=np.stack(
+                [np.full((ny, nx), 20), np.full((ny, nx), 0.01), np.full((ny, nx), 100)]
+            ),
+            roi=[1, 1, ny, nx],
+        )
+        stacks = [rng.poisson(300, (200, ny, nx)).astype(np.uint16) for _ in range(3)]
+        nbytes = sum(S.nbytes for S in stacks)
+        for name, func in (
+            ("copying", lambda: _correct_stacks_copying(corrector, stacks)),
+            ("views", lambda: corrector.correct_stacks(stacks)),
+        ):
+            func()  # compile
+            tracemalloc.start()
+            start = time.time()
+            out = func()
+            elapsed = time.time() - start
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            del out
+            print(
+                "{:8s} {:6.3f} s, peak {:.1f}x input".format(
+                    name, elapsed, 1 + peak / nbytes
+                )
+            )
+        sys.exit(0)
 
     from llspy import llsdir
     from llspy import samples
@@ -374,8 +506,6 @@ if __name__ == "__main__":
     stacks = [imread(str(t)) for t in E.tiff.raw if "stack0000" in str(t)]
     niters = 5
 
-    import time
-
     start = time.time()
     for _ in range(niters):
         d1 = corrector.correct_stacks(
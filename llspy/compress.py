@@ -3,16 +3,37 @@ from .exceptions import CompressionError
 
 import tarfile
 import os
+import io
 import sys
+import json
+import zlib
+import struct
 import subprocess
 import logging
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 
+# in-process archive format: every tiff is compressed independently and
+# followed by a JSON index, so single stacks can be read without touching
+# the rest of the archive.  Layout:
+#   MAGIC | member 0 | member 1 | ... | JSON index | index offset (<Q) | MAGIC
+ARCHIVE_EXT = ".llsz"
+_MAGIC = b"LLSZ"
+_FOOTER = struct.Struct("<Q4s")
+
 EXTENTIONS = {
     ".bz2": ("lbzip2", "bzip2"),
     ".gz": ("pigz", "gzip"),
     ".zz": ("pigz", "gzip"),
+    ARCHIVE_EXT: (),
 }
 
 archive_extension = {
@@ -30,6 +51,8 @@ availableCompression = []
 for ctype in ("lbzip2", "pbzip2", "pigz", "bzip2", "gzip"):
     if util.which(ctype) is not None:
         availableCompression.append(ctype)
+# needs no external binary
+availableCompression.append("llsz")
 
 
 def get_platform_compression():
@@ -37,21 +60,24 @@ def get_platform_compression():
     return availableCompression[0]
 
 
-def tartiffs(path, delete=True):
-    tifflist = [f for f in os.listdir(path) if f.endswith(".tif")]
+def _archive_basename(tifflist):
     # figure out what type of folder this is
-    if not len(tifflist):
-        logger.info("No tiffs found in folder {}".format(path))
-        return None
-
-        # generate output file name
     folder_type = "RAW"
     if "_deskewed" in tifflist[0]:
         folder_type = "DESKEWED"
     elif "_decon" in tifflist[0]:
         folder_type = "DECON"
-    basename = "_".join([tifflist[0].split("_ch")[0], folder_type])
-    outtar = os.path.join(path, basename + ".tar")
+    return "_".join([tifflist[0].split("_ch")[0], folder_type])
+
+
+def tartiffs(path, delete=True):
+    tifflist = [f for f in os.listdir(path) if f.endswith(".tif")]
+    if not len(tifflist):
+        logger.info("No tiffs found in folder {}".format(path))
+        return None
+
+    # generate output file name
+    outtar = os.path.join(path, _archive_basename(tifflist) + ".tar")
 
     # create the tarfile
     with tarfile.open(outtar, "w") as tar:
@@ -143,22 +169,265 @@ def unzip_partial(fname, tRange=None, compression=None):
             )
 
 
+def _codec(name):
+    """return (compress, decompress) functions for an archive codec"""
+    if name == "zstd":
+        if zstandard is None:
+            raise CompressionError("zstd archives require the zstandard package")
+        # zstandard (de)compressor objects are not thread safe: one per call
+        return (
+            lambda raw: zstandard.ZstdCompressor(level=3).compress(raw),
+            lambda blob: zstandard.ZstdDecompressor().decompress(blob),
+        )
+    elif name == "zlib":
+        return (lambda raw: zlib.compress(raw, 6), zlib.decompress)
+    raise CompressionError("Unknown archive codec: {}".format(name))
+
+
+def write_archive(outname, files, codec=None, threads=None):
+    """Compress each file in `files` independently into a single archive.
+
+    Compression runs in a thread pool (zlib and zstd release the GIL), and
+    members are written in order.  If codec is None, zstd is used when the
+    zstandard package is available, otherwise zlib.
+    """
+    if codec is None:
+        codec = "zstd" if zstandard is not None else "zlib"
+    compressor = _codec(codec)[0]
+    threads = threads or os.cpu_count() or 1
+
+    def pack(fname):
+        with open(fname, "rb") as fh:
+            raw = fh.read()
+        return compressor(raw), len(raw), zlib.crc32(raw)
+
+    members = []
+    with open(outname, "wb") as out:
+        out.write(_MAGIC)
+        for fname, (blob, size, crc) in util.prefetch(
+            pack, files, depth=2 * threads, nthreads=threads
+        ):
+            members.append(
+                {
+                    "name": os.path.basename(fname),
+                    "offset": out.tell(),
+                    "length": len(blob),
+                    "size": size,
+                    "crc32": crc,
+                }
+            )
+            out.write(blob)
+        indexpos = out.tell()
+        index = {"version": 1, "codec": codec, "members": members}
+        out.write(json.dumps(index).encode("utf-8"))
+        out.write(_FOOTER.pack(indexpos, _MAGIC))
+    return outname
+
+
+class Archive(object):
+    """Random access reader for archives written by :func:`write_archive`
+
+    Only the footer index is read on creation, members are read and
+    decompressed on demand.
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        with open(self.path, "rb") as fh:
+            fh.seek(0, os.SEEK_END)
+            end = fh.tell() - _FOOTER.size
+            if end < len(_MAGIC):
+                raise CompressionError("Not an LLSpy archive: {}".format(self.path))
+            fh.seek(end)
+            indexpos, magic = _FOOTER.unpack(fh.read(_FOOTER.size))
+            if magic != _MAGIC or not len(_MAGIC) <= indexpos <= end:
+                raise CompressionError("Not an LLSpy archive: {}".format(self.path))
+            fh.seek(indexpos)
+            index = json.loads(fh.read(end - indexpos).decode("utf-8"))
+        self.codec = index["codec"]
+        self._decompress = _codec(self.codec)[1]
+        self.members = OrderedDict((m["name"], m) for m in index["members"])
+
+    def __len__(self):
+        return len(self.members)
+
+    def __contains__(self, name):
+        return name in self.members
+
+    @property
+    def names(self):
+        return list(self.members.keys())
+
+    def size(self, name):
+        """uncompressed size in bytes of a member"""
+        return self.members[name]["size"]
+
+    def read(self, name):
+        """return the uncompressed bytes of a single member"""
+        try:
+            member = self.members[name]
+        except KeyError:
+            raise CompressionError("No member {} in archive {}".format(name, self.path))
+        with open(self.path, "rb") as fh:
+            fh.seek(member["offset"])
+            raw = self._decompress(fh.read(member["length"]))
+        if len(raw) != member["size"] or zlib.crc32(raw) != member["crc32"]:
+            raise CompressionError(
+                "Corrupt member {} in archive {}".format(name, self.path)
+            )
+        return raw
+
+    def imread(self, name):
+        """read a single tiff member into a numpy array"""
+        return util.imread(io.BytesIO(self.read(name)))
+
+    def close(self):
+        # every read opens its own file handle
+        pass
+
+    def extract(self, dest=None, names=None, threads=None):
+        """write members (default: all) to folder `dest` (default: archive
+        folder), decompressing in parallel.  Returns the extracted paths.
+        """
+        dest = dest or os.path.dirname(self.path)
+        names = self.names if names is None else list(names)
+
+        def unpack(name):
+            outpath = os.path.join(dest, name)
+            with open(outpath, "wb") as fh:
+                fh.write(self.read(name))
+            return outpath
+
+        with ThreadPoolExecutor(threads or os.cpu_count() or 1) as pool:
+            return list(pool.map(unpack, names))
+
+
+class TarArchive(Archive):
+    """Reader for (compressed) tarballs with the same interface as :class:`Archive`
+
+    Tarballs have no index and compressed streams cannot seek backwards, so
+    listing the members takes one pass through the file and members are read
+    in a single forward pass.  Members skipped on the way to the requested one
+    are kept in memory (up to `maxbuffer` bytes) until they are first read;
+    the stream is only restarted for a member that was consumed and not kept.
+    """
+
+    def __init__(self, path, maxbuffer=1 << 30):
+        self.path = str(path)
+        self.maxbuffer = maxbuffer
+        self._lock = threading.Lock()
+        with tarfile.open(self.path, "r:*") as tar:
+            self.members = OrderedDict(
+                (os.path.basename(m.name), m.size) for m in tar if m.isfile()
+            )
+        self._stream = None
+        self._skipped = {}
+        self._read = set()
+
+    def size(self, name):
+        return self.members[name]
+
+    def _next(self):
+        """return (name, bytes) of the next file in the stream, or None"""
+        if self._stream is None:
+            self._stream = tarfile.open(self.path, "r|*")
+        member = self._stream.next()
+        while member is not None and not member.isfile():
+            member = self._stream.next()
+        if member is None:
+            self._stream.close()
+            self._stream = None
+            return None
+        return os.path.basename(member.name), self._stream.extractfile(member).read()
+
+    def read(self, name):
+        if name not in self.members:
+            raise CompressionError("No member {} in archive {}".format(name, self.path))
+        with self._lock:
+            self._read.add(name)
+            if name in self._skipped:
+                return self._skipped.pop(name)
+            restarted = self._stream is None
+            while True:
+                item = self._next()
+                if item is None:
+                    if restarted:
+                        raise CompressionError(
+                            "Could not read {} from {}".format(name, self.path)
+                        )
+                    restarted = True
+                    continue
+                key, data = item
+                if key == name:
+                    return data
+                buffered = sum(len(v) for v in self._skipped.values())
+                if key not in self._read and buffered + len(data) <= self.maxbuffer:
+                    self._skipped[key] = data
+
+    def close(self):
+        with self._lock:
+            if self._stream is not None:
+                self._stream.close()
+                self._stream = None
+            self._skipped.clear()
+
+
+def open_archive(path):
+    """return a reader for the archive `path`, or the archive in folder `path`"""
+    fname = find_archive(path) if os.path.isdir(path) else path
+    if fname is None:
+        raise CompressionError("No compressed files found in {}".format(path))
+    if fname.endswith(ARCHIVE_EXT):
+        return Archive(fname)
+    return TarArchive(fname)
+
+
+def archive_tiffs(path, delete=True, codec=None, threads=None):
+    """compress all tiffs in `path` into a single indexed .llsz archive"""
+    tifflist = sorted(f for f in os.listdir(path) if f.endswith(".tif"))
+    if not len(tifflist):
+        logger.info("No tiffs found in folder {}".format(path))
+        return None
+
+    outname = os.path.join(path, _archive_basename(tifflist) + ARCHIVE_EXT)
+    write_archive(outname, [os.path.join(path, f) for f in tifflist], codec, threads)
+    if delete:
+        [os.remove(os.path.join(path, i)) for i in tifflist]
+    return outname
+
+
+def find_archive(path):
+    """return the .llsz archive or compressed tarball in folder `path`"""
+    return util.find_filepattern(path, "*" + ARCHIVE_EXT) or util.find_filepattern(
+        path, "*.tar*"
+    )
+
+
+def _stack_members(archive, tRange):
+    wanted = ["stack{:04d}".format(t) for t in tRange]
+    return [n for n in archive.names if any(w in n for w in wanted)]
+
+
 def compress(path, compression=None):
     logger.debug("compressing folder {}".format(path))
-    if util.find_filepattern(path, "*.tar*") is not None:
+    if find_archive(path) is not None:
         raise CompressionError("There is already a compressed file in this directory")
+    if compression == "llsz":
+        return archive_tiffs(path)
     tar = tartiffs(path)
     return zipit(tar, compression) if tar is not None and os.path.isfile(tar) else None
 
 
 def decompress(file, compression=None):
     logger.debug("decompressing folder {}".format(file))
+    compressedtar = find_archive(file) if os.path.isdir(file) else file
+    if compressedtar is not None and compressedtar.endswith(ARCHIVE_EXT):
+        Archive(compressedtar).extract()
+        os.remove(compressedtar)
+        return os.path.dirname(compressedtar)
     if compression is None:
         compression = get_platform_compression()
         # if it's not a tar.bz2, assume it's a directory that contains one
-    compressedtar = (
-        util.find_filepattern(file, "*.tar*") if os.path.isdir(file) else file
-    )
     if compressedtar is None:
         logger.info("No compressed files found in {}".format(file))
         return None
@@ -172,12 +441,16 @@ def decompress(file, compression=None):
 
 
 def decompress_partial(file, tRange, compression=None):
+    if tRange is None:
+        tRange = [0]
+    compressedtar = find_archive(file) if os.path.isdir(file) else file
+    if compressedtar is not None and compressedtar.endswith(ARCHIVE_EXT):
+        # only the requested stacks are read from disk
+        archive = Archive(compressedtar)
+        return archive.extract(names=_stack_members(archive, tRange))
     if compression is None:
         compression = get_platform_compression()
         # if it's not a tar.bz2, assume it's a directory that contains one
-    compressedtar = (
-        util.find_filepattern(file, "*.tar*") if os.path.isdir(file) else file
-    )
     if compressedtar is None:
         logger.info("No compressed files found in {}".format(file))
         return None
@@ -24,6 +24,13 @@ defaults = {
     ),
     "otf_path": "/Users/talley/Dropbox (HMS)/CBMF/lattice_sample_data/lls_PSFs/",
     "output_log": "ProcessingLog.txt",
+    "index_file": ".llspy_index.json",
+    # process pool: number of workers (0: one per core), MB per worker (0: no limit)
+    "workers": "0",
+    "worker_memory": "0",
+    # stage cache of intermediate products: folder and disk quota in MB
+    "cache_dir": os.path.expanduser("~/.llspy_cache"),
+    "cache_quota": "20000",
 }
 
 config = configparser.ConfigParser()
@@ -55,3 +62,8 @@ __RADIALFT__ = _get_param("radialft", str)
 __CAMPARAMS__ = _get_param("camera_parameters", str)
 __OTFPATH__ = plib.Path(_get_param("otf_path", str))
 __OUTPUTLOG__ = _get_param("output_log", str)
+__INDEXFILE__ = _get_param("index_file", str)
+__WORKERS__ = _get_param("workers", int)
+__WORKERMEMORY__ = _get_param("worker_memory", int)
+__CACHEDIR__ = _get_param("cache_dir", str)
+__CACHEQUOTA__ = _get_param("cache_quota", int)
@@ -0,0 +1,380 @@
+"""CPU Richardson-Lucy deconvolution backend.
+
+Mirrors the libcudaDeconv/cudaDeconv processing chain (background subtraction,
+deskew, edge apodization, accelerated Richardson-Lucy) using real-to-complex
+FFTs, so that machines without a CUDA-capable GPU can deconvolve data with the
+same radially-averaged OTF files returned by :func:`llspy.otf.choose_otf`.
+
+FFT plans and the OTF interpolated onto the FFT grid are cached per stack
+shape, so processing a timeseries only pays the setup cost once.
+"""
+from . import arrayfun
+from . import libcudawrapper as libcu
+from . import util
+from .exceptions import OTFError, ParametersError
+
+import os
+import threading
+import logging
+import collections
+import numpy as np
+from scipy import fft as sfft
+
+logger = logging.getLogger(__name__)
+
+try:
+    import pyfftw
+
+    pyfftw.interfaces.cache.enable()
+    _HAS_FFTW = True
+except ImportError:
+    _HAS_FFTW = False
+
+# cudaDeconv defaults for the PSF used to generate the OTF
+DRPSF = 0.104
+DZPSF = 0.1
+
+# upper bound for the RL correction ratio
+RATIO_LIMIT = 10
+
+_CACHE_SIZE = 8
+_cache_lock = threading.Lock()
+_plan_cache = collections.OrderedDict()
+_otf_cache = collections.OrderedDict()
+
+
+def _cache_get(cache, key, factory):
+    with _cache_lock:
+        if key in cache:
+            cache.move_to_end(key)
+            return cache[key]
+    value = factory()
+    with _cache_lock:
+        cache[key] = value
+        while len(cache) > _CACHE_SIZE:
+            cache.popitem(last=False)
+    return value
+
+
+def default_threads():
+    return os.cpu_count() or 1
+
+
+def use_cpu_backend(backend="auto"):
+    """Return True if deconvolution should run on the CPU for ``backend``
+    {auto, cuda, cpu}.  'auto' chooses the CPU when libcudaDeconv is missing."""
+    if backend == "cpu":
+        return True
+    if backend == "cuda":
+        return False
+    return not libcu.cudaLib
+
+
+class FFTPlan(object):
+    """Forward/inverse real FFT pair for a fixed 3D shape.
+
+    Uses FFTW (via pyfftw) when it is installed, otherwise scipy's pocketfft,
+    in both cases multithreaded.
+    """
+
+    def __init__(self, shape, threads=None):
+        self.shape = tuple(shape)
+        self.threads = threads or default_threads()
+        if _HAS_FFTW:
+            a = pyfftw.empty_aligned(self.shape, dtype="float32")
+            self._fwd = pyfftw.builders.rfftn(
+                a, threads=self.threads, planner_effort="FFTW_MEASURE"
+            )
+            b = pyfftw.empty_aligned(self._fwd.output_shape, dtype="complex64")
+            self._inv = pyfftw.builders.irfftn(
+                b, s=self.shape, threads=self.threads, planner_effort="FFTW_MEASURE"
+            )
+
+    def rfftn(self, arr):
+        if _HAS_FFTW:
+            return self._fwd(arr).copy()
+        return sfft.rfftn(arr, workers=self.threads)
+
+    def irfftn(self, arr):
+        if _HAS_FFTW:
+            return self._inv(arr).copy()
+        return sfft.irfftn(arr, s=self.shape, workers=self.threads)
+
+
+def get_plan(shape, threads=None):
+    threads = threads or default_threads()
+    return _cache_get(
+        _plan_cache, (tuple(shape), threads), lambda: FFTPlan(shape, threads)
+    )
+
+
+def read_otf(otfpath):
+    """Read a radially averaged OTF file written by radialft.
+
+    The file has one row per kr and stores complex kz values interleaved along
+    each row, i.e. shape (nr_otf, 2 * nz_otf).  Returns complex64 array
+    (nz_otf, nr_otf).
+    """
+    raw = util.imread(str(otfpath)).astype(np.float32)
+    if raw.ndim != 2 or raw.shape[1] % 2:
+        raise OTFError("Not a valid radially-averaged OTF file: {}".format(otfpath))
+    otf = raw[:, 0::2] + 1j * raw[:, 1::2]
+    return np.ascontiguousarray(otf.T, dtype=np.complex64)
+
+
+def interpolate_otf(otf, shape, dz, dr, dzpsf=DZPSF, drpsf=DRPSF):
+    """Interpolate a radially averaged OTF onto the rfftn grid of ``shape``.
+
+    Follows the bilinear interpolation used by cudaDeconv, wrapping in kz and
+    zeroing frequencies outside of the OTF support.
+    """
+    nz, ny, nx = shape
+    nz_otf, nr_otf = otf.shape
+    dkr_otf = 1 / ((nr_otf - 1) * 2 * drpsf)
+    dkz_otf = 1 / (nz_otf * dzpsf)
+
+    kx = np.arange(nx // 2 + 1) / (nx * dr)
+    ky = np.fft.fftfreq(ny) * ny / (ny * dr)
+    kr = np.sqrt(kx[np.newaxis, :] ** 2 + ky[:, np.newaxis] ** 2) / dkr_otf
+    inside = kr < nr_otf - 1
+    ir = np.minimum(np.floor(kr).astype(int), nr_otf - 2)
+    ar = (kr - ir).astype(np.float32)
+
+    result = np.zeros((nz, ny, nx // 2 + 1), dtype=np.complex64)
+    kzs = np.fft.fftfreq(nz) * nz / (nz * dz) / dkz_otf
+    for z, kz in enumerate(kzs):
+        if kz < 0:
+            kz += nz_otf
+        if not 0 <= kz < nz_otf:
+            continue
+        iz = int(np.floor(kz))
+        az = kz - iz
+        iz2 = (iz + 1) % nz_otf
+        lower = (1 - ar) * otf[iz, ir] + ar * otf[iz, ir + 1]
+        upper = (1 - ar) * otf[iz2, ir] + ar * otf[iz2, ir + 1]
+        result[z] = np.where(inside, (1 - az) * lower + az * upper, 0)
+
+    dc = np.abs(result[0, 0, 0])
+    if dc > 0:
+        result /= dc
+    return result
+
+
+def get_otf(otfpath, shape, dz, dr, dzpsf=DZPSF, drpsf=DRPSF):
+    """Cached version of interpolate_otf, keyed on file, shape and spacing."""
+    if otfpath is None or not os.path.isfile(str(otfpath)):
+        raise OTFError("OTF file not found: {}".format(otfpath))
+    otfpath = str(otfpath)
+    key = (otfpath, os.path.getmtime(otfpath), tuple(shape), dz, dr, dzpsf, drpsf)
+    return _cache_get(
+        _otf_cache,
+        key,
+        lambda: interpolate_otf(read_otf(otfpath), shape, dz, dr, dzpsf, drpsf),
+    )
+
+
+def apodize(im, napodize):
+    """Soften XY edges so that the stack is periodic, as done by cudaDeconv."""
+    if not napodize:
+        return im
+    nz, ny, nx = im.shape
+    napodize = min(napodize, nx // 2, ny // 2)
+    fact = 1 - np.sin((np.arange(napodize) + 0.5) / napodize * np.pi / 2)
+    fact = fact.astype(np.float32)
+    diff = (im[:, :, -1] - im[:, :, 0]) / 2
+    im[:, :, :napodize] += diff[:, :, np.newaxis] * fact
+    im[:, :, nx - napodize :] -= diff[:, :, np.newaxis] * fact[::-1]
+    diff = (im[:, -1, :] - im[:, 0, :]) / 2
+    im[:, :napodize, :] += diff[:, np.newaxis, :] * fact[:, np.newaxis]
+    im[:, ny - napodize :, :] -= diff[:, np.newaxis, :] * fact[::-1, np.newaxis]
+    return im
+
+
+def richardson_lucy(im, otf, nIters=10, plan=None, flatStart=False):
+    """Accelerated (Biggs & Andrews) Richardson-Lucy deconvolution.
+
+    Args:
+        im (np.ndarray): float32 ZYX volume, already background subtracted
+        otf (np.ndarray): complex OTF on the rfftn grid of ``im``
+        nIters (int): number of iterations
+        plan (FFTPlan): optional FFT plan for im.shape
+    """
+    if plan is None:
+        plan = get_plan(im.shape)
+    otf_conj = np.conj(otf)
+    eps = np.float32(1e-6)
+
+    if flatStart:
+        X_k = np.full_like(im, np.median(im))
+    else:
+        X_k = im.copy()
+    X_km1 = X_k
+    G_km1 = None
+    lam = 0.0
+    for k in range(nIters):
+        if k > 1 and lam > 0:
+            Y = X_k + np.float32(lam) * (X_k - X_km1)
+            np.maximum(Y, 0, out=Y)
+        else:
+            Y = X_k
+        reblurred = plan.irfftn(plan.rfftn(Y) * otf)
+        np.maximum(reblurred, eps, out=reblurred)
+        ratio = im / reblurred
+        # like cudaDeconv, limit the ratio to keep negative PSF lobes from
+        # blowing up the estimate
+        np.minimum(ratio, RATIO_LIMIT, out=ratio)
+        X_kp1 = Y * plan.irfftn(plan.rfftn(ratio) * otf_conj)
+        np.maximum(X_kp1, 0, out=X_kp1)
+        G_kp1 = X_kp1 - Y
+        if G_km1 is not None:
+            denom = float(np.vdot(G_km1, G_km1))
+            lam = float(np.vdot(G_kp1, G_km1)) / denom if denom else 0.0
+            lam = min(max(lam, 0.0), 1.0)
+        X_km1, X_k, G_km1 = X_k, X_kp1, G_kp1
+    return X_k.astype(np.float32, copy=False)
+
+
+def decon(
+    im,
+    otfpath,
+    drdata=0.104,
+    dzdata=0.5,
+    deskew=0,
+    nIters=10,
+    background=0,
+    width=0,
+    shift=0,
+    padVal=0.0,
+    napodize=15,
+    drpsf=DRPSF,
+    dzpsf=DZPSF,
+    rotate=0,
+    savedeskew=False,
+    flatStart=False,
+    threads=None,
+    **kwargs
+):
+    """Deskew and deconvolve ``im`` on the CPU.
+
+    Accepts the same keyword arguments as :func:`llspy.libcudawrapper.quickDecon`
+    and returns a float32 array (or a (decon, deskewed) tuple when savedeskew).
+    Rotation is not implemented and raises a ParametersError.
+    """
+    if rotate:
+        raise ParametersError("Rotation is not supported by the CPU backend")
+    im = np.asarray(im, dtype=np.float32) - np.float32(background)
+    np.maximum(im, 0, out=im)
+    if deskew:
+        im = arrayfun.deskew_cpu(im, dzdata, drdata, deskew, width, shift, padVal)
+        dz = dzdata * abs(np.sin(deskew * np.pi / 180))
+    else:
+        dz = dzdata
+    deskewed = im.copy() if savedeskew else None
+
+    if nIters > 0:
+        plan = get_plan(im.shape, threads)
+        otf = get_otf(otfpath, im.shape, dz, drdata, dzpsf, drpsf)
+        im = richardson_lucy(apodize(im, napodize), otf, nIters, plan, flatStart)
+
+    if savedeskew:
+        return im, deskewed
+    return im
+
+
+def _write_outputs(im, outdir, basename, suffix, MIP, uint16, dx, dz):
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    if uint16:
+        im = np.clip(im, 0, 65535).astype(np.uint16)
+    util.imsave(im, os.path.join(outdir, basename + suffix + ".tif"), dx=dx, dz=dz)
+    if any(MIP):
+        mipdir = os.path.join(outdir, "MIPs")
+        if not os.path.isdir(mipdir):
+            os.makedirs(mipdir)
+        for axis, (doit, ax) in enumerate(zip(MIP, "xyz")):
+            if doit:
+                mip = im.max(axis=2 - axis)
+                util.imsave(
+                    mip, os.path.join(mipdir, "{}_MIP_{}.tif".format(basename, ax))
+                )
+
+
+def process_files(files, otfpath, outdir, dzFinal=None, **opts):
+    """Process a list of raw stacks, writing results like cudaDeconv does.
+
+    Deconvolved stacks go to ``outdir/GPUdecon`` (and MIPs to GPUdecon/MIPs),
+    raw deskewed stacks to ``outdir/Deskewed`` so that downstream steps such as
+    :func:`llspy.llsdir.mergemips` work unchanged.
+    """
+    nIters = opts.get("nIters", 10)
+    saveDeskewedRaw = opts.pop("saveDeskewedRaw", False)
+    MIP = opts.pop("MIP", (0, 0, 1))
+    rMIP = opts.pop("rMIP", (0, 0, 0))
+    uint16 = opts.pop("uint16", True)
+    uint16raw = opts.pop("uint16raw", True)
+    dx = opts.get("drdata", 1)
+    if dzFinal is None:
+        dzFinal = opts.get("dzdata", 1)
+
+    for fname in files:
+        basename = os.path.splitext(os.path.basename(fname))[0]
+        out = decon(util.imread(fname), otfpath, savedeskew=saveDeskewedRaw, **opts)
+        if saveDeskewedRaw:
+            out, deskewed = out
+            _write_outputs(
+                deskewed,
+                os.path.join(outdir, "Deskewed"),
+                basename,
+                "_deskewed",
+                rMIP,
+                uint16raw,
+                dx,
+                dzFinal,
+            )
+        if nIters > 0:
+            _write_outputs(
+                out,
+                os.path.join(outdir, "GPUdecon"),
+                basename,
+                "_decon",
+                MIP,
+                uint16,
+                dx,
+                dzFinal,
+            )
+        logger.info("CPU decon: {}".format(os.path.basename(fname)))
+
+
+if __name__ == "__main__":
+    import sys
+    import time
+
+    otfpath = (
+        sys.argv[1]
+        if len(sys.argv) > 1
+        else os.path.join(
+            os.path.dirname(__file__), "..", "tests", "testdata", "otfs", "488_otf.tif"
+        )
+    )
+    threads = default_threads()
+    backend = "FFTW" if _HAS_FFTW else "scipy"
+    print("FFT backend: {}, threads: {}".format(backend, threads))
+    row_format = "{:>16}{:>12}{:>12}{:>20}"
+    print(row_format.format("shape", "setup (s)", "decon (s)", "Mvox*iter/s/core"))
+    for shape in [(32, 128, 128), (64, 256, 256), (100, 256, 512), (128, 512, 512)]:
+        im = (np.random.poisson(100, shape)).astype(np.float32)
+        t0 = time.time()
+        get_plan(shape, threads)
+        get_otf(otfpath, shape, 0.3, 0.104)
+        t1 = time.time()
+        decon(im, otfpath, dzdata=0.3, nIters=10, threads=threads)
+        t2 = time.time()
+        rate = im.size * 10 / (t2 - t1) / 1e6 / threads
+        print(
+            row_format.format(
+                "x".join(str(s) for s in shape),
+                "{:.2f}".format(t1 - t0),
+                "{:.2f}".format(t2 - t1),
+                "{:.2f}".format(rate),
+            )
+        )
@@ -195,7 +195,7 @@ class CUDAbin(object):
     Wrapper class for Lin Shao's cudaDeconv binary
     """
 
-    def __init__(self, binPath=None):
+    def __init__(self, binPath=None, device=None):
         """
         Init the class by optionally giving it a path to an cudaDeconv executable.
         Otherwise, the class assumes cudaDeconv is the environment PATH variable
@@ -203,6 +203,7 @@ class CUDAbin(object):
         The _self_test function is called to verify cudaDeconv.
 
         binPath -- Path to cudaDeconv executable
+        device -- index of the GPU that process() runs on (default: any)
 
         Throws CUDAbinException:
             If cudaDeconv is not found in PATH or on the file system
@@ -213,6 +214,7 @@ class CUDAbin(object):
         """
         if binPath is None:
             binPath = get_bundled_binary()
+        self.device = device
 
         tmpPath = binPath
         if not os.path.isabs(binPath):
@@ -276,7 +278,10 @@ class CUDAbin(object):
         options["filename-pattern"] = filepattern
         cmd.extend(self.assemble_args(**options))
         logger.info("CUDAbin Process:\n" + " ".join(cmd))
-        return self._run_command(cmd, mode="call")
+        env = None
+        if self.device is not None:
+            env = dict(os.environ, CUDA_VISIBLE_DEVICES=str(self.device))
+        return self._run_command(cmd, mode="call", env=env)
 
     def list_gpus(self):
         return self.run("-Q")
@@ -307,7 +312,7 @@ class CUDAbin(object):
         )
         return o
 
-    def _run_command(self, cmd, mode="check"):
+    def _run_command(self, cmd, mode="check", env=None):
         """
         Execute an cudaDeconv command via the subprocess module.
         If the process exits with a exit status of zero, the output is
@@ -316,9 +321,9 @@ class CUDAbin(object):
         """
         try:
             if mode == "call":
-                subprocess.call(cmd, stderr=subprocess.STDOUT)
+                subprocess.call(cmd, stderr=subprocess.STDOUT, env=env)
             else:
-                output = subprocess.check_output(cmd, stderr=subprocess.STDOUT)
+                output = subprocess.check_output(cmd, stderr=subprocess.STDOUT, env=env)
                 return CUDAbinResult(0, output)
         except subprocess.CalledProcessError as e:
             raise CUDAProcessError(e.cmd, e.returncode, e.output)
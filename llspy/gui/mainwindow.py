@@ -464,6 +464,9 @@ class ActiveWatcher(QtCore.QObject):
         self.tQueue = []
         self.allReceived = False
         self.worker = None
+        self.zarr = None  # store that timepoints are appended to
+        # stacks are written in the background, so the GUI does not block
+        self.writer = llspy.util.AsyncWriter()
 
         try:
             app = QtCore.QCoreApplication.instance()
@@ -559,14 +562,29 @@ class ActiveWatcher(QtCore.QObject):
                 self.E.path.joinpath(outfolder).mkdir()
 
             corstring = "_COR" if self.opts["correctFlash"] else ""
+            s = llspy.util.reorderstack(np.squeeze(s), "zyx")
+            if self.opts.get("outputFormat") == "zarr":
+                if self.zarr is None:
+                    basename = llspy.parse.parse_filename(
+                        self.E.get_files(c=c, t=t)[0], "basename"
+                    )
+                    filename = basename + corstring + proctype + ".zarr"
+                    self.zarr = llspy.zarrstore.ZarrWriter(
+                        str(self.E.path.joinpath(outfolder, filename)),
+                        self.E.parameters.nc,
+                        s.shape,
+                        s.dtype,
+                        dx=self.E.parameters.dx,
+                        dz=self.E.parameters.dzFinal,
+                    )
+                # the T axis grows as timepoints arrive
+                self.writer.submit(self.zarr.write, t, c, s)
+                return
             basename = os.path.basename(self.E.get_files(c=c, t=t)[0])
             filename = basename.replace(".tif", corstring + proctype + ".tif")
             outpath = str(self.E.path.joinpath(outfolder, filename))
-            llspy.util.imsave(
-                llspy.util.reorderstack(np.squeeze(s), "zyx"),
-                outpath,
-                dx=self.E.parameters.dx,
-                dz=self.E.parameters.dzFinal,
+            self.writer.save(
+                s, outpath, dx=self.E.parameters.dx, dz=self.E.parameters.dzFinal
             )
 
         if stack.ndim == 5:
@@ -600,6 +618,11 @@ class ActiveWatcher(QtCore.QObject):
         logger.debug("TERMINATING WATCHER")
         self.observer.stop()
         self.observer.join()
+        try:
+            # wait for the last stacks to be written
+            self.writer.close()
+        except Exception as e:
+            logger.error("Error writing processed stacks: {}".format(e))
         self.finished.emit()
 
 
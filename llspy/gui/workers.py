@@ -279,8 +279,12 @@ class CompressionWorker(SubprocessWorker):
 #         self.finished.emit()
 
 
-def divide_arg_queue(E, n_gpus, binary):
-    """generate all the channel specific cudaDeconv arguments for this item."""
+def divide_arg_queue(E, n_gpus, binary, todo=None):
+    """generate all the channel specific cudaDeconv arguments for this item.
+
+    Returns a list of (channel, timepoints, arguments).  todo optionally
+    limits the timepoints of each channel, see :meth:`Journal.pending`.
+    """
     argQueue = []
 
     def split(a, n):
@@ -289,9 +293,12 @@ def divide_arg_queue(E, n_gpus, binary):
 
     P = E.localParams()
     cudaOpts = P.copy()
-    n_time = len(P.tRange)
 
     for i, chan in enumerate(P.cRange):
+        chanRange = list(P.tRange) if todo is None else todo[chan]
+        n_time = len(chanRange)
+        if not n_time:
+            continue
         # generate channel and gpu specific options
         cudaOpts["input-dir"] = str(E.path)
         cudaOpts["otf-file"] = P.otfs[i]
@@ -303,7 +310,7 @@ def divide_arg_queue(E, n_gpus, binary):
         # then split the work across GPUs by processing each channel,
         # diving time across the available GPUS
         if n_gpus <= n_time:
-            tRanges = list(split(P.tRange, n_gpus))
+            tRanges = list(split(chanRange, n_gpus))
 
             for tRange in tRanges:
                 # filter by channel and trange
@@ -314,15 +321,20 @@ def divide_arg_queue(E, n_gpus, binary):
                         chan, llspy.util.pyrange_to_perlregex(tRange)
                     )
 
-                argQueue.append(binary.assemble_args(**cudaOpts))
+                argQueue.append((chan, tRange, binary.assemble_args(**cudaOpts)))
 
         # if there are more GPUs than timepoints available
         # (e.g. single stack of multiple channels)
         # then if there are enough gpus to cover all channels,
         # divide channels across gpus
         else:
-            cudaOpts["filename-pattern"] = "_ch{}_".format(chan)
-            argQueue.append(binary.assemble_args(**cudaOpts))
+            if n_time == E.parameters.nt:
+                cudaOpts["filename-pattern"] = "_ch{}_".format(chan)
+            else:
+                cudaOpts["filename-pattern"] = "_ch{}.*_stack{}".format(
+                    chan, llspy.util.pyrange_to_perlregex(chanRange)
+                )
+            argQueue.append((chan, chanRange, binary.assemble_args(**cudaOpts)))
 
     return argQueue
 
@@ -360,6 +372,7 @@ class LLSitemWorker(QtCore.QObject):
         self.__argQueue = []  # holds all argument lists that will be sent to threads
         self.GPU_SET = QtCore.QCoreApplication.instance().gpuset
         self.__CUDAthreads = {gpu: None for gpu in self.GPU_SET}
+        self.__CUDAjobs = {}  # gpu: (channel, timepoints) being processed
         if not len(self.GPU_SET):
             self.error.emit()
             raise err.InvalidSettingsError("No GPUs selected. Check Config Tab")
@@ -388,9 +401,16 @@ class LLSitemWorker(QtCore.QObject):
             self.finished.emit()
             raise
 
+        # timepoints that an interrupted run has finished are skipped
+        self.journal = llspy.journal.Journal(self.path)
+        if self.P.reprocess or not self.P.resume:
+            self.journal.clear()
+        self.todo = self.journal.pending(self.P)
+        tRange = sorted(set().union(*self.todo.values()))
+
         # we process one folder at a time. Progress bar updates per Z stack
         # so the maximum is the total number of timepoints * channels
-        self.nFiles = len(self.P.tRange) * len(self.P.cRange)
+        self.nFiles = sum(len(t) for t in self.todo.values())
 
         self._logger.info("#" * 50)
         self._logger.info("Processing {}".format(self.E.basename))
@@ -398,20 +418,21 @@ class LLSitemWorker(QtCore.QObject):
         self._logger.debug("Full path {}".format(self.path))
         self._logger.debug("Parameters {}\n".format(self.E.parameters))
 
-        if self.P.correctFlash:
+        if tRange and self.P.correctFlash:
             try:
                 self.status_update.emit(
                     "Correcting Flash artifact on {}".format(self.E.basename)
                 )
-                self.E.path = self.E.correct_flash(**self.P)
+                self.E.path = self.E.correct_flash(**dict(self.P, tRange=tRange))
             except llspy.llsdir.LLSpyError:
                 self.error.emit()
                 raise
         # if not flash correcting but there is trimming/median filter requested
-        elif self.P.medianFilter or any(
-            [any(i) for i in (self.P.trimX, self.P.trimY, self.P.trimZ)]
+        elif tRange and (
+            self.P.medianFilter
+            or any([any(i) for i in (self.P.trimX, self.P.trimY, self.P.trimZ)])
         ):
-            self.E.path = self.E.median_and_trim(**self.P)
+            self.E.path = self.E.median_and_trim(**dict(self.P, tRange=tRange))
 
         self.nFiles_done = 0
         self.progressValue.emit(0)
@@ -431,9 +452,15 @@ class LLSitemWorker(QtCore.QObject):
                 self.error.emit()
                 raise
 
-            self.__argQueue = divide_arg_queue(self.E, len(self.GPU_SET), binary)
+            self.__argQueue = divide_arg_queue(
+                self.E, len(self.GPU_SET), binary, self.todo
+            )
 
             # with the argQueue populated, we can now start the workers
+            if not len(self.__argQueue) and not tRange:
+                self._logger.info("All stacks already processed: %s" % self.shortname)
+                self.post_process()
+                return
             if not len(self.__argQueue):
                 self._logger.error(
                     "No channel arguments to process in LLSitem: %s" % self.shortname
@@ -464,7 +491,8 @@ class LLSitemWorker(QtCore.QObject):
             #   return
             if not len(self.__argQueue):
                 return
-            args = self.__argQueue.pop(0)
+            chan, tRange, args = self.__argQueue.pop(0)
+            self.__CUDAjobs[gpu] = (chan, tRange)
 
             CUDAworker, thread = newWorkerThread(
                 CudaDeconvWorker,
@@ -515,6 +543,9 @@ class LLSitemWorker(QtCore.QObject):
         thread.quit()
         thread.wait()
         self.__CUDAthreads[worker_id] = None
+        if not self.aborted:
+            chan, tRange = self.__CUDAjobs.pop(worker_id)
+            llspy.llsdir.record_outputs(self.E, self.journal, self.P, chan, tRange)
 
         # FIXME:  this forces all GPUs to be done before ANY can continue
         # ... only as fast as the slowest GPU
@@ -0,0 +1,175 @@
+"""Completion journal for resumable processing.
+
+Whether a folder has been processed used to be judged only by the presence of
+its ProcessingLog, written when processing has finished: an interrupted run
+had to be redone from scratch.  The journal is a JSON-lines file in the
+experiment folder with one entry per finished (channel, timepoint, stage)
+output, appended as soon as the output has been written.  Each entry holds
+the output paths and sizes and a hash of the processing parameters, so a
+rerun only processes timepoints whose outputs are missing, truncated or were
+produced with different parameters.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+
+from . import util
+
+logger = logging.getLogger(__name__)
+
+JOURNAL = "ProcessingJournal.jsonl"
+
+# parameters that do not change the content of per-stack outputs
+_BOOKKEEPING = {
+    "tRange",
+    "cRange",
+    "reprocess",
+    "resume",
+    "verbose",
+    "compressRaw",
+    "compressionType",
+    "writeLog",
+    "keepCorrected",
+    "moveCorrected",
+    "mergeMIPs",
+    "mergeMIPsraw",
+    "streaming",
+    "stageCache",
+}
+
+
+def params_hash(P):
+    """hash of the parameters in P that affect the processed stacks"""
+    params = {k: v for k, v in P.items() if k not in _BOOKKEEPING}
+    text = json.dumps(params, sort_keys=True, cls=util.paramEncoder, default=str)
+    return hashlib.sha1(text.encode()).hexdigest()
+
+
+def output_stages(P):
+    """journal stages of the per-stack outputs that processing with P writes"""
+    stages = []
+    if P["nIters"] > 0:
+        stages.append("decon")
+    if P["saveDeskewedRaw"]:
+        stages.append("deskewed")
+    return stages
+
+
+class Journal(object):
+    """Record of the outputs finished in an experiment folder.
+
+    Outputs are stored relative to the folder.  Outputs written to its
+    Corrected subfolder are still found after :func:`llsdir.move_corrected`
+    has moved them up.  Entries can be recorded from several threads.
+
+    Args:
+        path (str): experiment folder
+    """
+
+    def __init__(self, path):
+        self.path = str(path)
+        self.file = os.path.join(self.path, JOURNAL)
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.load()
+
+    def load(self):
+        """read the journal file, the last entry of each output wins"""
+        self._entries = {}
+        if not os.path.isfile(self.file):
+            return
+        with open(self.file) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # a line cut short by an interrupted run
+                    continue
+                self._entries[(entry["c"], entry["t"], entry["stage"])] = entry
+
+    def clear(self):
+        """forget all entries, e.g. when reprocessing"""
+        with self._lock:
+            self._entries = {}
+            if os.path.isfile(self.file):
+                os.remove(self.file)
+
+    def record(self, c, t, stage, params, outputs):
+        """record that the outputs (paths) of channel c, timepoint t and
+        stage have been written with parameter hash params"""
+        files = []
+        for out in outputs:
+            out = str(out)
+            size = os.path.getsize(out) if os.path.isfile(out) else None
+            files.append([os.path.relpath(out, self.path), size])
+        entry = {"c": c, "t": t, "stage": stage, "params": params, "outputs": files}
+        with self._lock:
+            self._entries[(c, t, stage)] = entry
+            with open(self.file, "a") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def callback(self, c, t, stage, params, outputs):
+        """return a function to call with each written output path, which
+        records the entry once all outputs have been written, for instance
+        as the callback of :meth:`util.AsyncWriter.save`"""
+        remaining = set(str(o) for o in outputs)
+        lock = threading.Lock()
+
+        def written(path):
+            with lock:
+                remaining.discard(str(path))
+                finished = not remaining
+            if finished:
+                self.record(c, t, stage, params, outputs)
+
+        return written
+
+    def _exists(self, relpath, size):
+        paths = [os.path.join(self.path, relpath)]
+        parts = relpath.split(os.sep)
+        if parts[0] == "Corrected":
+            paths.append(os.path.join(self.path, *parts[1:]))
+        for path in paths:
+            if size is None and os.path.exists(path):
+                return True
+            if os.path.isfile(path) and os.path.getsize(path) == size:
+                return True
+        return False
+
+    def outputs(self, c, t, stage):
+        """paths of the recorded outputs of channel c, timepoint t and stage"""
+        entry = self._entries.get((c, t, stage))
+        return (
+            [os.path.join(self.path, p) for p, _ in entry["outputs"]] if entry else []
+        )
+
+    def is_done(self, c, t, stage, params):
+        """True if the outputs were recorded with params and still exist with
+        their recorded size"""
+        entry = self._entries.get((c, t, stage))
+        if entry is None or entry["params"] != params:
+            return False
+        return all(self._exists(p, size) for p, size in entry["outputs"])
+
+    def missing(self, tRange, c, stages, params):
+        """timepoints of tRange that are not done for channel c in all stages"""
+        return [
+            t for t in tRange if not all(self.is_done(c, t, s, params) for s in stages)
+        ]
+
+    def pending(self, P):
+        """return {channel: timepoints} of P.cRange and P.tRange whose outputs
+        are not done (all of them if P writes no per-stack outputs)"""
+        stages = output_stages(P)
+        params = params_hash(P)
+        return {
+            c: (
+                self.missing(P["tRange"], c, stages, params)
+                if stages
+                else list(P["tRange"])
+            )
+            for c in P["cRange"]
+        }
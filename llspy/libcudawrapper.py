@@ -163,9 +163,8 @@ def camcor_init(rawdata_shape, camparams):
 
 def camcor(imstack):
     requireCUDAlib()
-    if not np.issubdtype(imstack.dtype, np.uint16):
-        print("CONVERTING")
-        imstack = imstack.astype(np.uint16)
+    if not np.issubdtype(imstack.dtype, np.uint16) or not imstack.flags["C_CONTIGUOUS"]:
+        imstack = np.ascontiguousarray(imstack, dtype=np.uint16)
     nz, ny, nx = imstack.shape
     result = np.empty_like(imstack)
     camcor_interface(imstack, nx, ny, nz, result)
@@ -176,13 +175,11 @@ def deskewGPU(im, dz=0.5, dr=0.102, angle=31.5, width=0, shift=0, padVal=0.0):
     """Deskew data acquired in stage-scanning mode on GPU"""
     requireCUDAlib()
     nz, ny, nx = im.shape
-    if not np.issubdtype(im.dtype, np.float32):
-        im = im.astype(np.float32)
+    if not np.issubdtype(im.dtype, np.float32) or not im.flags["C_CONTIGUOUS"]:
+        im = np.ascontiguousarray(im, dtype=np.float32)
     # have to calculate this here to know the size of the return array
     if width == 0:
-        deskewedNx = np.int(
-            nx + np.floor(nz * dz * abs(np.cos(angle * np.pi / 180)) / dr)
-        )
+        deskewedNx = int(nx + np.floor(nz * dz * abs(np.cos(angle * np.pi / 180)) / dr))
     else:
         deskewedNx = width
 
@@ -333,8 +330,9 @@ def RL_decon(
     else:
         deskew_result = np.empty(1, dtype=np.float32)
 
-    if not np.issubdtype(im.dtype, np.uint16):
-        im = im.astype(np.uint16)
+    if not np.issubdtype(im.dtype, np.uint16) or not im.flags["C_CONTIGUOUS"]:
+        # e.g. views returned by CameraParameters.correct_stacks
+        im = np.ascontiguousarray(im, dtype=np.uint16)
 
     napodize = 15
     nZblend = 0
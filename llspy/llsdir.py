@@ -1,28 +1,40 @@
+import atexit
+import collections
 import datetime
 import glob
+import hashlib
+import io
 import json
 import logging
 import os
 import pprint
 import re
+import queue
 import shutil
 import sys
+import threading
 import time
 import warnings
 from parse import parse as _parse
-from multiprocessing import Pool, cpu_count
+
+try:
+    from multiprocessing import shared_memory
+except ImportError:  # python < 3.8
+    shared_memory = None
 
 import numpy as np
 import tifffile as tf
 
-from llspy.libcudawrapper import affineGPU, deskewGPU, quickDecon
+from llspy.libcudawrapper import quickDecon
 
 from . import arrayfun, compress, config
 from . import otf as otfmodule
-from . import parse, schema, util
+from . import cpudecon, parse, procpool, schema, util, zarrstore
 from .camera import CameraParameters, selectiveMedianFilter
-from .cudabinwrapper import CUDAbin
-from .exceptions import LLSpyError, OTFError
+from .cudabinwrapper import CUDAbin, CUDAbinException
+from .exceptions import LLSpyError, OTFError, ParametersError
+from .journal import Journal, output_stages, params_hash
+from .stagecache import StageCache, file_identity
 from .settingstxt import LLSsettings
 
 try:
@@ -85,6 +97,24 @@ if sys.platform.startswith("win"):
 
 __FPATTERN__ = "{basename}_ch{channel:d}_stack{stack:d}_{wave:d}nm_{reltime:d}msec_{abstime:d}msecAbs{}"
 
+# bump when the content of the LLSdir index changes
+__INDEXVERSION__ = 2
+# parameters detected from the tiff files, that are stored in the index
+__INDEXPARAMS__ = (
+    "interval",
+    "channels",
+    "tset",
+    "nc",
+    "decimated",
+    "duration",
+    "shape",
+    "nz",
+    "ny",
+    "nx",
+)
+# processing output folders, which are not indexed
+__OUTPUTFOLDERS__ = ("Corrected", "GPUdecon", "Deskewed", "CPPdecon")
+
 
 def correctTimepoint(
     fnames,
@@ -95,11 +125,18 @@ def correctTimepoint(
     trimY,
     trimX,
     flashCorrectTarget="cpu",
+    callback=None,
+    writer=None,
 ):
     """accepts a list of filenames (fnames) that represent Z stacks that have
     been acquired in an interleaved manner (i.e. ch1z1,ch2z1,ch1z2,ch2z2...)
+
+    callback, if provided, is called with each output filename once written.
+    With a :class:`util.AsyncWriter` (writer), the channels are queued on its
+    threads and may still be pending on return, otherwise they are written
+    before returning.
     """
-    stacks = [util.imread(f) for f in fnames]
+    stacks = [util.imread_mmap(f) for f in fnames]
     outstacks = camparams.correct_stacks(
         stacks, medianFilter, (trimZ, trimY, trimX), flashCorrectTarget
     )
@@ -108,17 +145,254 @@ def correctTimepoint(
         for f in fnames
     ]
     for n in range(len(outstacks)):
-        util.imsave(util.reorderstack(np.squeeze(outstacks[n]), "zyx"), outnames[n])
+        outstack = util.reorderstack(np.squeeze(outstacks[n]), "zyx")
+        if writer is not None:
+            writer.save(outstack, outnames[n], callback=callback)
+        else:
+            util.imsave(outstack, outnames[n])
+            if callback is not None:
+                callback(outnames[n])
+
+
+# writer threads of a pool worker, started by its first correction task
+_workerWriter = None
+
+
+def _correct_in_worker(*args, **kwargs):
+    """correctTimepoint on the writer threads of this worker process, which
+    are reused by later tasks.  Returns once the stacks are written."""
+    global _workerWriter
+    if _workerWriter is None:
+        _workerWriter = util.AsyncWriter()
+    writer = _workerWriter
+    try:
+        correctTimepoint(*args, writer=writer, **kwargs)
+        writer.flush()
+    except Exception:
+        # the writer would re-raise a failed write in every later task
+        _workerWriter = None
+        try:
+            writer.close()
+        except Exception:
+            pass
+        raise
 
 
 def unwrapper(tup):
-    return correctTimepoint(*tup)
+    return _correct_in_worker(*tup)
+
+
+# (segment, CameraParameters) mapped by a pool worker, by shared memory name,
+# most recently used last.  Several FlashCorrectionPools can be in use at once.
+_flashParams = collections.OrderedDict()
+_MAXFLASHPARAMS = 4
+
+
+def _shared_camparams(shmname, shape, roi):
+    """camera parameters in shared memory, mapped once per worker process"""
+    if shmname not in _flashParams:
+        shm = shared_memory.SharedMemory(name=shmname)
+        data = np.ndarray(shape, np.float32, buffer=shm.buf)
+        # keep the segment open for as long as the worker uses the array
+        _flashParams[shmname] = (shm, CameraParameters(data=data, roi=roi))
+        while len(_flashParams) > _MAXFLASHPARAMS:
+            _flashParams.popitem(last=False)[1][0].close()
+    _flashParams.move_to_end(shmname)
+    return _flashParams[shmname][1]
+
+
+def _correct_shared(run, params, fnames, outpath, medianFilter, trimZ, trimY, trimX):
+    _correct_in_worker(
+        fnames,
+        _shared_camparams(*params),
+        outpath,
+        medianFilter,
+        trimZ,
+        trimY,
+        trimX,
+        callback=lambda name: procpool.report(run),
+    )
+    return len(fnames)
+
+
+class FlashCorrectionPool(object):
+    """Flash correction of many timepoints on the shared process pool.
+
+    The A, B and offset maps of camparams are copied once into shared memory,
+    which the workers of :func:`procpool.get_pool` map on first use, so tasks
+    only carry filenames.  At most maxInFlight timepoints are queued at any
+    time.  A FlashCorrectionPool can be reused for any number of correct()
+    calls with the same camera parameters, see get_flash_pool().
+
+    Use as a context manager, or call close() to release the shared memory.
+    """
+
+    def __init__(self, camparams, maxInFlight=None):
+        if shared_memory is None:
+            raise LLSpyError("FlashCorrectionPool requires python 3.8 or later")
+        self.maxInFlight = maxInFlight or 2 * procpool.pool_size()
+        data = np.ascontiguousarray(camparams.data[:3], np.float32)
+        self.key = self.params_key(data)
+        self._runs = 0
+        self._lock = threading.Lock()
+        self._shm = shared_memory.SharedMemory(create=True, size=data.nbytes)
+        np.ndarray(data.shape, data.dtype, buffer=self._shm.buf)[:] = data
+        self._params = (self._shm.name, data.shape, camparams.roi._data)
+
+    @staticmethod
+    def params_key(data):
+        """identifies the camera parameter maps of a pool"""
+        data = np.ascontiguousarray(data[:3], np.float32)
+        return (hashlib.sha1(data).hexdigest(), data.shape)
+
+    @staticmethod
+    def _poll(progress, timeout):
+        """wait for one progress message of this run, True if one arrived"""
+        try:
+            progress.get(timeout=timeout)
+            return True
+        except queue.Empty:
+            return False
+
+    def correct(
+        self,
+        timegroups,
+        outpath,
+        medianFilter=False,
+        trimZ=(0, 0),
+        trimY=(0, 0),
+        trimX=(0, 0),
+        callback=None,
+    ):
+        """correct a list of timepoints (lists of filenames) into outpath.
+
+        callback, if provided, is called with (stacksDone, stacksTotal) each
+        time a corrected stack has been written.
+        """
+        with self._lock:
+            self._runs += 1
+            # unique between pools: progress messages are routed by run
+            run = (self._shm.name, self._runs)
+        progress = procpool.subscribe(run)
+        try:
+            options = (medianFilter, trimZ, trimY, trimX)
+            return self._correct(run, progress, timegroups, outpath, callback, options)
+        finally:
+            procpool.unsubscribe(run)
+
+    def _correct(self, run, progress, timegroups, outpath, callback, options):
+        total = sum(len(g) for g in timegroups)
+        done = 0
+        groups = iter(timegroups)
+        pending = collections.deque()
+        pool = procpool.get_pool()
+        while True:
+            for group in groups:
+                args = (run, self._params, group, outpath) + options
+                pending.append(pool.apply_async(_correct_shared, args))
+                if len(pending) >= self.maxInFlight:
+                    break
+            while pending and pending[0].ready():
+                # re-raises exceptions from the worker
+                pending.popleft().get()
+            if not pending and done >= total:
+                break
+            # messages of the last stacks may arrive after their results
+            if self._poll(progress, 0.1 if pending else 5):
+                done += 1
+                logger.debug("Flash corrected {}/{} stacks".format(done, total))
+                if callback is not None:
+                    callback(done, total)
+            elif not pending:
+                break
+        return done
+
+    def close(self):
+        self._shm.close()
+        self._shm.unlink()
+
+    def terminate(self):
+        """stop the shared pool, with any timepoints still in flight"""
+        procpool.shutdown(terminate=True)
+        self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            self.terminate()
+
+
+# pools kept alive between correct_flash calls: [pool, users] by params_key
+_flashPools = {}
+_flashPoolLock = threading.Lock()
+
+
+def get_flash_pool(camparams):
+    """return a FlashCorrectionPool for camparams, reusing the pool of the
+    same camera parameters if there is one.
+
+    Every call must be paired with release_flash_pool(pool).  A pool is
+    only closed once no one uses it: when a pool for other parameters is
+    created, or by close_flash_pool().
+    """
+    key = FlashCorrectionPool.params_key(camparams.data)
+    with _flashPoolLock:
+        if key not in _flashPools:
+            _close_idle_flash_pools()
+            _flashPools[key] = [FlashCorrectionPool(camparams), 0]
+        entry = _flashPools[key]
+        entry[1] += 1
+        return entry[0]
+
+
+def release_flash_pool(pool):
+    """mark a pool returned by get_flash_pool as no longer used by the caller,
+    it stays open for reuse"""
+    with _flashPoolLock:
+        entry = _flashPools.get(pool.key)
+        if entry is not None and entry[0] is pool and entry[1] > 0:
+            entry[1] -= 1
+
+
+def _close_idle_flash_pools():
+    for key, (pool, users) in list(_flashPools.items()):
+        if not users:
+            pool.close()
+            del _flashPools[key]
+
+
+@atexit.register
+def close_flash_pool():
+    """release the pools created by get_flash_pool that are not in use"""
+    with _flashPoolLock:
+        _close_idle_flash_pools()
+
+
+# selectiveMedianFilter bad pixel masks of this process, per camera_key()
+_badPixelMasks = {}
+
+
+def camera_key(exp):
+    """identifies the camera and ROI of an LLSdir, None without settings"""
+    if not exp.has_settings:
+        return None
+    cam = exp.settings.camera
+    return (cam.serial, tuple(cam.roi._data))
 
 
-def filter_stack(filename, outname, dx, background, trim, medianFilter):
-    stack = util.imread(filename)
+def _median_filter(stack, background, camera=None):
+    cache = _badPixelMasks.setdefault(camera, {}) if camera else None
+    return selectiveMedianFilter(stack, background, cache=cache)[0]
+
+
+def filter_stack(filename, outname, dx, background, trim, medianFilter, camera=None):
+    stack = util.imread_mmap(filename)
     if medianFilter:
-        stack, _ = selectiveMedianFilter(stack, background)
+        stack = _median_filter(stack, background, camera)
     if any([any(i) for i in trim]):
         stack = arrayfun.trimedges(stack, trim)
     util.imsave(util.reorderstack(np.squeeze(stack), "zyx"), outname, dx=dx, dz=1)
@@ -146,9 +420,82 @@ def move_corrected(path):
                     t += 1
 
 
+# registration objects and the inverse matrices of their transforms, shared by
+# all callers so that fiducials are only read and fitted once per calibration
+_regObjCache = {}
+_regTformCache = {}
+_regCacheLock = threading.RLock()
+
+
+def _calib_mtime(regCalibPath):
+    """modification time of a registration file, or the latest of a fiducial
+    folder and the files in it"""
+    mtime = os.stat(regCalibPath).st_mtime_ns
+    if os.path.isdir(regCalibPath):
+        for entry in os.scandir(regCalibPath):
+            if entry.is_file():
+                mtime = max(mtime, entry.stat().st_mtime_ns)
+    return mtime
+
+
+def _calib_key(regObj):
+    """(path, mtime) of a registration object returned by get_regObj, or None
+    if it does not come from the cache"""
+    path = getattr(regObj, "path", None)
+    if path is None:
+        return None
+    path = os.path.abspath(str(path))
+    try:
+        key = (path, _calib_mtime(path))
+    except OSError:
+        return None
+    with _regCacheLock:
+        return key if _regObjCache.get(key) is regObj else None
+
+
+def clear_registration_cache():
+    """forget cached registration objects and transforms"""
+    with _regCacheLock:
+        _regObjCache.clear()
+        _regTformCache.clear()
+
+
 def get_regObj(regCalibPath):
     """Detect whether provided path is a directory of tiffs with fiducials or
-    a pre-calibrated registration file"""
+    a pre-calibrated registration file
+
+    Registration objects are cached until the file or folder changes.
+    """
+    try:
+        key = (os.path.abspath(regCalibPath), _calib_mtime(regCalibPath))
+    except OSError:
+        key = None
+    with _regCacheLock:
+        if key in _regObjCache:
+            return _regObjCache[key]
+        refObj = _load_regObj(regCalibPath)
+        if key is not None and refObj is not None:
+            _regObjCache[key] = refObj
+        return refObj
+
+
+def registration_tform(regObj, imwave, refwave=488, mode="2step"):
+    """inverse of the transform mapping imwave onto refwave, ready to pass to
+    arrayfun.affine.  Cached for objects returned by get_regObj."""
+    key = _calib_key(regObj)
+    if key is not None:
+        key += (str(mode).lower(), str(imwave), str(refwave))
+        with _regCacheLock:
+            if key in _regTformCache:
+                return _regTformCache[key]
+    inv_tform = np.linalg.inv(regObj.get_tform(imwave, refwave, mode))
+    if key is not None:
+        with _regCacheLock:
+            _regTformCache[key] = inv_tform
+    return inv_tform
+
+
+def _load_regObj(regCalibPath):
     refObj = None
     if os.path.isfile(regCalibPath) and regCalibPath.endswith(
         (".reg", ".txt", ".json")
@@ -189,22 +536,24 @@ def register_folder(
     # get all tiffs in folders
     files = parse.filter_w(os.listdir(folder), regRefWave, exclusive=True)
     files = [f for f in files if (f.endswith(".tif") and "_REG" not in f)]
-    for F in files:
-        fname = os.path.join(folder, F)
-        outname = fname.replace(".tif", "_REG{}.tif".format(regRefWave))
-        imarray = util.imread(fname)
-        imwave = parse.parse_filename(fname, "wave", pattern=__FPATTERN__)
-        im_out = register_image_to_wave(
-            imarray, regObj, imwave, regRefWave, mode=regMode, voxsize=voxsize
-        ).astype(imarray.dtype)
-        util.imsave(
-            util.reorderstack(np.squeeze(im_out), "zyx"),
-            outname,
-            dx=voxsize[2],
-            dz=voxsize[0],
-        )
-        if discard:
-            os.remove(os.path.join(folder, F))
+    files = [os.path.join(folder, f) for f in files]
+    # the next stacks are read, and registered ones written, while the
+    # current one is registered
+    with util.AsyncWriter() as writer:
+        for fname, imarray in util.prefetch(util.imread, files):
+            outname = fname.replace(".tif", "_REG{}.tif".format(regRefWave))
+            imwave = parse.parse_filename(fname, "wave", pattern=__FPATTERN__)
+            im_out = register_image_to_wave(
+                imarray, regObj, imwave, regRefWave, mode=regMode, voxsize=voxsize
+            ).astype(imarray.dtype)
+            writer.save(
+                util.reorderstack(np.squeeze(im_out), "zyx"),
+                outname,
+                # only remove the input once its registered version is written
+                callback=(lambda o, f=fname: os.remove(f)) if discard else None,
+                dx=voxsize[2],
+                dz=voxsize[0],
+            )
 
     # rename refwave files too
     for F in parse.filter_w(os.listdir(folder), regRefWave, exclusive=False):
@@ -245,9 +594,102 @@ def register_image_to_wave(
             "Input to Registration must either be a np.array " "or a path to a tif file"
         )
 
-    tform = regCalibObj.get_tform(imwave, refwave, mode)
-    inv_tform = np.linalg.inv(tform)
-    return affineGPU(img, inv_tform, voxsize)
+    inv_tform = registration_tform(regCalibObj, imwave, refwave, mode)
+    return arrayfun.affine(img, inv_tform, voxsize)
+
+
+def _valid_regObj(regCalibPath):
+    """get_regObj for processing: returns None (and logs) if unusable."""
+    if regCalibPath is None:
+        logger.error("Skipping Registration: no Calibration Object path provided")
+        return None
+    regObj = get_regObj(regCalibPath)
+    if isinstance(regObj, (RegDir, RegFile)) and regObj.isValid:
+        return regObj
+    logger.error("Registration Calibration dir not valid" "{}".format(regCalibPath))
+    return None
+
+
+def correct_stacks(stacks, P, camparams=None, flashCorrectTarget="cpu", camera=None):
+    """Camera correction, median filter, edge trim and background subtraction
+    of the raw stacks of a single timepoint (ordered as P.cRange).
+
+    camera (see camera_key) lets the median filter reuse its bad pixel mask.
+    """
+    trim = (P.trimZ, P.trimY, P.trimX)
+    if P.correctFlash and camparams is not None:
+        return camparams.correct_stacks(
+            stacks,
+            trim=trim,
+            medianFilter=P.medianFilter,
+            flashCorrectTarget=flashCorrectTarget,
+        )
+    if P.medianFilter:
+        stacks = [_median_filter(s, b, camera) for s, b in zip(stacks, P.background)]
+    # camera correction trims edges, so if we aren't doing the camera correction
+    # we need to call the edge trim on our own
+    if any([any(i) for i in trim]):
+        stacks = [arrayfun.trimedges(s, trim) for s in stacks]
+    # camera correction also does background subtraction
+    # so otherwise trigger it manually here
+    return [arrayfun.sub_background(s, b) for s, b in zip(stacks, P.background)]
+
+
+def deconvolve_stacks(stacks, P, savedeskew=False):
+    """Deconvolve (or just deskew and crop) corrected stacks, with libcudaDeconv
+    or the CPU backend according to P.deconBackend.
+
+    Returns a tuple of lists: (processed, deskewed).  deskewed is None unless
+    savedeskew is True and deconvolution was performed.
+    """
+    deskewed = None
+    if P.nIters > 0:
+        # FIXME: background is the only thing keeping this from just **P to deconvolve
+        opts = {
+            "nIters": P.nIters,
+            "drdata": P.drdata,
+            "dzdata": P.dzdata,
+            "deskew": P.deskew,
+            "rotate": P.rotate,
+            "width": P.width,
+            "shift": P.shift,
+            "background": 0,  # zero here because it's already been subtracted above
+        }
+        if cpudecon.use_cpu_backend(P.deconBackend):
+            deconfunc = cpudecon.decon
+            opts["napodize"] = P.napodize
+        else:
+            deconfunc = quickDecon
+        out = [
+            deconfunc(s, o, savedeskew=savedeskew, **opts)
+            for s, o in zip(stacks, P.otfs)
+        ]
+        if savedeskew:
+            out, deskewed = [list(i) for i in zip(*out)]
+        return out, deskewed
+
+    # deconvolution does deskewing and cropping, so we do it here if we're
+    # not deconvolving
+    if P.deskew:
+        stacks = [arrayfun.deskew(s, P.dzdata, P.drdata, P.deskew) for s in stacks]
+    return [arrayfun.cropX(s, P.width, P.shift) for s in stacks], deskewed
+
+
+def register_stacks(stacks, waves, P, regObj, voxsize):
+    """Register all non-reference channels to P.regRefWave."""
+    out = []
+    for stk, wave in zip(stacks, waves):
+        if not wave == P.regRefWave:  # don't reg the reference channel
+            stk = register_image_to_wave(
+                stk,
+                regObj,
+                imwave=wave,
+                refwave=P.regRefWave,
+                mode=P.regMode,
+                voxsize=voxsize,
+            )
+        out.append(stk)
+    return out
 
 
 def preview(exp, tR=0, cR=None, **kwargs):
@@ -271,9 +713,13 @@ def preview(exp, tR=0, cR=None, **kwargs):
     logger.debug("Preview called on {}".format(str(exp.path)))
     logger.debug("Params: {}".format(exp.parameters))
 
-    if exp.is_compressed():
+    if exp.is_compressed() and exp.archive is None:
         try:
-            exp.decompress_partial(tRange=tR)
+            if util.find_filepattern(str(exp.path), "*" + compress.ARCHIVE_EXT):
+                # read the stacks straight from the indexed archive
+                exp.open_archive()
+            else:
+                exp.decompress_partial(tRange=tR)
         except Exception as e:
             logger.error("ERROR: could not do partial decompression...")
             logger.error(str(e))
@@ -295,84 +741,25 @@ def preview(exp, tR=0, cR=None, **kwargs):
         P.correctFlash = False
         logger.warning("Cannot perform Flash Correction without settings.txt file")
 
+    camparams = None
+    if P.correctFlash:
+        camparams = CameraParameters(P.camparamsPath)
+        camparams = camparams.get_subroi(exp.settings.camera.roi)
+
+    regObj = None
+    if P.doReg:
+        regObj = _valid_regObj(P.regCalibPath)
+    voxsize = [exp.parameters.dzFinal, exp.parameters.dx, exp.parameters.dx]
+
     out = []
-    for timepoint in P.tRange:
-        stacks = [util.imread(f) for f in exp.get_files(c=P.cRange, t=timepoint)]
+    for timepoint, _, stacks in exp.iter_timepoints(P.tRange, P.cRange):
         if not stacks:
             continue
         # logger.debug("shape_raw: {}".format(stacks[0].shape))
-        if P.correctFlash:
-            camparams = CameraParameters(P.camparamsPath)
-            camparams = camparams.get_subroi(exp.settings.camera.roi)
-            stacks = camparams.correct_stacks(
-                stacks, trim=(P.trimZ, P.trimY, P.trimX), medianFilter=P.medianFilter
-            )
-        else:
-            # camera correction trims edges, so if we aren't doing the camera correction
-            # we need to call the edge trim on our own
-            if any([any(i) for i in (P.trimZ, P.trimY, P.trimX)]):
-                stacks = [
-                    arrayfun.trimedges(s, (P.trimZ, P.trimY, P.trimX)) for s in stacks
-                ]
-            # camera correction also does background subtraction
-            # so otherwise trigger it manually here
-            stacks = [
-                arrayfun.sub_background(s, b) for s, b in zip(stacks, P.background)
-            ]
-
-        # FIXME: background is the only thing keeping this from just **P to deconvolve
-        if P.nIters > 0:
-            opts = {
-                "nIters": P.nIters,
-                "drdata": P.drdata,
-                "dzdata": P.dzdata,
-                "deskew": P.deskew,
-                "rotate": P.rotate,
-                "width": P.width,
-                "shift": P.shift,
-                "background": 0,  # zero here because it's already been subtracted above
-            }
-            for i, d in enumerate(zip(stacks, P.otfs)):
-                stk, otf = d
-                stacks[i] = quickDecon(stk, otf, **opts)
-        else:
-            # deconvolution does deskewing and cropping, so we do it here if we're
-            #
-            if P.deskew:
-                stacks = [deskewGPU(s, P.dzdata, P.drdata, P.deskew) for s in stacks]
-            stacks = [arrayfun.cropX(s, P.width, P.shift) for s in stacks]
-
-        # FIXME: this is going to be slow until we cache the tform Matrix results
-        if P.doReg:
-            if P.regCalibPath is None:
-                logger.error(
-                    "Skipping Registration: no Calibration Object path provided"
-                )
-            else:
-                refObj = get_regObj(P.regCalibPath)
-                if isinstance(refObj, (RegDir, RegFile)) and refObj.isValid:
-                    voxsize = [
-                        exp.parameters.dzFinal,
-                        exp.parameters.dx,
-                        exp.parameters.dx,
-                    ]
-                    for i, d in enumerate(zip(stacks, P.wavelength)):
-                        stk, wave = d
-                        if not wave == P.regRefWave:  # don't reg the reference channel
-                            stacks[i] = register_image_to_wave(
-                                stk,
-                                refObj,
-                                imwave=wave,
-                                refwave=P.regRefWave,
-                                mode=P.regMode,
-                                voxsize=voxsize,
-                            )
-                else:
-                    logger.error(
-                        "Registration Calibration dir not valid"
-                        "{}".format(P.regCalibPath)
-                    )
-
+        stacks = correct_stacks(stacks, P, camparams, camera=camera_key(exp))
+        stacks, _ = deconvolve_stacks(stacks, P)
+        if regObj is not None:
+            stacks = register_stacks(stacks, P.wavelength, P, regObj, voxsize)
         out.append(np.stack(stacks, 0))
 
     if out:
@@ -384,6 +771,275 @@ def preview(exp, tR=0, cR=None, **kwargs):
         return None
 
 
+def _write_store(store, t, c, volume, callback=None):
+    store.write(t, c, volume)
+    if callback is not None:
+        callback(store.path)
+
+
+def process_stream(exp, P, prefetch=2, nwriters=2, journal=None):
+    """Process LLS experiment one timepoint at a time, entirely in memory.
+
+    Every timepoint is read once, then corrected, trimmed, deskewed/deconvolved,
+    registered and MIP'd before the results are written, so disk traffic per
+    stack is one read and one write (no Corrected folder, no separate
+    registration or MIP merge passes).  Upcoming timepoints are read and
+    finished ones written on background threads through bounded queues.
+
+    Output file names match those of the staged :func:`process` pipeline.
+    With ``outputFormat='zarr'``, stacks are written into one chunked TCZYX
+    store per output folder instead of individual tiffs.  Rotation and bleach correction are not supported, and at least one of
+    deconvolution or saveDeskewedRaw is required: a ParametersError is raised
+    otherwise.
+
+    Args:
+        exp (LLSdir): experiment to process
+        P (dict): validated parameters from :meth:`LLSdir.localParams`
+        prefetch (int): number of timepoints to read ahead
+        nwriters (int): number of writer threads
+        journal (Journal): if provided, timepoints it records as done are
+            skipped, and finished outputs are recorded in it
+    """
+    unsupported = [k for k in ("rotate", "bleachCorrection") if P.get(k)]
+    if unsupported:
+        raise ParametersError(
+            "Streaming mode does not support: {}".format(", ".join(unsupported))
+        )
+    if not (P.nIters > 0 or P.saveDeskewedRaw):
+        raise ParametersError(
+            "Streaming mode requires deconvolution (nIters > 0) or saveDeskewedRaw"
+        )
+
+    camparams = None
+    flashTarget = "cpu"
+    if P.correctFlash:
+        if not exp.has_settings:
+            raise LLSpyError("Cannot correct Flash pixels without settings.txt file")
+        camparams = CameraParameters(P.camparamsPath)
+        if not np.all(camparams.roi == exp.settings.camera.roi):
+            camparams = camparams.get_subroi(exp.settings.camera.roi)
+        if P.flashCorrectTarget in ("cuda", "gpu"):
+            flashTarget = "cuda"
+            camparams.init_CUDAcamcor(
+                (
+                    exp.parameters.nz * exp.parameters.nc,
+                    exp.parameters.ny,
+                    exp.parameters.nx,
+                )
+            )
+
+    regObj = _valid_regObj(P.regCalibPath) if P.doReg else None
+    camera = camera_key(exp)
+    dx = exp.parameters.dx
+    dz = exp.parameters.dzFinal
+    voxsize = [dz, dx, dx]
+    cor = "_COR" if (P.correctFlash or P.medianFilter) else ""
+    reg = "_REG{}".format(P.regRefWave) if regObj is not None else ""
+
+    # (subfolder, suffix, MIP axes, uint16, save stacks)
+    if P.nIters > 0:
+        outputs = [("GPUdecon", "_decon", P.MIP, P.uint16, P.saveDecon)]
+        if P.saveDeskewedRaw:
+            outputs.append(("Deskewed", "_deskewed", P.rMIP, P.uint16raw, True))
+    else:
+        outputs = [("Deskewed", "_deskewed", P.rMIP, P.uint16raw, True)]
+    for folder, _, MIP, _, _ in outputs:
+        mipdir = exp.path.joinpath(folder, "MIPs")
+        if not mipdir.is_dir() and any(MIP):
+            mipdir.mkdir(parents=True)
+        elif not exp.path.joinpath(folder).is_dir():
+            exp.path.joinpath(folder).mkdir()
+
+    done = set()
+    if journal is not None:
+        phash = params_hash(P)
+        done = set(P.tRange).difference(*journal.pending(P).values())
+        if P.mergeMIPs and any(
+            any(MIP) and not (save and P.outputFormat == "tiff")
+            for _, _, MIP, _, save in outputs
+        ):
+            # merged MIPs of skipped timepoints are read from their stacks
+            done = set()
+        if done:
+            logger.info("Skipping {} finished timepoints".format(len(done)))
+
+    # stores for outputFormat == 'zarr', created with the first result
+    stores = {}
+    nt = max(P.tRange) + 1
+
+    def get_store(folder, suffix, im):
+        if folder not in stores:
+            basename = parse.parse_filename(
+                chanfiles[0], "basename", pattern=exp.fname_pattern
+            )
+            outname = "{}{}{}{}.zarr".format(basename, cor, suffix, reg)
+            stores[folder] = zarrstore.ZarrWriter(
+                str(exp.path.joinpath(folder, outname)),
+                len(chanfiles),
+                im.shape,
+                im.dtype,
+                nt=nt,
+                dx=dx,
+                dz=dz,
+                dt=exp.parameters.interval[0] if exp.parameters.interval else 1,
+            )
+        return stores[folder]
+
+    cache = None
+    if P.stageCache:
+        cache = StageCache()
+        # parameters of the correction and of the deskew/decon stages
+        corrParams = [camera, P.correctFlash, P.medianFilter, P.trimZ, P.trimY, P.trimX]
+        if P.correctFlash:
+            corrParams.append(file_identity(P.camparamsPath))
+        useCPU = cpudecon.use_cpu_backend(P.deconBackend)
+        procParams = [P.nIters, P.drdata, P.dzdata, P.deskew, P.rotate, P.width]
+        procParams += [P.shift, P.saveDeskewedRaw, useCPU, useCPU and P.napodize]
+
+    def cached(keys, compute):
+        """the arrays cached under keys, or those returned by compute()"""
+        if keys is not None:
+            arrays = cache.get_all(keys)
+            if arrays is not None:
+                return arrays
+        arrays = compute()
+        if keys is not None:
+            cache.put_all(keys, arrays)
+        return arrays
+
+    # (folder, axis): [(t, c, plane)], sorted when the merged MIPs are written
+    mips = {}
+    if P.mergeMIPs:
+        for t in sorted(done):
+            for folder, suffix, MIP, _, _ in outputs:
+                if not any(MIP):
+                    continue
+                for c, chan in enumerate(P.cRange):
+                    im = util.imread(journal.outputs(chan, t, suffix[1:])[0])
+                    for axis, (doit, ax) in enumerate(zip(MIP, "xyz")):
+                        if doit:
+                            mip = im.max(axis=2 - axis)
+                            mips.setdefault((folder, ax), []).append((t, c, mip))
+
+    tRange = [t for t in P.tRange if t not in done]
+    with util.AsyncWriter(nthreads=max(nwriters, 1)) as writer:
+        # flash correction needs every interleaved channel of the timepoint
+        cRange = None if P.correctFlash else P.cRange
+        for t, files, stacks in exp.iter_timepoints(tRange, cRange, prefetch):
+            chanfiles = parse.filter_c(files, P.cRange)
+            if len(chanfiles) != len(list(P.cRange)):
+                logger.warning("Skipping incomplete timepoint {}".format(t))
+                continue
+
+            def correct():
+                if P.correctFlash:
+                    out = correct_stacks(stacks, P, camparams, flashTarget)
+                    return [out[files.index(f)] for f in chanfiles]
+                return correct_stacks(stacks, P, camera=camera)
+
+            def deconvolve():
+                corrected = cached(ckeys, correct)
+                out = deconvolve_stacks(corrected, P, savedeskew=P.saveDeskewedRaw)
+                return [im for result in out[: len(outputs)] for im in result]
+
+            # keys of the corrected stacks, and of the processed stacks by output
+            ckeys = pkeys = None
+            if cache is not None:
+                ckeys, pkeys = [], []
+                for i, fname in enumerate(chanfiles):
+                    ident = exp.stack_identity(fname)
+                    ckeys.append(cache.key(ident, corrParams, P.background[i]))
+                for _, suffix, _, _, _ in outputs:
+                    for i, ckey in enumerate(ckeys):
+                        otf = P.otfs[i] if P.nIters > 0 else None
+                        otf = file_identity(otf) if otf else None
+                        pkeys.append(cache.key(suffix, ckey, procParams, otf))
+            processed = cached(pkeys, deconvolve)
+            n = len(chanfiles)
+            results = [processed[i : i + n] for i in range(0, len(processed), n)]
+
+            for (folder, suffix, MIP, uint16, save), result in zip(outputs, results):
+                if regObj is not None:
+                    result = register_stacks(result, P.wavelength, P, regObj, voxsize)
+                for c, (fname, im) in enumerate(zip(chanfiles, result)):
+                    base = os.path.basename(fname).replace(".tif", cor)
+                    if uint16:
+                        im = np.clip(im, 0, 65535).astype(np.uint16)
+                    # (array, path, imsave kwargs) of the tiffs of this stack
+                    tiffs = []
+                    if save and P.outputFormat == "tiff":
+                        outname = "{}{}{}.tif".format(base, suffix, reg)
+                        outpath = str(exp.path.joinpath(folder, outname))
+                        tiffs.append((im, outpath, {"dx": dx, "dz": dz}))
+                    for axis, (doit, ax) in enumerate(zip(MIP, "xyz")):
+                        if not doit:
+                            continue
+                        mip = im.max(axis=2 - axis)
+                        if P.mergeMIPs:
+                            mips.setdefault((folder, ax), []).append((t, c, mip))
+                        else:
+                            outname = "{}_MIP_{}.tif".format(base, ax)
+                            outpath = str(exp.path.joinpath(folder, "MIPs", outname))
+                            tiffs.append((mip, outpath, {}))
+                    store = None
+                    outpaths = [path for _, path, _ in tiffs]
+                    if save and P.outputFormat == "zarr":
+                        store = get_store(folder, suffix, im)
+                        outpaths.append(store.path)
+
+                    # the journal entry is recorded once all outputs are written
+                    callback = None
+                    if journal is not None and outpaths:
+                        callback = journal.callback(
+                            P.cRange[c], t, suffix[1:], phash, outpaths
+                        )
+                    elif journal is not None:
+                        journal.record(P.cRange[c], t, suffix[1:], phash, [])
+                    if store is not None:
+                        writer.submit(_write_store, store, t, c, im, callback)
+                    for arr, outpath, kwargs in tiffs:
+                        writer.save(arr, outpath, callback=callback, **kwargs)
+            logger.info("Streamed timepoint {}".format(t))
+    if cache is not None:
+        logger.info("Stage cache: {} hits, {} misses".format(cache.hits, cache.misses))
+
+    # merged MIPs are assembled in memory and written in the same
+    # format as mergemips(): TZCYX
+    try:
+        interval = exp.parameters.interval[0]
+    except IndexError:
+        interval = 0
+    nc = len(list(P.cRange))
+    if mips:
+        basename = parse.parse_filename(
+            exp.get_files(c=P.cRange)[0], "basename", pattern=exp.fname_pattern
+        )
+    for (folder, ax), planes in mips.items():
+        planes = [mip for _, _, mip in sorted(planes, key=lambda p: p[:2])]
+        stack = np.stack(planes).reshape((-1, 1, nc) + planes[0].shape)
+        miptype = "_decon_" if folder == "GPUdecon" else "_deskewed_"
+        outname = basename + cor + miptype + "comboMIP_" + ax + ".tif"
+        outpath = str(exp.path.joinpath(folder, "MIPs", outname))
+        util.imsave(stack, outpath, dx=dx, dt=interval)
+
+
+def record_outputs(exp, journal, P, chan, tRange):
+    """record the deskewed/deconvolved stacks that the staged pipeline wrote
+    for channel chan and timepoints tRange in the completion journal"""
+    folders = {"decon": "GPUdecon", "deskewed": "Deskewed"}
+    stages = output_stages(P)
+    params = params_hash(P)
+    # exp.path may point to the "Corrected" folder
+    tiffs = [str(f) for f in sorted(exp.path.glob("*.tif"))]
+    for fname in parse.filter_files(tiffs, c=chan, t=tRange):
+        base = os.path.splitext(os.path.basename(fname))[0]
+        t = parse.parse_filename(fname, "stack")
+        for stage in stages:
+            out = exp.path.joinpath(folders[stage], "{}_{}.tif".format(base, stage))
+            if out.is_file():
+                journal.record(chan, t, stage, params, [str(out)])
+
+
 def process(exp, binary=None, **kwargs):
     """Process LLS experiment with cudaDeconv, output results to file.
 
@@ -404,8 +1060,15 @@ def process(exp, binary=None, **kwargs):
     logger.debug("Process called on {}".format(str(exp.path)))
     logger.debug("Params: {}".format(exp.parameters))
 
-    if exp.is_compressed():
-        exp.decompress()
+    if exp.is_compressed() and exp.archive is None:
+        streaming = kwargs.get("streaming", schema.__defaults__["streaming"][0])
+        if schema.smartbool(streaming) or util.find_filepattern(
+            str(exp.path), "*" + compress.ARCHIVE_EXT
+        ):
+            # raw stacks are read from the archive without extracting it
+            exp.open_archive()
+        else:
+            exp.decompress()
 
     if not exp.ready_to_process:
         if not exp.has_lls_tiffs:
@@ -416,56 +1079,149 @@ def process(exp, binary=None, **kwargs):
 
     P = exp.localParams(**kwargs)
 
-    if binary is None:
-        binary = CUDAbin()
+    if P.streaming and not (P.nIters > 0 or P.saveDeskewedRaw):
+        # only the correction steps were requested, which write their
+        # own output folders
+        logger.warning("Nothing to stream without deconvolution or deskewing")
+        P.streaming = False
 
-    if P.correctFlash:
-        exp.path = exp.correct_flash(**P)
-    elif P.medianFilter or any([any(i) for i in (P.trimX, P.trimY, P.trimZ)]):
-        exp.path = exp.median_and_trim(**P)
-
-    if P.nIters > 0 or P.saveDeskewedRaw or P.rotate:
-        for chan in P.cRange:
-            opts = {
-                "background": P.background[chan] if not P.correctFlash else 0,
-                "drdata": P.drdata,
-                "dzdata": P.dzdata,
-                "wavelength": float(P.wavelength[chan]) / 1000,
-                "deskew": P.deskew,
-                "saveDeskewedRaw": P.saveDeskewedRaw,
-                "MIP": P.MIP,
-                "rMIP": P.rMIP,
-                "uint16": P.uint16,
-                "bleachCorrection": P.bleachCorrection,
-                "RL": P.nIters,
-                "rotate": P.rotate,
-                "width": P.width,
-                "shift": P.shift,
-                # 'quiet': bool(quiet),
-                # 'verbose': bool(verbose),
-            }
+    if P.stageCache and not P.streaming:
+        # the staged pipeline writes every intermediate product to disk
+        logger.warning("The stage cache is only used when streaming, ignoring it")
 
-            # filter by channel and trange
-            if (
-                len(list(P.tRange)) == exp.parameters.nt
-            ):  # processing all the timepoints
-                filepattern = "ch{}_".format(chan)
-            else:
-                filepattern = "ch{}_stack{}".format(
-                    chan, util.pyrange_to_perlregex(P.tRange)
+    if P.outputFormat == "zarr" and zarrstore.zarr is None:
+        raise ParametersError("outputFormat 'zarr' requires the zarr package")
+
+    if exp.archive is not None and not P.streaming:
+        # the staged pipeline and the external binaries read tiffs from disk
+        exp.decompress()
+
+    # finished stacks are recorded, so that an interrupted run can be resumed
+    journal = Journal(str(exp.path))
+    if P.reprocess or not P.resume:
+        journal.clear()
+
+    if P.streaming:
+        # raw stacks are read from the archive (if any) without extracting it
+        process_stream(exp, P, journal=journal)
+    else:
+        useCPU = P.deconBackend == "cpu"
+        if binary is None and not useCPU:
+            try:
+                binary = CUDAbin()
+            except CUDAbinException:
+                if P.deconBackend != "auto":
+                    raise
+                logger.warning("cudaDeconv binary not found, using CPU deconvolution")
+                useCPU = True
+        if useCPU and P.rotate:
+            # check before any correction pass writes files
+            raise ParametersError("Rotation is not supported by the CPU backend")
+
+        # timepoints of each channel that the journal does not record as done
+        todo = journal.pending(P)
+        tRange = sorted(set().union(*todo.values()))
+        if len(tRange) < len(list(P.tRange)):
+            logger.info(
+                "Resuming {}: {} of {} timepoints left".format(
+                    exp.basename, len(tRange), len(list(P.tRange))
                 )
+            )
 
-            binary.process(str(exp.path), filepattern, P.otfs[chan], **opts)
+        trim = any([any(i) for i in (P.trimX, P.trimY, P.trimZ)])
+        if tRange and P.correctFlash:
+            exp.path = exp.correct_flash(**dict(P, tRange=tRange))
+        elif tRange and (P.medianFilter or trim):
+            exp.path = exp.median_and_trim(**dict(P, tRange=tRange))
+
+        if useCPU and (P.nIters > 0 or P.saveDeskewedRaw):
+            # exp.path may point to the "Corrected" folder at this point
+            tiffs = [str(f) for f in sorted(exp.path.glob("*.tif"))]
+            for i, chan in enumerate(P.cRange):
+                if not todo[chan]:
+                    continue
+                cpudecon.process_files(
+                    parse.filter_files(tiffs, c=chan, t=todo[chan]),
+                    P.otfs[i] if P.otfs else None,
+                    str(exp.path),
+                    dzFinal=P.dzFinal,
+                    background=P.background[i] if not P.correctFlash else 0,
+                    drdata=P.drdata,
+                    dzdata=P.dzdata,
+                    deskew=P.deskew,
+                    nIters=P.nIters,
+                    width=P.width,
+                    shift=P.shift,
+                    rotate=P.rotate,
+                    napodize=P.napodize,
+                    padVal=P.padval,
+                    flatStart=P.FlatStart,
+                    saveDeskewedRaw=P.saveDeskewedRaw,
+                    MIP=P.MIP,
+                    rMIP=P.rMIP,
+                    uint16=P.uint16,
+                    uint16raw=P.uint16raw,
+                )
+                record_outputs(exp, journal, P, chan, todo[chan])
+        elif P.nIters > 0 or P.saveDeskewedRaw or P.rotate:
+            for chan in P.cRange:
+                if not todo[chan]:
+                    continue
+                opts = {
+                    "background": P.background[chan] if not P.correctFlash else 0,
+                    "drdata": P.drdata,
+                    "dzdata": P.dzdata,
+                    "wavelength": float(P.wavelength[chan]) / 1000,
+                    "deskew": P.deskew,
+                    "saveDeskewedRaw": P.saveDeskewedRaw,
+                    "MIP": P.MIP,
+                    "rMIP": P.rMIP,
+                    "uint16": P.uint16,
+                    "bleachCorrection": P.bleachCorrection,
+                    "RL": P.nIters,
+                    "rotate": P.rotate,
+                    "width": P.width,
+                    "shift": P.shift,
+                    # 'quiet': bool(quiet),
+                    # 'verbose': bool(verbose),
+                }
+
+                # filter by channel and trange
+                if (
+                    len(todo[chan]) == exp.parameters.nt
+                ):  # processing all the timepoints
+                    filepattern = "ch{}_".format(chan)
+                else:
+                    filepattern = "ch{}_stack{}".format(
+                        chan, util.pyrange_to_perlregex(todo[chan])
+                    )
 
-        # if verbose:
-        #   logger.info(response.output.decode('utf-8'))
+                binary.process(str(exp.path), filepattern, P.otfs[chan], **opts)
+                record_outputs(exp, journal, P, chan, todo[chan])
 
-    # FIXME: this is just a messy first try...
-    if P.doReg:
-        exp.register(P.regRefWave, P.regMode, P.regCalibPath, P.deleteUnregistered)
+            # if verbose:
+            #   logger.info(response.output.decode('utf-8'))
 
-    if P.mergeMIPs:
-        exp.mergemips()
+        # FIXME: this is just a messy first try...
+        if P.doReg:
+            exp.register(P.regRefWave, P.regMode, P.regCalibPath, P.deleteUnregistered)
+
+        if P.outputFormat == "zarr":
+            try:
+                interval = exp.parameters.interval[0]
+            except IndexError:
+                interval = 1
+            for folder in ("GPUdecon", "Deskewed"):
+                if exp.path.joinpath(folder).is_dir():
+                    zarrstore.tiffs_to_zarr(
+                        str(exp.path.joinpath(folder)),
+                        dx=exp.parameters.dx,
+                        dz=exp.parameters.dzFinal,
+                        dt=interval,
+                    )
+
+        if P.mergeMIPs:
+            exp.mergemips()
 
     # if P.mergeMIPsraw:
     #   if exp.path.joinpath('Deskewed').is_dir():
@@ -480,8 +1236,11 @@ def process(exp, binary=None, **kwargs):
     if not P.keepCorrected:
         shutil.rmtree(str(exp.path.joinpath("Corrected")), ignore_errors=True)
 
-    if P.compressRaw:
-        exp.compress()
+    if P.compressRaw and not exp.is_compressed():
+        ctype = P.compressionType
+        exp.compress(
+            compression=ctype if ctype in compress.availableCompression else None
+        )
 
     if P.writeLog:
         outname = str(
@@ -515,13 +1274,13 @@ def mergemips(folder, axis, write=True, dx=1, dt=1, delete=True, fpattern=None):
             if not len(channelFiles):
                 break  # no MIPs in this channel
                 # this assumes that there are no gaps in the channels (i.e. ch1, ch3 but not 2)
-            for file in channelFiles:
-                tiffs.append(tf.imread(str(file)))
-                filelist.append(file)
+            filelist.extend(channelFiles)
             channelCounts.append(len(channelFiles))
             c += 1
         if not len(filelist):
             return None  # there were no MIPs for this axis
+        # many small files: keep several reads in flight
+        tiffs = [im for _, im in util.prefetch(util.imread, filelist, depth=8)]
         if c > 0:
             nt = np.max(channelCounts)
 
@@ -632,6 +1391,10 @@ class LLSdir(object):
         path (:obj:`str`): path to LLS experiment
         ditch_partial (:obj:`bool`, optional): whether to discard tiff files that
             are smaller than the rest (and probably partially acquired)
+        useindex (:obj:`bool`, optional): whether to use (and write) the index
+            file that caches the results of scanning the folder.  The index is
+            only used while the folder is unchanged (same mtime and number of
+            entries).
 
     Usage:
         >>> E = llspy.LLSdir('path/to/experiment_directory')
@@ -664,9 +1427,12 @@ class LLSdir(object):
         >>> E.compress(compression='lbzip2')  # compress the raw data
         >>> E.decompress()  # decompress files for re-processing
         >>> E.freeze()  # delete processed data and compress raw data
+        # or read the raw stacks straight from the archive, without extracting
+        >>> E.open_archive()
+        >>> E.imread(E.get_files(t=0)[0])
     """
 
-    def __init__(self, path, fname_pattern=None, ditch_partial=True):
+    def __init__(self, path, fname_pattern=None, ditch_partial=True, useindex=True):
         global __FPATTERN__
         if fname_pattern and isinstance(fname_pattern, str):
             self.fname_pattern = fname_pattern
@@ -676,6 +1442,8 @@ class LLSdir(object):
 
         self.path = plib.Path(path)
         self.ditch_partial = ditch_partial
+        self.useindex = useindex
+        self.archive = None
         self.settings_files = self.get_settings_files()
         self.has_settings = bool(len(self.settings_files))
         if not self.path.is_dir():
@@ -708,8 +1476,13 @@ class LLSdir(object):
             except Exception as e:
                 logger.warning("Exception reading {}: {}".format(proclog, e))
 
-        if self.has_lls_tiffs:
+        if self.useindex and self._load_index():
+            logger.debug("Loaded LLSdir index for {}".format(self.path))
+        elif self.has_lls_tiffs:
             self._register_tiffs()
+        elif util.find_filepattern(str(self.path), "*" + compress.ARCHIVE_EXT):
+            # indexed archives are cheap to open: stacks are read on demand
+            self.open_archive()
 
     @property
     def isValid(self):
@@ -729,7 +1502,10 @@ class LLSdir(object):
 
     @property
     def has_lls_tiffs(self):
-        """Returns true if the folder has any tiffs mathing the filename regex."""
+        """Returns true if the folder has any tiffs mathing the filename regex,
+        on disk or in an opened archive."""
+        if self.archive is not None and self.tiff.raw:
+            return True
         if self.path.is_dir():
             return parse.contains_filepattern(self.path, self.fname_pattern)
         return False
@@ -750,20 +1526,113 @@ class LLSdir(object):
                 self.ditch_partial_tiffs()
             else:
                 self.tiff.raw = self.tiff.all
+                self._filetable = None
             self.detect_parameters()
             self.read_tiff_header()
+            if self.useindex and self.archive is None:
+                self._save_index()
+
+    def _index_key(self):
+        """identifies the state of the folder that an index was built from.
+        Adding, removing or renaming files changes the directory mtime and
+        the hash of the file names (mtime alone may be too coarse, e.g. FAT)."""
+        st = os.stat(str(self.path))
+        names = "\n".join(sorted(os.listdir(str(self.path))))
+        return {
+            "version": __INDEXVERSION__,
+            "mtime": st.st_mtime_ns,
+            "names": hashlib.sha1(names.encode("utf-8")).hexdigest(),
+            "pattern": self.fname_pattern,
+            "ditch_partial": self.ditch_partial,
+        }
+
+    def _load_index(self):
+        """restore tiff table and detected parameters from the index file.
+        Returns False if there is no index or the folder has changed."""
+        indexfile = str(self.path.joinpath(config.__INDEXFILE__))
+        try:
+            with open(indexfile, "r") as f:
+                index = json.load(f)
+            if index.get("key") != self._index_key():
+                return False
+            params = index["parameters"]
+            params["channels"] = {int(k): v for k, v in params["channels"].items()}
+            params["shape"] = tuple(params["shape"])
+            tiff = index["tiff"]
+            for k in ("all", "raw", "rejected"):
+                tiff[k] = [str(self.path.joinpath(f)) for f in tiff.get(k, [])]
+            filetable = parse.FileTable(tiff["raw"], columns=index["filetable"])
+        except (OSError, ValueError, KeyError, AttributeError):
+            return False
+        self.tiff.update(tiff)
+        self._filetable = filetable
+        self.parameters.update(params)
+        return True
+
+    def _save_index(self):
+        """write the tiff table and detected parameters to the index file."""
+        if len(self.tiff.raw) != len(self.tiff.all):
+            # partial files are probably still being acquired, and files
+            # growing in place do not change the directory mtime
+            return
+        if self.path.name in __OUTPUTFOLDERS__:
+            # intermediate files, e.g. the Corrected folder, are read once
+            return
+        if not os.access(str(self.path), os.W_OK):
+            logger.info("Not writing LLSdir index to read-only {}".format(self.path))
+            return
+        indexfile = self.path.joinpath(config.__INDEXFILE__)
+        try:
+            # create the file first: that changes the directory mtime, whereas
+            # rewriting an existing file does not
+            if not indexfile.exists():
+                indexfile.touch()
+            # store file names, so the index survives moving the folder
+            tiff = dict(self.tiff)
+            for k in ("all", "raw", "rejected"):
+                tiff[k] = [os.path.basename(f) for f in tiff.get(k, [])]
+            index = {
+                "key": self._index_key(),
+                "tiff": tiff,
+                "filetable": self.filetable.to_dict(),
+                "parameters": {
+                    k: self.parameters[k]
+                    for k in __INDEXPARAMS__
+                    if k in self.parameters
+                },
+            }
+            with open(str(indexfile), "w") as f:
+                json.dump(index, f, cls=util.paramEncoder)
+        except (OSError, TypeError) as e:
+            logger.warning("Could not write LLSdir index: {}".format(e))
+
+    def _remove_index(self):
+        indexfile = self.path.joinpath(config.__INDEXFILE__)
+        if indexfile.exists():
+            indexfile.unlink()
 
     def _get_all_tiffs(self):
         """a list of every tiff file in the top level folder (all raw tiffs)"""
-        all_tiffs = sorted(
-            [x for x in self.path.glob("*.tif") if _parse(self.fname_pattern, str(x))]
-        )
+        if self.archive is not None:
+            # virtual paths of the archive members, read with self.imread
+            all_tiffs = sorted(
+                self.path.joinpath(n)
+                for n in self.archive.names
+                if n.endswith(".tif") and _parse(self.fname_pattern, n)
+            )
+        else:
+            all_tiffs = sorted(
+                x for x in self.path.glob("*.tif") if _parse(self.fname_pattern, str(x))
+            )
         if not all_tiffs:
             logger.warn("No raw/uncompressed Tiff files detected in folder")
             return 0
         self.tiff.numtiffs = len(all_tiffs)
         # self.tiff.bytes can be used to get size of raw data: np.sum(self.tiff.bytes)
-        self.tiff.bytes = [f.stat().st_size for f in all_tiffs]
+        if self.archive is not None:
+            self.tiff.bytes = [self.archive.size(f.name) for f in all_tiffs]
+        else:
+            self.tiff.bytes = [f.stat().st_size for f in all_tiffs]
         self.tiff.size_raw = round(np.median(self.tiff.bytes), 2)
         self.tiff.all = [str(f) for f in all_tiffs]
         return self.tiff.numtiffs
@@ -775,6 +1644,7 @@ class LLSdir(object):
         header for each file?
         """
         self.tiff.raw = []
+        self._filetable = None
         if self.parameters.nx and self.parameters.ny:
             thresh = (self.parameters.nx * self.parameters.ny) * 2
         else:
@@ -803,23 +1673,23 @@ class LLSdir(object):
 
         self.tiff.count = [0] * 20  # stupid
         temp = [0] * 20
-        Ns = [
-            parse.parse_filename(str(f), pattern=self.fname_pattern)
-            for f in self.tiff.raw
-        ]
-        for N in Ns:
-            if "channel" not in N:
-                raise LLSpyError("filepattern must specify a channel")
-            self.tiff.count[N["channel"]] += 1
-            if "wave" not in N:
-                raise LLSpyError("filepattern must specify a wave")
-            self.parameters.channels[N["channel"]] = N["wave"]
-
-            if "abstime" in N:
-                if self.tiff.count[N["channel"]] == 1:
-                    temp[N["channel"]] = N["abstime"]
-                if self.tiff.count[N["channel"]] == 2:
-                    temp[N["channel"]] = N["abstime"] - temp[N["channel"]]
+        columns = self.filetable.columns
+        if "channel" not in columns:
+            raise LLSpyError("filepattern must specify a channel")
+        if "wave" not in columns:
+            raise LLSpyError("filepattern must specify a wave")
+        abstimes = columns.get("abstime", [None] * len(self.filetable))
+        for chan, wave, abstime in zip(
+            columns["channel"].tolist(), columns["wave"].tolist(), abstimes
+        ):
+            self.tiff.count[chan] += 1
+            self.parameters.channels[chan] = wave
+
+            if abstime is not None:
+                if self.tiff.count[chan] == 1:
+                    temp[chan] = int(abstime)
+                if self.tiff.count[chan] == 2:
+                    temp[chan] = int(abstime) - temp[chan]
 
         self.tiff.count = [n for n in self.tiff.count if n != 0]
         self.parameters.nc = len(self.tiff.count)
@@ -841,15 +1711,17 @@ class LLSdir(object):
     def read_tiff_header(self):
         with warnings.catch_warnings():
             warnings.simplefilter("ignore")
-            with tf.TiffFile(self.tiff.raw[0]) as firstTiff:
+            first = self.tiff.raw[0]
+            if not os.path.exists(first) and self.archive is not None:
+                first = io.BytesIO(self.archive.read(os.path.basename(first)))
+            with tf.TiffFile(first) as firstTiff:
                 self.parameters.shape = firstTiff.series[0].shape
-                bitstring = "bits_per_sample"
-                try:
-                    if int(tf.__version__.split(".")[1]) >= 13:
-                        bitstring = "bitspersample"
-                except Exception:
-                    pass
-                self.tiff.bit_depth = getattr(firstTiff.pages[0], bitstring)
+                # tifffile >= 0.13 renamed bits_per_sample to bitspersample
+                page = firstTiff.pages[0]
+                if hasattr(page, "bitspersample"):
+                    self.tiff.bit_depth = page.bitspersample
+                else:
+                    self.tiff.bit_depth = page.bits_per_sample
         self.parameters.nz, self.parameters.ny, self.parameters.nx = (
             self.parameters.shape
         )
@@ -883,11 +1755,15 @@ class LLSdir(object):
 
     def compress(self, subfolder=".", compression=None):
         logger.info("compressing %s..." % str(self.path.joinpath(subfolder)))
+        if subfolder == ".":
+            # the index would describe tiffs that are now in the archive
+            self._remove_index()
         return compress.compress(
             str(self.path.joinpath(subfolder)), compression=compression
         )
 
     def decompress(self, subfolder=".", **kwargs):
+        self.close_archive()
         o = compress.decompress(str(self.path.joinpath(subfolder)))
         self._register_tiffs()
         return o
@@ -895,9 +1771,30 @@ class LLSdir(object):
     def decompress_partial(self, subfolder=".", tRange=None):
         """attempt to extract a subset of the tarball,  tRange=None will yield t=0
         """
+        self.close_archive()
         compress.decompress_partial(str(self.path.joinpath(subfolder)), tRange)
         self._register_tiffs()
 
+    def open_archive(self):
+        """Read raw stacks straight from the archive in this folder.
+
+        Archive members are registered as the raw tiffs of the folder, and
+        :meth:`imread` reads them into memory without extracting anything to
+        disk.  Returns the archive reader.
+        """
+        if self.archive is None:
+            self.archive = compress.open_archive(str(self.path))
+            self._register_tiffs()
+        return self.archive
+
+    def close_archive(self):
+        """go back to reading tiffs from disk"""
+        if self.archive is not None:
+            self.archive.close()
+            self.archive = None
+            self.tiff = util.dotdict()
+            self._filetable = None
+
     def reduce_to_raw(self, keepmip=True, verbose=True):
         """
         need to consider the case of sepmips
@@ -939,7 +1836,7 @@ class LLSdir(object):
             pass
         return 1
 
-    def freeze(self, verbose=True, keepmip=True, **kwargs):
+    def freeze(self, verbose=True, keepmip=True, compression=None, **kwargs):
         """Freeze folder for long term storage.
 
         Delete's all deskewed and deconvolved data
@@ -949,7 +1846,7 @@ class LLSdir(object):
         if verbose:
             logger.info("freezing {} ...".format(self.path.name))
         if self.reduce_to_raw(verbose=verbose, keepmip=keepmip, **kwargs):
-            if self.compress(**kwargs):
+            if self.compress(compression=compression, **kwargs):
                 return 1
 
     def localParams(self, recalc=False, **kwargs):
@@ -1148,20 +2045,60 @@ class LLSdir(object):
         output = binary.process(indir, filepattern, otf, **opts)
         return output
 
+    @property
+    def filetable(self):
+        """parsed filename fields of self.tiff.raw, built once.
+        Code that reassigns self.tiff.raw must reset self._filetable"""
+        if getattr(self, "_filetable", None) is None:
+            self._filetable = parse.FileTable(self.tiff.raw, pattern=self.fname_pattern)
+        return self._filetable
+
     def get_t(self, t):
-        return parse.filter_t(self.tiff.raw, t)
+        return self.filetable.filter(t=t)
 
     def get_c(self, c):
-        return parse.filter_c(self.tiff.raw, c)
+        return self.filetable.filter(c=c)
 
     def get_w(self, w):
-        return parse.filter_w(self.tiff.raw, w)
+        return self.filetable.filter(w=w)
 
     def get_reltime(self, rt):
-        return parse.filter_reltime(self.tiff.raw, rt)
+        return self.filetable.filter(reltime=rt)
+
+    def imread(self, fname):
+        """Default loader for stacks in this folder: memory-mapped when the
+        TIFF allows it, so sampling a few planes is cheap.  Stacks that only
+        exist in an opened archive are decompressed into memory."""
+        if self.archive is not None and not os.path.exists(fname):
+            return self.archive.imread(os.path.basename(fname))
+        return util.imread_mmap(fname)
+
+    def stack_identity(self, fname):
+        """identifies the content of a raw stack, for :class:`StageCache` keys"""
+        if self.archive is not None and not os.path.exists(fname):
+            return file_identity(self.archive.path) + [os.path.basename(fname)]
+        return file_identity(fname)
 
     def get_files(self, **kwargs):
-        return parse.filter_files(self.tiff.raw, **kwargs)
+        return self.filetable.filter(**kwargs)
+
+    def iter_timepoints(self, tRange=None, cRange=None, prefetch=2):
+        """Yield (t, files, stacks) for every timepoint in tRange, with the
+        stacks of channels cRange (default: all) read into memory.
+
+        The next `prefetch` timepoints are read on background threads while
+        the current one is processed.
+        """
+        if tRange is None:
+            tRange = self.parameters.tset
+
+        def read(t):
+            files = self.get_t(t) if cRange is None else self.get_files(c=cRange, t=t)
+            # copy out of the memory map, so the read happens on a reader thread
+            return files, [np.array(self.imread(f)) for f in files]
+
+        for t, (files, stacks) in util.prefetch(read, tRange, prefetch):
+            yield t, files, stacks
 
     def get_otf(self, wave, otfpath=config.__OTFPATH__):
         """ intelligently pick OTF from archive directory based on date and mask
@@ -1213,7 +2150,8 @@ class LLSdir(object):
         # defaults background and=100, pad=100, sigma=2
         bgrd = []
         for c in cRange:
-            i = util.imread(self.get_files(c=c)[0]).squeeze()
+            # memory mapped: only the plane used for detection is read
+            i = self.imread(self.get_files(c=c)[0]).squeeze()
             bgrd.append(arrayfun.detect_background(i))
         # self.parameters.background = bgrd
         return bgrd
@@ -1231,6 +2169,7 @@ class LLSdir(object):
     ):
 
         trim = (trimZ, trimY, trimX)
+        camera = camera_key(self)
 
         outpath = self.path.joinpath("Corrected")
         if not outpath.is_dir():
@@ -1254,16 +2193,11 @@ class LLSdir(object):
                 outname = str(outpath.joinpath(os.path.basename(f)))
                 if medianFilter:
                     outname = outname.replace(".tif", "_COR.tif")
-                g.append((f, outname, self.parameters.dx, bgrd, trim, medianFilter))
+                g.append(
+                    (f, outname, self.parameters.dx, bgrd, trim, medianFilter, camera)
+                )
 
-        if sys.version_info >= (3, 4):
-            with Pool(processes=cpu_count()) as pool:
-                pool.map(unbundle, g)
-        else:
-            pool = Pool(processes=cpu_count())
-            pool.map(unbundle, g)
-            pool.close()
-            pool.join()
+        procpool.get_pool().map(unbundle, g)
 
         return outpath
 
@@ -1276,13 +2210,19 @@ class LLSdir(object):
         trimZ=(0, 0),
         trimY=(0, 0),
         trimX=(0, 0),
+        callback=None,
+        pool=None,
         **kwargs
     ):
         """Correct flash artifact, writing files to Corrected dir.
 
+        pool and callback are only used by the "parallel" target: pool is a
+        FlashCorrectionPool for these camera parameters (by default the one
+        from get_flash_pool), and callback is passed to its correct() method.
         """
         if not self.has_settings:
             raise LLSpyError("Cannot correct Flash pixels without settings.txt file")
+        camparams = camparamsPath
         if not isinstance(camparamsPath, CameraParameters):
             if isinstance(camparamsPath, str):
                 camparams = CameraParameters(camparamsPath)
@@ -1328,41 +2268,55 @@ class LLSdir(object):
             #   [p.start() for p in proccessGroup]
             #   [p.join() for p in proccessGroup]
 
-            g = [
-                (t, camparams, outpath, medianFilter, trimZ, trimY, trimX)
-                for t in timegroups
-            ]
-            if sys.version_info >= (3, 4):
-                with Pool(processes=cpu_count()) as pool:
-                    pool.map(unwrapper, g)
+            if shared_memory is not None:
+                shared = pool is None
+                if shared:
+                    pool = get_flash_pool(camparams)
+                try:
+                    pool.correct(
+                        timegroups,
+                        outpath,
+                        medianFilter,
+                        trimZ,
+                        trimY,
+                        trimX,
+                        callback=callback,
+                    )
+                finally:
+                    if shared:
+                        release_flash_pool(pool)
             else:
-                pool = Pool(processes=cpu_count())
-                pool.map(unwrapper, g)
-                pool.close()
-                pool.join()
-
-        elif flashCorrectTarget == "cpu":
-            for t in timegroups:
-                correctTimepoint(
-                    t, camparams, outpath, medianFilter, trimZ, trimY, trimX
-                )
-        elif flashCorrectTarget == "cuda" or flashCorrectTarget == "gpu":
-            camparams.init_CUDAcamcor(
-                (
-                    self.parameters.nz * self.parameters.nc,
-                    self.parameters.ny,
-                    self.parameters.nx,
-                )
-            )
-            for t in timegroups:
-                correctTimepoint(
-                    t, camparams, outpath, medianFilter, trimZ, trimY, trimX, "cuda"
-                )
+                g = [
+                    (t, camparams, outpath, medianFilter, trimZ, trimY, trimX)
+                    for t in timegroups
+                ]
+                procpool.get_pool().map(unwrapper, g)
+
         else:
-            for t in timegroups:
-                correctTimepoint(
-                    t, camparams, outpath, medianFilter, trimZ, trimY, trimX
+            target = "cpu"
+            if flashCorrectTarget == "cuda" or flashCorrectTarget == "gpu":
+                camparams.init_CUDAcamcor(
+                    (
+                        self.parameters.nz * self.parameters.nc,
+                        self.parameters.ny,
+                        self.parameters.nx,
+                    )
                 )
+                target = "cuda"
+            # the next timepoint is corrected while the last one is written
+            with util.AsyncWriter() as writer:
+                for t in timegroups:
+                    correctTimepoint(
+                        t,
+                        camparams,
+                        outpath,
+                        medianFilter,
+                        trimZ,
+                        trimY,
+                        trimX,
+                        target,
+                        writer=writer,
+                    )
         return outpath
 
     def register(self, regRefWave, regMode, regCalibPath, discard=False):
@@ -1480,7 +2434,7 @@ class RegDir(LLSdir):
             if (not dx) or (not dz) or (not angle):
                 raise ValueError("Cannot deskew without dx, dz & angle")
 
-            self.deskewed = [deskewGPU(i, dz, dx, angle) for i in self.data]
+            self.deskewed = [arrayfun.deskew(i, dz, dx, angle) for i in self.data]
             return self.deskewed
 
     def cloudset(self, redo=False, tojson=False):
@@ -7,6 +7,7 @@ import re
 import ctypes
 import os
 import logging
+import threading
 
 logger = logging.getLogger(__name__)
 
@@ -122,25 +123,78 @@ default_otf_pattern = re.compile(
 )
 
 
+# OTF directories by absolute path: {path, mtime, names, has_otfs, otf_dict}
+_catalogs = {}
+# choose_otf results, by arguments and directory mtime
+_choices = {}
+_catalogLock = threading.RLock()
+
+
+def _catalog(otfdir):
+    """Cached listing of an OTF directory, or None if it does not exist.
+
+    The directory is listed again only when its modification time changes,
+    which happens whenever files are added, removed or renamed.
+    """
+    path = os.path.abspath(str(otfdir))
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+    if not os.path.isdir(path):
+        return None
+    with _catalogLock:
+        catalog = _catalogs.get(path)
+        if catalog is None or catalog["mtime"] != mtime:
+            names = sorted(
+                t for t in os.listdir(path) if t.endswith("tif") and not t.startswith(".")
+            )
+            catalog = {
+                "path": path,
+                "mtime": mtime,
+                "names": names,
+                "has_otfs": any(
+                    psffile_pattern.search(t) or default_otf_pattern.search(t)
+                    for t in names
+                ),
+                "otf_dict": None,
+            }
+            _catalogs[path] = catalog
+        return catalog
+
+
+def clear_otf_cache():
+    """forget all cached OTF directory listings and choose_otf results"""
+    with _catalogLock:
+        _catalogs.clear()
+        _choices.clear()
+
+
 def dir_has_otfs(dirname):
-    if os.path.isdir(str(dirname)):
-        if any(
-            [
-                (psffile_pattern.search(t) or default_otf_pattern.search(t))
-                for t in os.listdir(dirname)
-            ]
-        ):
-            return True
-    return False
+    catalog = _catalog(dirname)
+    return bool(catalog and catalog["has_otfs"])
 
 
 def get_otf_dict(otfdir):
-    """ The otf_dict is a dict with
+    """ The otf_dict is a dict with {wave: {mask: [otf info], 'default': path}}
+
+    The dict is cached until files are added to or removed from otfdir, and
+    must not be modified.
     """
+    catalog = _catalog(otfdir)
+    if catalog is None:
+        return {}
+    with _catalogLock:
+        if catalog["otf_dict"] is None:
+            catalog["otf_dict"] = _scan_otf_dict(catalog["path"], catalog["names"])
+        return catalog["otf_dict"]
+
+
+def _scan_otf_dict(otfdir, names):
     otf_dict = {}
     otfdir = plib.Path(otfdir)
 
-    for t in otfdir.glob("*tif"):
+    for t in (otfdir.joinpath(n) for n in names):
         M = psffile_pattern.search(str(t.name))
         if M:
             M = M.groupdict()
@@ -213,11 +267,25 @@ def choose_otf(
     direction can be {'nearest', 'before', 'after'}, where 'before' returns an
     OTF that was collected before 'date' and 'after' returns one that was
     collected after 'date.'
+
+    Results are memoized until files are added to or removed from otfpath.
     """
-    if not dir_has_otfs(otfpath):
+    catalog = _catalog(otfpath)
+    if not (catalog and catalog["has_otfs"]):
         raise OTFError("Not a valid OTF path: {}".format(otfpath))
     if not date:
-        date = datetime.now()
+        # the default date changes every call, so is not memoized
+        return _choose_otf(wave, otfpath, datetime.now(), mask, direction, approximate)
+    key = (catalog["path"], catalog["mtime"], wave, date, mask, direction, approximate)
+    with _catalogLock:
+        if key not in _choices:
+            _choices[key] = _choose_otf(
+                wave, otfpath, date, mask, direction, approximate
+            )
+        return _choices[key]
+
+
+def _choose_otf(wave, otfpath, date, mask, direction, approximate):
 
     otf_dict = get_otf_dict(otfpath)
     otflist = []
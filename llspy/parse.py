@@ -3,6 +3,8 @@ from __future__ import division, print_function
 import os
 import re
 import warnings
+
+import numpy as np
 import parse
 
 
@@ -179,20 +181,10 @@ def filter_reltime(filelist, trange, exclusive=False):
     if not len(trange) == 2:
         raise ValueError("relative time range must be a 2x tuple of min/max")
     q = []
-    if exclusive:
-        for f in filelist:
-            if (
-                parse_filename(f, "reltime") < trange[0]
-                and parse_filename(f, "reltime") > trange[1]
-            ):
-                q.append(f)
-    else:
-        for f in filelist:
-            if (
-                parse_filename(f, "reltime") >= trange[0]
-                and parse_filename(f, "reltime") <= trange[1]
-            ):
-                q.append(f)
+    for f in filelist:
+        inrange = trange[0] <= parse_filename(f, "reltime") <= trange[1]
+        if inrange != exclusive:
+            q.append(f)
     return q
 
 
@@ -217,25 +209,109 @@ def filter_files(filelist, exclusive=False, **kwargs):
         relative time -> filter_reltime,
 
     """
-    funcdict = {
-        "t": filter_t,
-        "time": filter_t,
-        "s": filter_t,
-        "stacks": filter_t,
-        "timepoints": filter_t,
-        "c": filter_c,
-        "channel": filter_c,
-        "channels": filter_c,
-        "w": filter_w,
-        "wave": filter_w,
-        "waves": filter_w,
-        "wavelengths": filter_w,
-        "reltime": filter_reltime,
-        "relative time": filter_reltime,
-    }
-
     for k in kwargs:
-        if k not in funcdict:
+        if k not in _FILTERS:
             raise AttributeError("Did not recognize filter argument: {}".format(k))
-        filelist = funcdict[k](filelist, kwargs[k], exclusive=exclusive)
+        filelist = _FILTERS[k][0](filelist, kwargs[k], exclusive=exclusive)
     return filelist
+
+
+# filter_files keyword -> (filter function, filename field)
+_FILTERS = {
+    "t": (filter_t, "stack"),
+    "time": (filter_t, "stack"),
+    "s": (filter_t, "stack"),
+    "stacks": (filter_t, "stack"),
+    "timepoints": (filter_t, "stack"),
+    "c": (filter_c, "channel"),
+    "channel": (filter_c, "channel"),
+    "channels": (filter_c, "channel"),
+    "w": (filter_w, "wave"),
+    "wave": (filter_w, "wave"),
+    "waves": (filter_w, "wave"),
+    "wavelengths": (filter_w, "wave"),
+    "reltime": (filter_reltime, "reltime"),
+    "relative time": (filter_reltime, "reltime"),
+}
+
+
+def _iterate(values):
+    if isinstance(values, str):
+        return [values]
+    try:
+        return list(values)
+    except TypeError:
+        return [values]
+
+
+class FileTable(object):
+    """ Columnar index of a list of LLS filenames.
+
+    Every filename is parsed once, and the named fields (channel, stack,
+    wave, reltime, abstime ...) are stored as arrays, so that repeated
+    queries are answered with vectorized masks instead of rescanning the
+    filenames.  :meth:`filter` returns the same lists as :func:`filter_files`.
+
+    Args:
+        filelist (list): filenames, all matching ``pattern``
+        pattern (str): filename pattern, see :func:`parse_filename`
+        columns (dict): previously parsed fields (e.g. from :meth:`to_dict`),
+            used instead of parsing the filenames
+    """
+
+    def __init__(self, filelist, pattern=None, columns=None):
+        self.files = list(filelist)
+        if columns is None:
+            records = [parse_filename(f, pattern=pattern) for f in self.files]
+            fields = set(records[0]) if records else set()
+            for r in records:
+                fields.intersection_update(r)
+            columns = {k: [r[k] for r in records] for k in fields}
+        self.columns = {}
+        for k, v in columns.items():
+            if len(v) != len(self.files):
+                raise ValueError("column {} does not match number of files".format(k))
+            self.columns[k] = np.asarray(v)
+
+    def __len__(self):
+        return len(self.files)
+
+    def to_dict(self):
+        """ JSON serializable copy of the parsed fields """
+        return {k: v.tolist() for k, v in self.columns.items()}
+
+    def _match(self, field, values, idx):
+        col = self.columns[field]
+        sub = col[idx]
+        out = []
+        for v in _iterate(values):
+            if field == "wave" and str(v).endswith("nm"):
+                v = str(v).strip("nm")
+            try:
+                v = int(v) if col.dtype.kind in "iu" else str(v)
+            except ValueError:
+                continue
+            out.append(idx[sub == v])
+        return np.concatenate(out) if out else idx[:0]
+
+    def _reltime(self, trange, idx):
+        if not len(trange) == 2:
+            raise ValueError("relative time range must be a 2x tuple of min/max")
+        sub = self.columns["reltime"][idx]
+        return idx[(sub >= trange[0]) & (sub <= trange[1])]
+
+    def filter(self, exclusive=False, **kwargs):
+        """ filter the table with the same arguments as :func:`filter_files` """
+        for k in kwargs:
+            if k not in _FILTERS:
+                raise AttributeError("Did not recognize filter argument: {}".format(k))
+        fields = [_FILTERS[k][1] for k in kwargs]
+        if exclusive or not all(f in self.columns for f in fields):
+            return filter_files(self.files, exclusive=exclusive, **kwargs)
+        idx = np.arange(len(self.files))
+        for k, field in zip(kwargs, fields):
+            if field == "reltime":
+                idx = self._reltime(kwargs[k], idx)
+            else:
+                idx = self._match(field, kwargs[k], idx)
+        return [self.files[i] for i in idx]
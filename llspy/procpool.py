@@ -0,0 +1,156 @@
+"""Long-lived process pool shared by the CPU-parallel stages of LLSpy.
+
+Starting a pool spawns interpreters that import numpy, scipy and numba,
+which can take longer than correcting a whole folder.  The pool returned by
+:func:`get_pool` is started on first use and kept until its settings change
+or the interpreter exits, so batch runs only pay for it once.
+
+Workers are spawned rather than forked: forking after a numba parallel
+kernel has run (e.g. arrayfun.deskew_cpu) can deadlock the children.
+"""
+
+import atexit
+import logging
+import os
+import queue
+import threading
+from multiprocessing import cpu_count, get_context
+
+import numba
+
+from . import config
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+logger = logging.getLogger(__name__)
+
+# worker count (None: one per core) and per-worker memory budget in MB
+_settings = {
+    "processes": config.__WORKERS__ or None,
+    "memory": config.__WORKERMEMORY__ or None,
+}
+
+_pool = None
+_poolSettings = None
+# in the parent: queue that tasks report progress to, in workers: its end
+_progress = None
+# in the parent: queues of the runs listening to progress messages, by run key
+_subscribers = {}
+# batch runs request the pool from several threads
+_lock = threading.RLock()
+
+
+def configure(processes=None, memory=None):
+    """Set the number of workers and the memory budget (MB) of each worker.
+
+    By default there is one worker per core and no memory budget.  With a
+    budget, the number of workers is limited to what fits in physical
+    memory, and on POSIX systems a worker that allocates beyond its budget
+    raises MemoryError in its task instead of exhausting the machine.
+    A running pool is restarted with the new settings on next use.
+    """
+    _settings["processes"] = processes
+    _settings["memory"] = memory
+
+
+def _physical_memory():
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (AttributeError, ValueError, OSError):
+        return None
+
+
+def pool_size():
+    """number of workers the pool is started with"""
+    processes = _settings["processes"] or cpu_count()
+    memory = _settings["memory"]
+    total = _physical_memory()
+    if memory and total:
+        processes = min(processes, max(1, total // (memory * 2**20)))
+    return processes
+
+
+def _init_worker(memory, progress):
+    global _progress
+    _progress = progress
+    # the pool already runs one task per core
+    numba.set_num_threads(1)
+    if memory and resource is not None:
+        limit = memory * 2**20
+        try:
+            hard = resource.getrlimit(resource.RLIMIT_DATA)[1]
+            if hard != resource.RLIM_INFINITY:
+                limit = min(limit, hard)
+            resource.setrlimit(resource.RLIMIT_DATA, (limit, hard))
+        except (ValueError, OSError) as e:
+            logger.warning("Could not set worker memory budget: {}".format(e))
+
+
+def _dispatch(progress):
+    """route progress messages to the queue of their run, until shutdown"""
+    while True:
+        item = progress.get()
+        if item is None:
+            break
+        run, message = item
+        with _lock:
+            q = _subscribers.get(run)
+        if q is not None:
+            q.put(message)
+
+
+def get_pool():
+    """return the shared process pool, starting it if necessary"""
+    global _pool, _poolSettings, _progress
+    settings = (pool_size(), _settings["memory"])
+    with _lock:
+        if _pool is not None and _poolSettings != settings:
+            shutdown()
+        if _pool is None:
+            ctx = get_context("spawn")
+            _progress = ctx.Queue()
+            _pool = ctx.Pool(settings[0], _init_worker, (settings[1], _progress))
+            _poolSettings = settings
+            threading.Thread(target=_dispatch, args=(_progress,), daemon=True).start()
+            logger.debug("Started process pool with {} workers".format(settings[0]))
+        return _pool
+
+
+def subscribe(run):
+    """return a queue receiving the messages that tasks send with
+    :func:`report` for run (any hashable key, unique among concurrent runs)"""
+    get_pool()
+    with _lock:
+        return _subscribers.setdefault(run, queue.Queue())
+
+
+def unsubscribe(run):
+    """stop receiving the messages of run"""
+    with _lock:
+        _subscribers.pop(run, None)
+
+
+def report(run, message=None):
+    """send message to the parent process for run, from a task of the shared
+    pool"""
+    _progress.put((run, message))
+
+
+@atexit.register
+def shutdown(terminate=False):
+    """stop the shared pool, waiting for running tasks unless terminate"""
+    global _pool, _poolSettings
+    with _lock:
+        if _pool is not None:
+            if terminate:
+                _pool.terminate()
+            else:
+                _pool.close()
+            _pool.join()
+            # stops the dispatcher thread
+            _progress.put(None)
+            _pool = None
+            _poolSettings = None
@@ -4,6 +4,7 @@ import numpy as np
 from scipy import ndimage
 from scipy import stats
 import scipy
+import scipy.spatial
 import os
 
 try:
@@ -116,9 +117,8 @@ def get_closest_points(pc1, pc2):
 
 	can be used to eliminate points in pc1 that don't have a partner in pc2
 	"""
-    d = [((pc2 - point) ** 2).sum(axis=1) for point in pc1]
-    nn = [(np.min(p), np.argmin(p)) for p in d]
-    return nn
+    d, idx = scipy.spatial.cKDTree(pc2).query(pc1)
+    return np.column_stack((d * d, idx))
 
 
 def get_matching_points(pc1, pc2, maxd=100):
@@ -98,6 +98,7 @@ __defaults__ = {
     "regCalibPath": (None, "directory with registration calibration data"),
     "mincount": (10, "minimum number of beads expected in regCal data"),
     "reprocess": (False, "reprocess already-done data when processing"),
+    "resume": (True, "skip stacks the completion journal records as done"),
     "tRange": (None, "time range to process (None means all)"),
     "cRange": (None, "channel range to process (None means all)"),
     "otfDir": (None, "directory to look in for PSFs/OTFs"),
@@ -112,7 +113,8 @@ __defaults__ = {
     "compressRaw": (False, "do compression of raw data after processing"),
     "compressionType": (
         "lbzip2",
-        "compression binary {lbzip2, bzip2, pbzip2, pigz, gzip}",
+        "compression binary {lbzip2, bzip2, pbzip2, pigz, gzip}, "
+        "or llsz for an indexed per-stack archive",
     ),
     "writeLog": (True, "write settings to processinglog.txt"),
     "padval": (0, "value to pad image with when deskewing"),
@@ -125,6 +127,17 @@ __defaults__ = {
         "duplicate reversed stack prior to decon to reduce Z ringing",
     ),
     "lzw": (False, "use LZW tiff compression"),
+    "streaming": (False, "process one timepoint at a time with a single read/write"),
+    "stageCache": (
+        False,
+        "streaming: reuse corrected, deskewed and deconvolved stacks cached "
+        "by previous runs with the same upstream parameters",
+    ),
+    "outputFormat": (
+        "tiff",
+        "{tiff, zarr} - zarr writes one chunked TCZYX store per output type",
+    ),
+    "deconBackend": ("auto", "{auto, cuda, cpu} - auto uses CPU when CUDA is missing"),
     # 'bRollingBall': self.backgroundRollingRadio.
 }
 
@@ -220,6 +233,7 @@ __validator__ = {
         msg="mincount (min number of beads to detect) must be between 0-500",
     ),
     "reprocess": smartbool,
+    "resume": smartbool,
     "tRange": Any(
         None, CTiterable, msg="tRange must be int or iterable of integers >= 0"
     ),
@@ -249,13 +263,31 @@ __validator__ = {
         "pbzip2",
         "pigz",
         "gzip",
-        msg="Currently allowed compression types: {lbzip2, bzip2, pbzip2, pigz, gzip}",
+        "llsz",
+        msg="Currently allowed compression types: "
+        "{lbzip2, bzip2, pbzip2, pigz, gzip, llsz}",
     ),
     "writeLog": smartbool,
     "padval": intRange(0, 9999),
     "FlatStart": smartbool,
     "dupRevStack": smartbool,
     "lzw": smartbool,
+    "streaming": smartbool,
+    "stageCache": smartbool,
+    "outputFormat": All(
+        Coerce(str),
+        Lower,
+        Strip,
+        Any("tiff", "zarr"),
+        msg="outputFormat must be {tiff, zarr}",
+    ),
+    "deconBackend": All(
+        Coerce(str),
+        Lower,
+        Strip,
+        Any("auto", "cuda", "cpu"),
+        msg="deconBackend must be {auto, cuda, cpu}",
+    ),
 }
 
 
@@ -0,0 +1,150 @@
+"""Disk cache of intermediate products, reused between processing runs.
+
+Reprocessing a folder with tweaked options usually changes only the last
+steps of the pipeline (MIPs, registration, bit depth...), yet every run used
+to start again from the raw data.  :class:`StageCache` stores the products
+of expensive stages (corrected stacks, deskewed and deconvolved stacks)
+under a key made from the identity of the input files and the parameters of
+every stage up to that point, so a later run with the same upstream
+parameters reads them back instead of recomputing them.
+
+Entries are .npy files in a single folder.  Once the folder grows beyond its
+disk quota the least recently used entries are removed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import threading
+import uuid
+
+import numpy as np
+
+from . import config, util
+
+logger = logging.getLogger(__name__)
+
+
+def file_identity(path):
+    """(path, size, mtime) of a file, which changes when it is rewritten"""
+    path = os.path.abspath(str(path))
+    st = os.stat(path)
+    return [path, st.st_size, st.st_mtime_ns]
+
+
+class StageCache(object):
+    """Least recently used cache of arrays on disk.
+
+    Args:
+        path (str): cache folder (default: config ``cache_dir``)
+        quota (int): maximum size of the folder in MB (default: config
+            ``cache_quota``)
+    """
+
+    SUFFIX = ".npy"
+
+    def __init__(self, path=None, quota=None):
+        self.path = os.path.expanduser(str(path or config.__CACHEDIR__))
+        self.quota = (quota if quota is not None else config.__CACHEQUOTA__) * 2**20
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        self._lock = threading.Lock()
+        self._size = sum(size for _, _, size in self._entries())
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(*parts):
+        """key of a product, from any JSON-serializable description of its
+        inputs and parameters (e.g. the key of the previous stage)"""
+        text = json.dumps(parts, sort_keys=True, cls=util.paramEncoder, default=str)
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.path, key + self.SUFFIX)
+
+    def _entries(self):
+        """(mtime, path, size) of every entry"""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(self.SUFFIX):
+                continue
+            path = os.path.join(self.path, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, path, st.st_size))
+        return entries
+
+    def get(self, key):
+        """return the array stored under key, or None"""
+        path = self._file(key)
+        try:
+            arr = np.load(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        try:
+            # the modification time is the last use, for eviction
+            os.utime(path)
+        except OSError:
+            pass
+        self.hits += 1
+        return arr
+
+    def get_all(self, keys):
+        """return the list of arrays stored under keys, or None unless all
+        of them are cached"""
+        arrays = []
+        for key in keys:
+            arr = self.get(key)
+            if arr is None:
+                return None
+            arrays.append(arr)
+        return arrays
+
+    def put(self, key, arr):
+        """store arr under key, evicting old entries beyond the quota"""
+        arr = np.asarray(arr)
+        if self.quota <= 0 or arr.nbytes > self.quota:
+            return
+        path = self._file(key)
+        # written under a unique name, so that readers never see partial files
+        tmp = "{}.{}.tmp".format(path, uuid.uuid4().hex)
+        with open(tmp, "wb") as f:
+            np.save(f, arr)
+        with self._lock:
+            try:
+                # an entry that is overwritten no longer counts
+                self._size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(tmp, path)
+            self._size += os.path.getsize(path)
+            if self._size > self.quota:
+                self.evict()
+
+    def put_all(self, keys, arrays):
+        for key, arr in zip(keys, arrays):
+            self.put(key, arr)
+
+    def evict(self):
+        """remove least recently used entries until the cache fits its quota"""
+        entries = sorted(self._entries())
+        self._size = sum(size for _, _, size in entries)
+        while entries and self._size > self.quota:
+            _, path, size = entries.pop(0)
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+            logger.debug("Evicted {} from stage cache".format(os.path.basename(path)))
+
+    def clear(self):
+        with self._lock:
+            for _, path, _ in self._entries():
+                os.remove(path)
+            self._size = 0
@@ -1,11 +1,15 @@
 import os
 import sys
+import queue
 import fnmatch
+import threading
 import warnings
 import tifffile
 import numpy as np
 import json
 import ctypes
+import collections
+from concurrent.futures import ThreadPoolExecutor
 
 
 PLAT = sys.platform
@@ -55,6 +59,21 @@ def imread(*args, **kwargs):
         return tifffile.imread(*args, **kwargs)
 
 
+def imread_mmap(path, **kwargs):
+    """Read TIFF file, memory-mapping it when possible.
+
+    Uncompressed TIFFs with contiguous image data (such as raw LLS camera
+    output) are mapped read-only, so that accessing a few planes only reads
+    those planes from disk.  Anything else is decoded with :func:`imread`.
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        try:
+            return tifffile.memmap(str(path), mode="r", **kwargs)
+        except (ValueError, TypeError):
+            return tifffile.imread(str(path), **kwargs)
+
+
 def imshow(*args, **kwargs):
     return tifffile.imshow(*args, **kwargs)
 
@@ -75,7 +94,9 @@ def imsave(arr, outpath, dx=1, dz=1, dt=1, unit="micron"):
         arr = reorderstack(arr)  # assume that 3 dimension array is ZYX
     with warnings.catch_warnings():
         warnings.simplefilter("ignore")
-        tifffile.imsave(
+        # tifffile.imsave was removed in favor of tifffile.imwrite
+        imwrite = getattr(tifffile, "imwrite", None) or tifffile.imsave
+        imwrite(
             outpath,
             arr,
             bigtiff=bigT,
@@ -85,6 +106,120 @@ def imsave(arr, outpath, dx=1, dz=1, dt=1, unit="micron"):
         )
 
 
+def prefetch(func, items, depth=2, nthreads=None):
+    """Yield (item, func(item)) for items, in order.
+
+    Up to ``depth`` items ahead of the one being consumed are computed in a
+    pool of ``nthreads`` threads (default: depth), so that reading the next
+    items overlaps with whatever the caller does with the current one.
+    Exceptions raised by func are re-raised when their item is reached.
+    """
+    depth = max(depth, 1)
+    pending = collections.deque()
+    with ThreadPoolExecutor(nthreads or depth) as pool:
+        try:
+            for item in items:
+                pending.append((item, pool.submit(func, item)))
+                if len(pending) > depth:
+                    item, future = pending.popleft()
+                    yield item, future.result()
+            while pending:
+                item, future = pending.popleft()
+                yield item, future.result()
+        finally:
+            # the consumer stopped early
+            for _, future in pending:
+                future.cancel()
+
+
+class AsyncWriter(object):
+    """Write files on background threads, so that compute and output overlap.
+
+    :meth:`save` queues an :func:`imsave` call (and :meth:`submit` any other
+    writing function) and returns immediately.  When ``maxsize`` writes are
+    pending, it blocks until a writer thread catches up.  The first exception
+    raised by a write is re-raised in the caller by the next save, flush or
+    close; later writes are skipped.  Queued arrays must not be modified by
+    the caller afterwards.
+
+    Use as a context manager, or call close() at the end of the pipeline to
+    wait for all pending writes.
+    """
+
+    def __init__(self, nthreads=2, maxsize=None):
+        self._queue = queue.Queue(maxsize=maxsize or 2 * nthreads)
+        self._errors = []
+        self._closed = False
+        self._threads = [
+            threading.Thread(target=self._run, daemon=True) for _ in range(nthreads)
+        ]
+        [t.start() for t in self._threads]
+
+    def _run(self):
+        while True:
+            job = self._queue.get()
+            try:
+                if job is None:
+                    return
+                func, args, kwargs, callback = job
+                if not self._errors:
+                    func(*args, **kwargs)
+                    if callback is not None:
+                        callback()
+            except Exception as e:
+                self._errors.append(e)
+            finally:
+                self._queue.task_done()
+
+    def check(self):
+        """re-raise the first error of a writer thread"""
+        if self._errors:
+            raise self._errors[0]
+
+    def submit(self, func, *args, **kwargs):
+        """queue func(*args, **kwargs) on a writer thread"""
+        self.check()
+        if self._closed:
+            raise RuntimeError("AsyncWriter is closed")
+        self._queue.put((func, args, kwargs, None))
+
+    def save(self, arr, outpath, callback=None, **kwargs):
+        """queue imsave(arr, outpath, **kwargs), callback(outpath) is called on
+        the writer thread once the file has been written"""
+        self.check()
+        if self._closed:
+            raise RuntimeError("AsyncWriter is closed")
+        done = (lambda: callback(outpath)) if callback is not None else None
+        self._queue.put((imsave, (arr, outpath), kwargs, done))
+
+    def flush(self):
+        """wait until all queued writes are done"""
+        self._queue.join()
+        self.check()
+
+    def close(self):
+        """flush and stop the writer threads"""
+        if not self._closed:
+            self._closed = True
+            for _ in self._threads:
+                self._queue.put(None)
+            [t.join() for t in self._threads]
+        self.check()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *args):
+        if exc_type is None:
+            self.close()
+        else:
+            # keep the original exception
+            try:
+                self.close()
+            except Exception:
+                pass
+
+
 def getfoldersize(folder, recurse=False):
     if recurse:
         total_size = 0
@@ -0,0 +1,213 @@
+"""Chunked (OME-)Zarr output for processed volumes.
+
+All deskewed or deconvolved volumes of an experiment go into a single TCZYX
+store instead of one tiff per channel and timepoint.  Every chunk belongs to
+a single (t, c) volume, so volumes can be written concurrently from threads
+or processes without locking.  Each store holds a pyramid of levels,
+downsampled 2x in Y and X, described by OME-Zarr (v0.4) multiscales metadata.
+"""
+
+import logging
+import os
+import re
+import shutil
+import threading
+
+import numpy as np
+
+from . import procpool, util
+from .exceptions import LLSpyError
+
+try:
+    import zarr
+except ImportError:
+    zarr = None
+
+logger = logging.getLogger(__name__)
+
+# chunk size of (z, y, x) within a single volume
+CHUNKS = (64, 256, 256)
+
+# processed tiff names: {base}_ch{c}_stack{t}..._{abstime}msecAbs{suffix}.tif
+_TIFFNAME = re.compile(
+    r"^(?P<base>.+)_ch(?P<c>\d+)_stack(?P<t>\d{4}).*?msecAbs(?P<suffix>.*)\.tif$"
+)
+
+
+def _downsample(volume):
+    """2x2 mean in Y and X, keeping the dtype"""
+    nz, ny, nx = volume.shape
+    ny, nx = ny // 2 * 2, nx // 2 * 2
+    binned = volume[:, :ny, :nx].reshape(nz, ny // 2, 2, nx // 2, 2)
+    return binned.mean(axis=(2, 4)).astype(volume.dtype)
+
+
+class ZarrWriter(object):
+    """Write (t, c) volumes into a chunked, compressed TCZYX Zarr store.
+
+    The store is created (or reopened, if it exists) by the constructor.
+    Writers can be pickled and sent to worker processes: every process opens
+    its own handles to the store.  Writing past the last timepoint grows the
+    T axis, which allows appending timepoints as they are acquired.  Growing
+    is safe between threads, but not between processes, so concurrent writer
+    processes should pass the final number of timepoints up front.
+
+    Args:
+        path (str): path of the .zarr store
+        nc (int): number of channels
+        shape (tuple): (nz, ny, nx) shape of a single volume
+        dtype: data type of the volumes
+        nt (int): initial number of timepoints
+        dx, dz (float): voxel size in microns
+        dt (float): time interval in seconds
+        levels (int): number of pyramid levels (including full resolution)
+    """
+
+    def __init__(
+        self, path, nc, shape, dtype, nt=1, dx=1, dz=1, dt=1, levels=3, chunks=None
+    ):
+        if zarr is None:
+            raise LLSpyError("Zarr output requires the zarr package")
+        self.path = str(path)
+        self.nc = nc
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype).str
+        self.levels = max(1, min(levels, int(np.log2(max(min(shape[1:]), 1))) + 1))
+        self.chunks = tuple(min(c, s) for c, s in zip(chunks or CHUNKS, self.shape))
+        self._arrays = None
+        self._lock = threading.Lock()
+
+        group = zarr.open_group(self.path, mode="a")
+        scale = [dt, 1, dz, dx, dx]
+        datasets = []
+        for level in range(self.levels):
+            datasets.append(
+                {
+                    "path": str(level),
+                    "coordinateTransformations": [
+                        {"type": "scale", "scale": list(scale)}
+                    ],
+                }
+            )
+            scale[3] *= 2
+            scale[4] *= 2
+        axes = [
+            {"name": "t", "type": "time", "unit": "second"},
+            {"name": "c", "type": "channel"},
+            {"name": "z", "type": "space", "unit": "micrometer"},
+            {"name": "y", "type": "space", "unit": "micrometer"},
+            {"name": "x", "type": "space", "unit": "micrometer"},
+        ]
+        group.attrs["multiscales"] = [
+            {
+                "version": "0.4",
+                "name": os.path.basename(self.path),
+                "axes": axes,
+                "datasets": datasets,
+            }
+        ]
+        self._open(mode="a", nt=nt)
+
+    def _levelshapes(self):
+        nz, ny, nx = self.shape
+        return [(nz, ny >> level, nx >> level) for level in range(self.levels)]
+
+    def _open(self, mode="r+", nt=1):
+        if self._arrays is None:
+            self._arrays = []
+            for level, shape in enumerate(self._levelshapes()):
+                chunks = tuple(min(c, s) for c, s in zip(self.chunks, shape))
+                self._arrays.append(
+                    zarr.open_array(
+                        os.path.join(self.path, str(level)),
+                        mode=mode,
+                        shape=(nt, self.nc) + shape,
+                        chunks=(1, 1) + chunks,
+                        dtype=self.dtype,
+                    )
+                )
+        return self._arrays
+
+    def __getstate__(self):
+        # zarr handles are reopened in every process
+        state = self.__dict__.copy()
+        state["_arrays"] = None
+        del state["_lock"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+
+    @property
+    def nt(self):
+        return self._open()[0].shape[0]
+
+    def write(self, t, c, volume):
+        """write a ZYX volume at timepoint t, channel c, and its pyramid"""
+        volume = np.asarray(volume, dtype=self.dtype)
+        if volume.shape != self.shape:
+            raise ValueError(
+                "Volume shape {} does not match store shape {}".format(
+                    volume.shape, self.shape
+                )
+            )
+        with self._lock:
+            # threads appending timepoints out of order must never shrink T
+            arrays = self._open()
+            if t >= arrays[0].shape[0]:
+                for arr in arrays:
+                    arr.resize((t + 1,) + arr.shape[1:])
+        for arr in arrays:
+            arr[t, c] = volume
+            volume = _downsample(volume)
+
+
+def _write_tiff(job):
+    writer, t, c, fname = job
+    writer.write(t, c, util.imread(fname))
+
+
+def tiffs_to_zarr(folder, dx=1, dz=1, dt=1, delete=True, **kwargs):
+    """Convert a folder of processed tiffs to one Zarr store per output type.
+
+    Files are grouped by their name outside of the channel/stack fields, so
+    e.g. ``*_decon.tif`` and ``*_decon_REG488.tif`` go to separate stores.
+    Tiffs are read and written concurrently by the shared process pool.
+    Returns the paths of the written stores.
+    """
+    groups = {}
+    for fname in sorted(os.listdir(folder)):
+        m = _TIFFNAME.match(fname)
+        if m:
+            key = (m.group("base"), m.group("suffix"))
+            groups.setdefault(key, []).append(
+                (int(m.group("t")), int(m.group("c")), os.path.join(folder, fname))
+            )
+
+    stores = []
+    for (base, suffix), files in sorted(groups.items()):
+        tset = sorted({t for t, _, _ in files})
+        cset = sorted({c for _, c, _ in files})
+        first = util.imread(files[0][2])
+        path = os.path.join(folder, base + suffix + ".zarr")
+        if os.path.exists(path):
+            shutil.rmtree(path)
+        writer = ZarrWriter(
+            path,
+            len(cset),
+            first.shape,
+            first.dtype,
+            nt=len(tset),
+            dx=dx,
+            dz=dz,
+            dt=dt,
+            **kwargs
+        )
+        jobs = [(writer, tset.index(t), cset.index(c), f) for t, c, f in files]
+        procpool.get_pool().map(_write_tiff, jobs)
+        if delete:
+            [os.remove(f) for _, _, f in files]
+        logger.info("Wrote {} volumes to {}".format(len(files), path))
+        stores.append(path)
+    return stores
@@ -0,0 +1,47 @@
+import numpy as np
+
+from llspy import arrayfun
+
+
+def test_deskew_cpu_geometry():
+    nz, ny, nx = 12, 5, 20
+    dz, dr, angle = 0.4, 0.1, 31.5
+    im = np.zeros((nz, ny, nx), np.float32)
+    im[:, :, 3] = 100
+    out = arrayfun.deskew_cpu(im, dz, dr, angle, padVal=7)
+    assert out.dtype == np.float32
+    assert out.shape == (nz, ny, arrayfun.deskewed_nx(nx, nz, dz, dr, angle))
+    # the bright column should move right by deskewFactor pixels per plane
+    factor = np.cos(angle * np.pi / 180) * dz / dr
+    peaks = out[:, 0].argmax(1)
+    assert np.all(np.abs(np.diff(peaks) - factor) <= 1)
+    # everything shifted out of the source image is filled with padVal
+    assert out[0, 0, -1] == 7
+    assert out[-1, 0, 0] == 7
+
+
+def test_deskew_cpu_width_shift():
+    im = np.random.rand(8, 4, 16).astype(np.float32)
+    full = arrayfun.deskew_cpu(im, 0.3, 0.1, 31.5)
+    assert arrayfun.deskew_cpu(im, 0.3, 0.1, 31.5, width=10).shape == (8, 4, 10)
+    # zero deskew factor is an identity transform
+    ident = arrayfun.deskew_cpu(im, 0.3, 0.1, 90, width=16)
+    np.testing.assert_allclose(ident, im, atol=1e-5)
+    # shifting moves the crop window across the full output
+    shifted = arrayfun.deskew_cpu(im, 0.3, 0.1, 31.5, width=full.shape[2], shift=2)
+    np.testing.assert_allclose(shifted[..., :-2], full[..., 2:], atol=1e-5)
+
+
+def test_affine_cpu():
+    im = np.random.rand(6, 10, 12).astype(np.float32)
+    np.testing.assert_allclose(arrayfun.affine_cpu(im, np.eye(4)), im, atol=1e-5)
+    # the matrix maps output to input coordinates, in XYZ order
+    tmat = np.eye(4)
+    tmat[:3, 3] = [2, 1, 0]
+    out = arrayfun.affine_cpu(im, tmat)
+    np.testing.assert_allclose(out[:, :-1, :-2], im[:, 1:, 2:], atol=1e-5)
+    assert not out[:, -1:].any() and not out[..., -2:].any()
+    # with a voxel size, the translation is in world units
+    tmat[:3, 3] = [0.2, 0, 1]
+    out = arrayfun.affine_cpu(im, tmat, dzyx=[0.5, 0.1, 0.1])
+    np.testing.assert_allclose(out[:-2, :, :-2], im[2:, :, 2:], atol=1e-5)
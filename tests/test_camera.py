@@ -0,0 +1,67 @@
+import numpy as np
+
+from scipy.ndimage import median_filter
+
+from llspy.camera import CameraParameters, flash_correct, selectiveMedianFilter
+
+
+def make_camparams(ny=32, nx=40):
+    rng = np.random.RandomState(0)
+    data = np.stack([rng.uniform(0, 50, (ny, nx)), rng.uniform(0, 0.05, (ny, nx)),
+                     rng.uniform(90, 110, (ny, nx))])
+    return CameraParameters(data=data, roi=[1, 1, ny, nx])
+
+
+def test_flash_correct_matches_numpy():
+    camparams = make_camparams()
+    assert camparams.data.dtype == np.float32
+    rng = np.random.RandomState(1)
+    stacks = [rng.poisson(300, (10, 32, 40)).astype(np.uint16) for _ in range(3)]
+    trim = ((1, 0), (2, 1), (1, 3))
+    ref = camparams.correct_stacks(stacks, trim=trim, flashCorrectTarget='numpy')
+    out = camparams.correct_stacks(stacks, trim=trim, flashCorrectTarget='cpu')
+    for r, o in zip(ref, out):
+        assert o.dtype == np.uint16 and o.shape == r.shape == (9, 29, 36)
+        assert np.abs(o.astype(int) - r).max() <= 1
+
+
+def test_flash_correct_inplace():
+    camparams = make_camparams()
+    stack = np.random.RandomState(2).poisson(300, (6, 32, 40)).astype(np.uint16)
+    expected = flash_correct(stack, camparams.a, camparams.b, camparams.offset)
+    out = flash_correct(stack, camparams.a, camparams.b, camparams.offset, inplace=True)
+    assert out is stack
+    np.testing.assert_array_equal(out, expected)
+
+
+def test_correct_stacks_returns_views():
+    from llspy.camera import _correct_stacks_copying
+    camparams = make_camparams()
+    rng = np.random.RandomState(3)
+    stacks = [rng.poisson(300, (5, 32, 40)).astype(np.uint16) for _ in range(3)]
+    out = camparams.correct_stacks(stacks)
+    # channels interleave plane by plane in one buffer
+    assert all(np.may_share_memory(out[0], o) for o in out[1:])
+    for o, ref in zip(out, _correct_stacks_copying(camparams, stacks)):
+        np.testing.assert_array_equal(o, ref)
+
+
+def test_selective_median_filter():
+    rng = np.random.RandomState(4)
+    stack = rng.poisson(100, (8, 30, 40)).astype(np.uint16)
+    # noisy pixels, including on the edges
+    for y, x in [(0, 0), (5, 7), (29, 20), (12, 39)]:
+        stack[::2, y, x] = 3000
+    cache = {}
+    out, (distances, threshold) = selectiveMedianFilter(stack, 0, cache=cache)
+    mask = distances > threshold
+    assert mask[5, 7] and mask[0, 0] and mask[29, 20] and mask[12, 39]
+    expected = stack.copy()
+    for z in range(stack.shape[0]):
+        filtered = median_filter(stack[z].astype(np.float32), 3)
+        expected[z][mask] = filtered[mask]
+    np.testing.assert_array_equal(out, expected)
+    # the cached mask is reused, even if the next stack looks different
+    out2, (distances2, _) = selectiveMedianFilter(stack[:4], 0, cache=cache)
+    assert len(cache) == 1 and distances2 is distances
+    np.testing.assert_array_equal(out2, expected[:4])
@@ -0,0 +1,57 @@
+import os
+
+import numpy as np
+import pytest
+
+from llspy import cpudecon
+from llspy.exceptions import OTFError, ParametersError
+
+TESTSDIR = os.path.dirname(os.path.abspath(__file__))
+OTF = os.path.join(TESTSDIR, "testdata", "otfs", "488_otf.tif")
+
+
+def test_read_otf():
+    otf = cpudecon.read_otf(OTF)
+    # file is (nr, 2 * nz) with interleaved complex values
+    assert otf.shape == (61, 65)
+    assert otf.dtype == np.complex64
+    assert np.isclose(otf[0, 0], 1)
+
+
+def test_otf_cache_and_normalization():
+    shape = (32, 64, 64)
+    otf = cpudecon.get_otf(OTF, shape, 0.2, 0.104)
+    assert otf.shape == (32, 64, 33)
+    assert np.isclose(np.abs(otf[0, 0, 0]), 1)
+    assert cpudecon.get_otf(OTF, shape, 0.2, 0.104) is otf
+    assert cpudecon.get_plan(shape) is cpudecon.get_plan(shape)
+
+
+def test_richardson_lucy_sharpens():
+    shape = (32, 64, 64)
+    otf = cpudecon.get_otf(OTF, shape, 0.2, 0.104)
+    plan = cpudecon.get_plan(shape)
+    truth = np.ones(shape, np.float32)
+    truth[16, 32, 28] = truth[16, 32, 36] = 5000
+    blurred = np.maximum(plan.irfftn(plan.rfftn(truth) * otf), 0)
+    result = cpudecon.richardson_lucy(blurred, otf, 10, plan)
+    assert result.dtype == np.float32
+    assert result[16, 32, 28] > 3 * blurred[16, 32, 28]
+    assert np.isclose(result.sum(), blurred.sum(), rtol=0.05)
+
+
+def test_decon_deskew_shapes():
+    raw = np.random.poisson(100, (20, 32, 40)).astype(np.uint16)
+    decon, deskewed = cpudecon.decon(
+        raw, OTF, dzdata=0.4, deskew=31.5, nIters=2, background=90, savedeskew=True
+    )
+    assert decon.shape == deskewed.shape == (20, 32, 40 + 65)
+    assert decon.dtype == np.float32
+
+
+def test_decon_rejects_bad_options():
+    raw = np.zeros((8, 16, 16), np.uint16)
+    with pytest.raises(ParametersError):
+        cpudecon.decon(raw, OTF, deskew=31.5, rotate=31.5)
+    with pytest.raises(OTFError):
+        cpudecon.decon(raw, None, nIters=2)
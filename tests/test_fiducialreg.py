@@ -0,0 +1,169 @@
+import numpy as np
+import pytest
+from scipy import ndimage
+
+from fiducialreg.fiducialreg import (
+    CloudSet,
+    CPDrigid,
+    CPDsimilarity,
+    FiducialCloud,
+    GaussFitter3D,
+    count_objects,
+    get_closest_points,
+    get_mutual_matches,
+    get_thresh,
+)
+
+
+@pytest.fixture
+def beads():
+    rng = np.random.RandomState(0)
+    shape = (24, 64, 64)
+    Z, Y, X = np.mgrid[: shape[0], : shape[1], : shape[2]]
+    im = np.full(shape, 100.0)
+    centers = np.column_stack(
+        [rng.uniform(5, 19, 20), rng.uniform(5, 59, 20), rng.uniform(5, 59, 20)]
+    )
+    for z, y, x in centers:
+        amp = rng.uniform(500, 2000)
+        r2 = ((X - x) ** 2 + (Y - y) ** 2) / (2 * 1.5**2)
+        im += amp * np.exp(-r2 - (Z - z) ** 2 / (2 * 2.0**2))
+    im = rng.poisson(im).astype(np.float32)
+    labeled = ndimage.label(im > 400)[0]
+    return im, ndimage.find_objects(labeled)
+
+
+def test_batched_gauss_fit(beads):
+    im, objects = beads
+    fitter = GaussFitter3D(im, dz=0.3, dx=0.1)
+    single = [fitter[key] for key in objects]
+    # small batches of mixed ROI shapes, to exercise the padding
+    tiny = (slice(2, 3), slice(4, 6), slice(4, 6))
+    batched = fitter.fit_all(objects[:3] + [tiny] + objects[3:], batchsize=7)
+    # too few voxels for the 7 fit parameters
+    with pytest.raises(TypeError):
+        fitter[tiny]
+    assert batched.pop(3) is None
+    assert len(batched) == len(single)
+    for s, b in zip(single, batched):
+        np.testing.assert_allclose(
+            [b.x(0), b.y(0), b.z(0)], [s.x(0), s.y(0), s.z(0)], atol=1e-3
+        )
+        np.testing.assert_allclose(b.fitResults, s.fitResults, rtol=1e-3, atol=1e-3)
+
+
+def test_batched_gauss_fit_processes(beads):
+    im, objects = beads
+    fitter = GaussFitter3D(im, dz=0.3, dx=0.1)
+    serial = fitter.fit_all(objects, batchsize=5)
+    pooled = fitter.fit_all(objects, batchsize=5, processes=2)
+    for s, p in zip(serial, pooled):
+        np.testing.assert_allclose(p.fitResults, s.fitResults)
+
+
+@pytest.fixture
+def clouds():
+    rng = np.random.RandomState(1)
+    # beads on a jittered grid, much further apart than the channel shift
+    grid = np.mgrid[:15, :15, :14].reshape(3, -1) * 30.0
+    fixed = grid + rng.uniform(-5, 5, grid.shape)
+    order = rng.permutation(fixed.shape[1])
+    moving = fixed[:, order] + [[1.5], [-0.7], [0.3]] + rng.normal(0, 0.05, fixed.shape)
+    # beads only detected in one channel
+    moving = np.hstack([moving, rng.uniform(520, 600, (3, 50))])
+    return fixed, moving, order
+
+
+def test_closest_points(clouds):
+    fixed, moving, _ = clouds
+    nn = get_closest_points(fixed[:, :200], moving)
+    d = ((moving.T[None] - fixed[:, :200].T[:, None]) ** 2).sum(-1)
+    np.testing.assert_allclose(nn[:, 0], d.min(1))
+    np.testing.assert_array_equal(nn[:, 1], d.argmin(1))
+
+
+def test_mutual_matches(clouds):
+    fixed, moving, order = clouds
+    m1, m2 = get_mutual_matches(fixed, moving)
+    assert m1.shape == m2.shape
+    # a few pairs fall in the tail of the default distance cutoff
+    assert 0.98 * fixed.shape[1] < m1.shape[1] <= fixed.shape[1]
+    # every pair is a bead and its shifted copy
+    assert np.abs(m2 - m1 - [[1.5], [-0.7], [0.3]]).max() < 0.5
+    # an explicit cutoff rejects all pairs further apart
+    m1, m2 = get_mutual_matches(fixed, moving, maxd=0.5)
+    assert not m1.shape[1]
+
+
+def test_cloudset_matching(clouds):
+    fixed, moving, _ = clouds
+    cs = CloudSet()
+    cs.N = 3
+    cs.clouds = [FiducialCloud(), FiducialCloud(), FiducialCloud()]
+    for cloud, coords in zip(cs.clouds, (fixed, moving, moving[:, ::-1] - 1)):
+        cloud.coords = coords
+    matched = cs.matching()
+    assert len({c.shape for c in matched}) == 1
+    assert np.abs(matched[1] - matched[0] - [[1.5], [-0.7], [0.3]]).max() < 0.5
+    np.testing.assert_allclose(matched[2], matched[1] - 1)
+
+
+def _cpd_clouds(n=400):
+    rng = np.random.RandomState(2)
+    X = rng.uniform(0, 50, (n, 3))
+    th = 0.05
+    R = np.array([[np.cos(th), -np.sin(th), 0], [np.sin(th), np.cos(th), 0], [0, 0, 1]])
+    Y = np.dot(X - [0.5, -0.3, 0.2], R) + rng.normal(0, 0.02, X.shape)
+    return X, Y
+
+
+def test_cpd_estep():
+    X, Y = _cpd_clouds(100)
+    reg = CPDrigid(X, Y[:80], w=0.1, blocksize=1000)
+    reg.initialize()
+    reg.sigma2 = 20.0
+    reg.EStep()
+    # reference: the full matrix of correspondence probabilities
+    d2 = ((X[None] - reg.TY[:, None]) ** 2).sum(-1)
+    P = np.exp(-d2 / (2 * reg.sigma2))
+    c = (2 * np.pi * reg.sigma2) ** 1.5 * 0.1 / 0.9 * 80 / 100
+    P /= P.sum(0) + c
+    np.testing.assert_allclose(reg.P1, P.sum(1))
+    np.testing.assert_allclose(reg.Pt1, P.sum(0))
+    np.testing.assert_allclose(reg.PX, np.dot(P, X))
+    # only pairs within 4 sigma are evaluated with the KD-tree
+    reg._sparse_estep(4 * np.sqrt(reg.sigma2), c)
+    np.testing.assert_allclose(reg.PX, np.dot(P, X), atol=1e-2)
+
+
+@pytest.mark.parametrize('options', [{}, {'dtype': np.float32, 'truncate': 3}])
+def test_cpd_registration(options):
+    X, Y = _cpd_clouds()
+    exact = CPDsimilarity(X, Y).register(None)[4]
+    reg = CPDsimilarity(X, Y, blocksize=5000, **options)
+    np.testing.assert_allclose(reg.register(None)[4], exact, atol=1e-2)
+    th = 0.05
+    expected = [[np.cos(th), -np.sin(th)], [np.sin(th), np.cos(th)]]
+    np.testing.assert_allclose(exact[:2, :2], expected, atol=1e-3)
+    np.testing.assert_allclose(exact[:3, 3], [0.5, -0.3, 0.2], atol=0.05)
+
+
+def test_count_objects():
+    rng = np.random.RandomState(3)
+    im = ndimage.gaussian_filter(rng.rand(60, 70), 1.5)
+    # unsorted thresholds, including some below and above all pixels
+    thresholds = np.concatenate([rng.uniform(im.min(), im.max(), 30), [-1, 2]])
+    expected = [ndimage.label(im > t)[1] for t in thresholds]
+    np.testing.assert_array_equal(count_objects(im, thresholds), expected)
+    # ties between pixels and thresholds
+    im = rng.randint(0, 4, (30, 40)).astype(np.uint16)
+    thresholds = np.arange(-1, 5)
+    expected = [ndimage.label(im > t)[1] for t in thresholds]
+    np.testing.assert_array_equal(count_objects(im, thresholds), expected)
+
+
+def test_get_thresh(beads):
+    im, _ = beads
+    thresh, count = get_thresh(im, mincount=10)
+    assert count == len(ndimage.find_objects(ndimage.label(im.max(0) > thresh)[0]))
+    assert count >= 10
@@ -1,5 +1,14 @@
 import os
 import hashlib
+import shutil
+import tarfile
+
+import numpy as np
+import pytest
+import tifffile
+
+import llspy
+from llspy import batch
 
 def sha1OfFile(filepath):
     sha = hashlib.sha1()
@@ -18,4 +27,373 @@ def hash_dir(dir_path):
         for dir in sorted(dirs): # we sort to guarantee that dirs will always go in the same order
             hashes.append(hash_dir(os.path.join(path, dir)))
         break # we only need one iteration - to get files and dirs in current directory
-    return str(hash(''.join(hashes)))
\ No newline at end of file
+    return str(hash(''.join(hashes)))
+
+TESTSDIR = os.path.dirname(os.path.abspath(__file__))
+OTFDIR = os.path.join(TESTSDIR, 'testdata', 'otfs')
+FNAME = 'cell_ch{}_stack{:04d}_{}nm_{:07d}msec_{:010d}msecAbs.tif'
+
+
+@pytest.fixture
+def llsdir(tmp_path):
+    """small synthetic two-channel, three-timepoint sample-scan dataset"""
+    rng = np.random.RandomState(0)
+    for t in range(3):
+        for c, w in enumerate((488, 642)):
+            im = rng.poisson(100, (12, 32, 40)).astype(np.uint16)
+            im[6, 16, 20] = 2000
+            name = FNAME.format(c, t, w, t * 1000, 5000 + t * 1000)
+            tifffile.imwrite(str(tmp_path / name), im)
+    shutil.copy(os.path.join(TESTSDIR, 'testdata', 'sample', 'sample_Settings.txt'),
+                str(tmp_path / 'cell_Settings.txt'))
+    return tmp_path
+
+
+def test_process_stream(llsdir):
+    E = llspy.LLSdir(str(llsdir))
+    llspy.process(E, nIters=2, background=90, otfDir=OTFDIR, streaming=True,
+                  deconBackend='cpu', MIP=(0, 0, 1), saveDeskewedRaw=True)
+    decon = [f for f in os.listdir(str(llsdir / 'GPUdecon')) if f.endswith('.tif')]
+    assert len(decon) == 6 and all(f.endswith('_decon.tif') for f in decon)
+    deskewed = sorted(os.listdir(str(llsdir / 'Deskewed')))
+    assert len([f for f in deskewed if f.endswith('_deskewed.tif')]) == 6
+    # MIPs are merged in memory into TCYX hyperstacks, named like mergemips()
+    mip = tifffile.imread(str(llsdir / 'GPUdecon' / 'MIPs' / 'cell_decon_comboMIP_z.tif'))
+    assert mip.shape[:2] == (3, 2)
+    stack = tifffile.imread(str(llsdir / 'GPUdecon' / decon[0]))
+    assert stack.dtype == np.uint16
+    assert stack.shape[-1] == mip.shape[-1]
+    # no intermediate corrected files are written
+    assert not (llsdir / 'Corrected').exists()
+
+
+def test_process_stream_unsupported(llsdir):
+    E = llspy.LLSdir(str(llsdir))
+    P = E.localParams(nIters=2, background=90, otfDir=OTFDIR, deconBackend='cpu',
+                      bRotate=True)
+    with pytest.raises(llspy.exceptions.ParametersError):
+        llspy.llsdir.process_stream(E, P)
+    P = E.localParams(nIters=0, background=90, otfDir=OTFDIR, deconBackend='cpu')
+    with pytest.raises(llspy.exceptions.ParametersError):
+        llspy.llsdir.process_stream(E, P)
+
+
+def test_llsdir_index(llsdir, monkeypatch):
+    E = llspy.LLSdir(str(llsdir))
+    indexfile = llsdir / llspy.config.__INDEXFILE__
+    assert indexfile.exists()
+
+    # an unchanged folder is restored from the index without scanning tiffs
+    def noscan(self):
+        raise AssertionError('folder should not be rescanned')
+
+    monkeypatch.setattr(llspy.LLSdir, '_get_all_tiffs', noscan)
+    E2 = llspy.LLSdir(str(llsdir))
+    assert E2.parameters == E.parameters
+    assert dict(E2.tiff) == dict(E.tiff)
+    assert E2.get_files(c=1, t=2) == E.get_files(c=1, t=2)
+    monkeypatch.undo()
+
+    # adding files invalidates the index
+    name = FNAME.format(0, 3, 488, 3000, 8000)
+    tifffile.imwrite(str(llsdir / name), np.zeros((12, 32, 40), np.uint16))
+    E3 = llspy.LLSdir(str(llsdir))
+    assert E3.parameters.tset == [0, 1, 2, 3]
+
+    # so does a rename that leaves the directory mtime unchanged
+    st = os.stat(str(llsdir))
+    os.rename(str(llsdir / name), str(llsdir / name.replace('stack0003', 'stack0004')))
+    os.utime(str(llsdir), ns=(st.st_atime_ns, st.st_mtime_ns))
+    assert llspy.LLSdir(str(llsdir)).parameters.tset == [0, 1, 2, 4]
+
+    # compress() drops the index before archiving the tiffs
+    E3._remove_index()
+    assert not indexfile.exists()
+
+
+def test_llsdir_noindex(llsdir):
+    E = llspy.LLSdir(str(llsdir), useindex=False)
+    assert E.parameters.nc == 2
+    assert not (llsdir / llspy.config.__INDEXFILE__).exists()
+
+
+def test_flash_correction_pool(llsdir, tmp_path_factory):
+    from llspy.camera import CameraParameters
+    from llspy.llsdir import FlashCorrectionPool, correctTimepoint, get_flash_pool
+    # a numba parallel kernel running first used to deadlock forked workers
+    llspy.arrayfun.deskew_cpu(np.zeros((4, 8, 8), np.float32), 0.3, 0.1, 31.5)
+    rng = np.random.RandomState(1)
+    data = np.stack([rng.uniform(0, 20, (32, 40)), rng.uniform(0, 0.1, (32, 40)),
+                     rng.uniform(90, 110, (32, 40))]).astype(np.float32)
+    camparams = CameraParameters(data=data, roi=[1, 1, 32, 40])
+    E = llspy.LLSdir(str(llsdir))
+    groups = [E.get_t(t) for t in E.parameters.tset]
+    serial = tmp_path_factory.mktemp('serial')
+    parallel = tmp_path_factory.mktemp('parallel')
+    for g in groups:
+        correctTimepoint(g, camparams, serial, False, (0, 0), (0, 0), (0, 0))
+    # pool workers reuse their writer threads between timepoints
+    worker = tmp_path_factory.mktemp('worker')
+    writers = set()
+    for g in groups:
+        llspy.llsdir._correct_in_worker(g, camparams, worker, False, (0, 0), (0, 0), (0, 0))
+        writers.add(id(llspy.llsdir._workerWriter))
+    assert len(writers) == 1
+    assert sorted(os.listdir(str(worker))) == sorted(os.listdir(str(serial)))
+    progress = []
+    llspy.procpool.configure(processes=2)
+    with FlashCorrectionPool(camparams, maxInFlight=2) as pool:
+        pool.correct(groups, parallel, callback=lambda *a: progress.append(a))
+        # the same pool serves further runs
+        assert pool.correct(groups[:1], parallel) == 2
+    assert progress == [(n, 6) for n in range(1, 7)]
+    for f in os.listdir(str(serial)):
+        assert np.array_equal(tifffile.imread(str(serial / f)),
+                              tifffile.imread(str(parallel / f)))
+    # workers and shared memory are reused between folders
+    workers = llspy.procpool.get_pool()
+    pool = get_flash_pool(camparams)
+    assert get_flash_pool(camparams) is pool
+    pool.correct(groups[:1], parallel)
+    E.median_and_trim(tRange=[0], cRange=range(2), background=[90, 90])
+    assert llspy.procpool.get_pool() is workers and get_flash_pool(camparams) is pool
+    for _ in range(3):
+        llspy.llsdir.release_flash_pool(pool)
+    llspy.llsdir.close_flash_pool()
+    llspy.procpool.configure()
+
+
+def test_concurrent_flash_correction(llsdir, tmp_path_factory):
+    import threading
+
+    from llspy.camera import CameraParameters
+    from llspy.llsdir import correctTimepoint
+
+    other = tmp_path_factory.mktemp('other')
+    for f in os.listdir(str(llsdir)):
+        shutil.copy(str(llsdir / f), str(other / f))
+    rng = np.random.RandomState(2)
+    runs = []
+    for path in (llsdir, other):
+        data = np.stack([rng.uniform(0, 20, (32, 40)), rng.uniform(0, 0.1, (32, 40)),
+                         rng.uniform(90, 110, (32, 40))]).astype(np.float32)
+        camparams = CameraParameters(data=data, roi=[1, 1, 32, 40])
+        E = llspy.LLSdir(str(path))
+        E.settings.camera.roi = camparams.roi
+        runs.append((E, camparams, []))
+
+    llspy.procpool.configure(processes=2)
+    # each run uses its own camera parameters, so its own shared memory
+    threads = [
+        threading.Thread(target=E.correct_flash, kwargs=dict(
+            camparamsPath=camparams, callback=lambda *a, p=progress: p.append(a)))
+        for E, camparams, progress in runs
+    ]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(llspy.llsdir._flashPools) == 2
+    llspy.llsdir.close_flash_pool()
+    assert not llspy.llsdir._flashPools
+    llspy.procpool.configure()
+
+    for E, camparams, progress in runs:
+        # progress messages are not taken by the other run
+        assert progress == [(n, 6) for n in range(1, 7)]
+        serial = tmp_path_factory.mktemp('serial')
+        for t in E.parameters.tset:
+            correctTimepoint(E.get_t(t), camparams, serial, False, (0, 0), (0, 0),
+                             (0, 0))
+        for f in os.listdir(str(serial)):
+            assert np.array_equal(tifffile.imread(str(serial / f)),
+                                  tifffile.imread(str(E.path / 'Corrected' / f)))
+
+
+def test_compress_archive(llsdir):
+    tiffs = sorted(f for f in os.listdir(str(llsdir)) if f.endswith('.tif'))
+    hashes = {f: sha1OfFile(str(llsdir / f)) for f in tiffs}
+    expected = tifffile.imread(str(llsdir / tiffs[0]))
+    E = llspy.LLSdir(str(llsdir))
+    archive = E.compress(compression='llsz')
+    assert archive.endswith('.llsz') and E.is_compressed()
+    assert not [f for f in os.listdir(str(llsdir)) if f.endswith('.tif')]
+
+    A = llspy.compress.Archive(archive)
+    assert A.names == tiffs
+    np.testing.assert_array_equal(A.imread(tiffs[0]), expected)
+    with pytest.raises(llspy.exceptions.CompressionError):
+        A.read('missing.tif')
+
+    # partial decompression only extracts the requested timepoint
+    E.decompress_partial(tRange=[1])
+    partial = sorted(f for f in os.listdir(str(llsdir)) if f.endswith('.tif'))
+    assert partial == [f for f in tiffs if 'stack0001' in f]
+    assert os.path.exists(archive)
+    [os.remove(str(llsdir / f)) for f in partial]
+
+    E.decompress()
+    assert not os.path.exists(archive)
+    assert {f: sha1OfFile(str(llsdir / f)) for f in tiffs} == hashes
+    assert len(E.tiff.raw) == 6
+
+
+@pytest.mark.parametrize('streaming', [False, True])
+def test_resume_from_journal(llsdir, streaming):
+    opts = dict(nIters=0, saveDeskewedRaw=True, otfDir=OTFDIR, deconBackend='cpu',
+                streaming=streaming, rMIP=(0, 0, 1))
+    llspy.process(llspy.LLSdir(str(llsdir)), **opts)
+    journal = llspy.journal.Journal(str(llsdir))
+    assert journal.pending(llspy.LLSdir(str(llsdir)).localParams(**opts)) == {0: [], 1: []}
+
+    deskewed = sorted((llsdir / 'Deskewed').glob('*_deskewed.tif'))
+    assert len(deskewed) == 6
+    mtimes = {f: os.stat(str(f)).st_mtime_ns for f in deskewed}
+    # an interrupted run: one stack was never written, one was cut short
+    os.remove(str(deskewed[0]))
+    with open(str(deskewed[1]), 'r+b') as f:
+        f.truncate(100)
+
+    llspy.process(llspy.LLSdir(str(llsdir)), **opts)
+    assert all(f.is_file() for f in deskewed)
+    assert os.path.getsize(str(deskewed[1])) > 100
+    # streaming redoes all channels of an unfinished timepoint
+    finished = [f for f in deskewed if 'stack0002' in f.name]
+    assert all(os.stat(str(f)).st_mtime_ns == mtimes[f] for f in finished)
+
+    # different parameters make the journal entries stale
+    llspy.process(llspy.LLSdir(str(llsdir)), **dict(opts, background=50))
+    assert all(os.stat(str(f)).st_mtime_ns != mtimes[f] for f in finished)
+
+
+def test_stage_cache_reuse(llsdir, tmp_path_factory, monkeypatch, caplog):
+    monkeypatch.setattr(llspy.config, '__CACHEDIR__', str(tmp_path_factory.mktemp('cache')))
+    calls = []
+    deconvolve = llspy.llsdir.deconvolve_stacks
+    monkeypatch.setattr(llspy.llsdir, 'deconvolve_stacks',
+                        lambda *a, **k: calls.append(1) or deconvolve(*a, **k))
+    opts = dict(nIters=0, saveDeskewedRaw=True, otfDir=OTFDIR, deconBackend='cpu',
+                streaming=True, stageCache=True, resume=False, rMIP=(0, 0, 1))
+    llspy.process(llspy.LLSdir(str(llsdir)), **opts)
+    assert len(calls) == 3
+    name = sorted((llsdir / 'Deskewed').glob('*.tif'))[0].name
+    first = tifffile.imread(str(llsdir / 'Deskewed' / name))
+
+    # only MIP settings changed: the deskewed stacks come from the cache
+    llspy.process(llspy.LLSdir(str(llsdir)), **dict(opts, rMIP=(1, 1, 1)))
+    assert len(calls) == 3
+    np.testing.assert_array_equal(
+        tifffile.imread(str(llsdir / 'Deskewed' / name)), first)
+    assert len(list((llsdir / 'Deskewed' / 'MIPs').glob('*comboMIP_x.tif'))) == 1
+
+    # upstream parameters changed: recomputed
+    llspy.process(llspy.LLSdir(str(llsdir)), **dict(opts, background=50))
+    assert len(calls) == 6
+
+    # the staged pipeline does not use the cache, which is not silently ignored
+    llspy.process(llspy.LLSdir(str(llsdir)), **dict(opts, streaming=False))
+    assert 'stage cache is only used when streaming' in caplog.text
+
+
+def test_batch_scheduler(llsdir, tmp_path_factory):
+    second = tmp_path_factory.mktemp('second')
+    for f in os.listdir(str(llsdir)):
+        shutil.copy(str(llsdir / f), str(second / f))
+    llspy.LLSdir(str(second)).compress(compression='llsz')
+    jobs = [(llspy.LLSdir(str(d)), dict(nIters=0, saveDeskewedRaw=True, otfDir=OTFDIR,
+                                       deconBackend='cpu', compressRaw=True,
+                                       compressionType='llsz'))
+            for d in (llsdir, second)]
+    done = []
+    report = batch.BatchScheduler(cpu=1, gpus=0, disk=1).run(
+        jobs, callback=lambda E, error: done.append((str(E.path), error)))
+    assert not report.errors
+    assert sorted(done) == sorted((str(d), None) for d in (llsdir, second))
+    for d in (llsdir, second):
+        # compressed archives are extracted, processed and compressed again
+        assert len(list(d.glob('*.llsz'))) == 1
+        assert not [f for f in os.listdir(str(d)) if f.endswith('.tif')]
+        assert len(os.listdir(str(d / 'Deskewed'))) == 6
+    assert report.nbytes > 0 and report.elapsed > 0
+    assert report.busy['decompress'] > 0 and report.busy['compress'] > 0
+    assert 'MB/s' in report.summary()
+
+
+def test_read_from_archive(llsdir):
+    tiffs = sorted(f for f in os.listdir(str(llsdir)) if f.endswith('.tif'))
+    expected = tifffile.imread(str(llsdir / tiffs[-1]))
+    llspy.LLSdir(str(llsdir)).compress(compression='llsz')
+
+    # indexed archives are opened on creation and nothing is extracted
+    E = llspy.LLSdir(str(llsdir))
+    assert E.archive is not None and E.ready_to_process
+    assert E.parameters.nc == 2 and E.parameters.tset == [0, 1, 2]
+    assert E.parameters.shape == expected.shape
+    np.testing.assert_array_equal(E.imread(E.get_files(c=1, t=2)[0]), expected)
+    out = llspy.preview(E, tR=[0, 1], nIters=0, background=90, deconBackend='cpu')
+    assert out.shape[:2] == (2, 2)
+    llspy.process(E, nIters=0, saveDeskewedRaw=True, background=90, streaming=True,
+                  deconBackend='cpu', MIP=(0, 0, 0), rMIP=(0, 0, 0), writeLog=False)
+    assert len(os.listdir(str(llsdir / 'Deskewed'))) == 6
+    assert not [f for f in os.listdir(str(llsdir)) if f.endswith('.tif')]
+
+    # tarballs are read through the same interface
+    E.decompress()
+    with tarfile.open(str(llsdir / 'cell_RAW.tar.bz2'), 'w:bz2') as tar:
+        for f in tiffs:
+            tar.add(str(llsdir / f), arcname=f)
+            os.remove(str(llsdir / f))
+    E = llspy.LLSdir(str(llsdir))
+    assert E.archive is None and E.is_compressed()
+    archive = E.open_archive()
+    assert isinstance(archive, llspy.compress.TarArchive)
+    assert len(E.get_files()) == 6
+    np.testing.assert_array_equal(E.imread(E.get_files(c=1, t=2)[0]), expected)
+    # members are read in one forward pass, earlier ones are kept until read
+    assert archive._skipped
+    stacks = [E.imread(f) for f in E.get_files()]
+    assert not archive._skipped
+    # a member that was not kept restarts the stream
+    archive.maxbuffer = 0
+    np.testing.assert_array_equal(E.imread(E.get_files(c=0, t=0)[0]), stacks[0])
+    E.close_archive()
+
+    # without streaming, tarballs are extracted as before
+    llspy.process(E, nIters=0, saveDeskewedRaw=True, background=90,
+                  deconBackend='cpu', MIP=(0, 0, 0), rMIP=(0, 0, 0),
+                  writeLog=False, reprocess=True, compressRaw=False)
+    assert E.archive is None
+    assert len([f for f in os.listdir(str(llsdir)) if f.endswith('.tif')]) == 6
+
+
+def test_registration_cache(tmp_path, monkeypatch):
+    from llspy import llsdir as lld
+
+    tform = np.eye(4)
+    tform[:3, 3] = [-1, 0, 0]
+    regfile = tmp_path / 'reg.json'
+    regfile.write_text(
+        '{"tforms": [{"reference": 488, "moving": 560, "mode": "2step", '
+        '"tform": %s}]}' % tform.tolist()
+    )
+    lld.clear_registration_cache()
+    regObj = lld.get_regObj(str(regfile))
+    assert lld.get_regObj(str(regfile)) is regObj
+
+    calls = []
+    get_tform = type(regObj).get_tform
+    monkeypatch.setattr(
+        type(regObj),
+        'get_tform',
+        lambda self, *a: calls.append(a) or get_tform(self, *a),
+    )
+    im = np.random.rand(4, 6, 8).astype(np.float32)
+    for _ in range(3):
+        out = lld.register_image_to_wave(im, regObj, 560, 488)
+    assert len(calls) == 1
+    np.testing.assert_allclose(out[..., :-1], im[..., 1:], atol=1e-5)
+
+    # rewriting the calibration invalidates the cache
+    os.utime(str(regfile), ns=(0, 0))
+    assert lld.get_regObj(str(regfile)) is not regObj
+    lld.clear_registration_cache()
@@ -0,0 +1,57 @@
+import os
+from datetime import datetime
+
+import pytest
+
+from llspy import otf
+from llspy.exceptions import OTFError
+
+OTFNAME = '{}_488_totPSF_mb_0p5-0p42_otf.tif'
+
+
+@pytest.fixture
+def otfdir(tmp_path, monkeypatch):
+    for date in ('20160825', '20170101'):
+        (tmp_path / OTFNAME.format(date)).write_bytes(b'')
+    (tmp_path / '488_otf.tif').write_bytes(b'')
+    otf.clear_otf_cache()
+    listings = []
+    listdir = os.listdir
+    monkeypatch.setattr(os, 'listdir', lambda p: listings.append(p) or listdir(p))
+    return tmp_path, listings
+
+
+def test_choose_otf_scans_once(otfdir):
+    otfdir, listings = otfdir
+    mask = (0.42, 0.5)
+    old = otf.choose_otf(488, str(otfdir), datetime(2016, 9, 1), mask)
+    assert old == str(otfdir / OTFNAME.format('20160825'))
+    new = otf.choose_otf(488, str(otfdir), datetime(2017, 2, 1), mask)
+    assert new == str(otfdir / OTFNAME.format('20170101'))
+    assert otf.choose_otf(488, str(otfdir), datetime(2017, 2, 1), mask) == new
+    # unknown masks fall back to the default OTF
+    assert otf.choose_otf(490, str(otfdir), datetime(2017, 2, 1)) == str(
+        otfdir / '488_otf.tif')
+    assert otf.dir_has_otfs(str(otfdir))
+    assert len(listings) == 1
+
+
+def test_otf_catalog_follows_directory_changes(otfdir):
+    otfdir, listings = otfdir
+    mask = (0.42, 0.5)
+    date = datetime(2018, 1, 1)
+    assert otf.choose_otf(488, str(otfdir), date, mask).endswith(
+        OTFNAME.format('20170101'))
+    (otfdir / OTFNAME.format('20171231')).write_bytes(b'')
+    st = os.stat(str(otfdir))
+    os.utime(str(otfdir), ns=(st.st_atime_ns, st.st_mtime_ns + 10**9))
+    assert otf.choose_otf(488, str(otfdir), date, mask).endswith(
+        OTFNAME.format('20171231'))
+    assert len(listings) == 2
+
+
+def test_invalid_otf_dir(tmp_path):
+    assert not otf.dir_has_otfs(str(tmp_path / 'missing'))
+    assert otf.get_otf_dict(str(tmp_path / 'missing')) == {}
+    with pytest.raises(OTFError):
+        otf.choose_otf(488, str(tmp_path))
@@ -24,3 +24,27 @@ class FilenameTests(unittest.TestCase):
 	def test_gen_filename(self):
 		p = parse.gen_filename(self.dict)
 		self.assertEqual(p, self.example_name)
+
+
+class FileTableTests(unittest.TestCase):
+
+	def setUp(self):
+		self.files = [parse.gen_filename({'basename': 'cell5', 'channel': c,
+			'stack': t, 'wave': w, 'reltime': t * 1000, 'abstime': 2000 + t})
+			for t in range(5) for c, w in enumerate((488, 560, 642))]
+		self.table = parse.FileTable(self.files)
+
+	def test_matches_filter_files(self):
+		queries = [{'t': 3}, {'t': [4, 1]}, {'c': 1}, {'c': (2, 0), 't': range(3)},
+			{'w': 560}, {'w': '642nm'}, {'reltime': (1000, 3000)}, {'t': 7}]
+		for q in queries:
+			self.assertEqual(self.table.filter(**q),
+				parse.filter_files(self.files, **q))
+			self.assertEqual(self.table.filter(exclusive=True, **q),
+				parse.filter_files(self.files, exclusive=True, **q))
+
+	def test_from_columns(self):
+		table = parse.FileTable(self.files, columns=self.table.to_dict())
+		self.assertEqual(table.filter(c=0, t=2), self.table.filter(c=0, t=2))
+		with self.assertRaises(ValueError):
+			parse.FileTable(self.files[1:], columns=self.table.to_dict())
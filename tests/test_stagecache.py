@@ -0,0 +1,52 @@
+import os
+import time
+
+import numpy as np
+
+from llspy.stagecache import StageCache, file_identity
+
+
+def test_stage_cache_roundtrip(tmp_path):
+    cache = StageCache(str(tmp_path), quota=1)
+    arr = np.arange(1000, dtype=np.float32).reshape(10, 100)
+    key = cache.key('decon', [1, 2], {'nIters': 10})
+    assert key == cache.key('decon', [1, 2], {'nIters': 10})
+    assert key != cache.key('decon', [1, 2], {'nIters': 11})
+    assert cache.get(key) is None
+    cache.put(key, arr)
+    np.testing.assert_array_equal(cache.get(key), arr)
+    assert cache.get_all([key, 'missing']) is None
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_stage_cache_evicts_least_recently_used(tmp_path):
+    cache = StageCache(str(tmp_path), quota=1)  # 1 MB
+    arr = np.zeros(75000, np.float32)  # three entries fit in the quota
+    for key in 'abc':
+        cache.put(key, arr)
+        time.sleep(0.01)
+    cache.get('a')  # 'b' is now the least recently used
+    time.sleep(0.01)
+    cache.put('d', arr)
+    assert cache.get('b') is None
+    assert all(cache.get(k) is not None for k in 'acd')
+    # entries larger than the quota are not stored
+    cache.put('e', np.zeros(2**20, np.uint8))
+    assert cache.get('e') is None
+
+
+def test_stage_cache_overwrite_keeps_size(tmp_path):
+    cache = StageCache(str(tmp_path), quota=1)
+    arr = np.zeros(1000, np.float32)
+    for _ in range(3):
+        cache.put('a', arr)
+    assert cache._size == os.path.getsize(cache._file('a'))
+
+
+def test_file_identity_changes_on_rewrite(tmp_path):
+    path = tmp_path / 'stack.tif'
+    path.write_bytes(b'1234')
+    ident = file_identity(str(path))
+    assert file_identity(str(path)) == ident
+    path.write_bytes(b'12345')
+    assert file_identity(str(path)) != ident
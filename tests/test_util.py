@@ -0,0 +1,73 @@
+import numpy as np
+import pytest
+import tifffile
+
+from llspy import arrayfun, util
+
+
+def test_imread_mmap_contiguous(tmp_path):
+    data = np.random.randint(0, 2000, (6, 16, 20)).astype(np.uint16)
+    path = str(tmp_path / 'raw.tif')
+    tifffile.imwrite(path, data)
+    im = util.imread_mmap(path)
+    assert isinstance(im, np.memmap)
+    assert not im.flags.writeable
+    np.testing.assert_array_equal(im, data)
+    np.testing.assert_array_equal(im[2], util.imread(path)[2])
+
+
+def test_imread_mmap_compressed_fallback(tmp_path):
+    data = np.random.randint(0, 2000, (6, 16, 20)).astype(np.uint16)
+    path = str(tmp_path / 'compressed.tif')
+    tifffile.imwrite(path, data, compression='zlib')
+    im = util.imread_mmap(path)
+    assert not isinstance(im, np.memmap)
+    np.testing.assert_array_equal(im, data)
+
+
+def test_detect_background():
+    im = np.full((4, 8, 8), 100, np.uint16)
+    im[1, :2] = 300
+    assert arrayfun.detect_background(im) == 100
+    assert arrayfun.detect_background(im.astype(np.float32)) == 100
+
+
+def test_async_writer(tmp_path):
+    data = np.random.randint(0, 2000, (3, 8, 8)).astype(np.uint16)
+    written = []
+    with util.AsyncWriter(nthreads=2, maxsize=1) as writer:
+        for i in range(4):
+            writer.save(data + i, str(tmp_path / '{}.tif'.format(i)),
+                        callback=written.append)
+    assert sorted(written) == sorted(str(tmp_path / '{}.tif'.format(i)) for i in range(4))
+    np.testing.assert_array_equal(util.imread(str(tmp_path / '3.tif')), data + 3)
+
+
+def test_async_writer_errors():
+    def fail():
+        raise IOError('disk full')
+
+    writer = util.AsyncWriter()
+    writer.submit(fail)
+    with pytest.raises(IOError):
+        writer.flush()
+    with pytest.raises(IOError):
+        writer.save(np.zeros((2, 2, 2)), 'never.tif')
+    with pytest.raises(IOError):
+        writer.close()
+
+
+def test_prefetch():
+    assert list(util.prefetch(lambda x: x * 2, range(5), depth=2)) == [
+        (0, 0), (1, 2), (2, 4), (3, 6), (4, 8)]
+
+    def read(x):
+        if x == 3:
+            raise IOError('unreadable')
+        return x
+
+    results = []
+    with pytest.raises(IOError):
+        for item, _ in util.prefetch(read, range(5)):
+            results.append(item)
+    assert results == [0, 1, 2]
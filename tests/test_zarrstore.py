@@ -0,0 +1,60 @@
+import os
+
+import numpy as np
+import pytest
+import tifffile
+
+from llspy import zarrstore
+
+zarr = pytest.importorskip("zarr")
+
+FNAME = 'cell_ch{}_stack{:04d}_{}nm_{:07d}msec_{:010d}msecAbs_decon.tif'
+
+
+def test_zarr_writer_appends(tmp_path):
+    vol = np.random.RandomState(0).randint(0, 1000, (5, 32, 40)).astype(np.uint16)
+    path = str(tmp_path / 'cell_decon.zarr')
+    writer = zarrstore.ZarrWriter(path, 2, vol.shape, vol.dtype, dx=0.1, dz=0.2)
+    writer.write(0, 1, vol)
+    writer.write(2, 0, vol + 1)  # grows the T axis
+    assert writer.nt == 3
+
+    group = zarr.open_group(path, mode='r')
+    datasets = group.attrs['multiscales'][0]['datasets']
+    assert len(datasets) == writer.levels == 3
+    np.testing.assert_array_equal(group['0'][0, 1], vol)
+    np.testing.assert_array_equal(group['0'][2, 0], vol + 1)
+    assert group['1'].shape == (3, 2, 5, 16, 20)
+    np.testing.assert_array_equal(group['1'][0, 1], zarrstore._downsample(vol))
+
+
+def test_zarr_writer_threads(tmp_path):
+    from llspy import util
+
+    vol = np.random.RandomState(0).randint(0, 1000, (5, 32, 40)).astype(np.uint16)
+    writer = zarrstore.ZarrWriter(str(tmp_path / 'cell_decon.zarr'), 1, vol.shape,
+                                  vol.dtype)
+    # timepoints appended concurrently, as by the GUI watcher
+    with util.AsyncWriter(nthreads=4) as threads:
+        for t in range(12):
+            threads.submit(writer.write, t, 0, vol + t)
+    assert writer.nt == 12
+    for t in range(12):
+        np.testing.assert_array_equal(writer._open()[0][t, 0], vol + t)
+
+
+def test_tiffs_to_zarr(tmp_path):
+    rng = np.random.RandomState(0)
+    vols = {}
+    for t in range(3):
+        for c, w in enumerate((488, 642)):
+            vols[(t, c)] = rng.randint(0, 1000, (4, 16, 16)).astype(np.uint16)
+            name = FNAME.format(c, t, w, t * 1000, 5000 + t * 1000)
+            tifffile.imwrite(str(tmp_path / name), vols[(t, c)])
+    stores = zarrstore.tiffs_to_zarr(str(tmp_path))
+    assert [os.path.basename(s) for s in stores] == ['cell_decon.zarr']
+    assert not [f for f in os.listdir(str(tmp_path)) if f.endswith('.tif')]
+    data = zarr.open_array(os.path.join(stores[0], '0'), mode='r')[:]
+    assert data.shape == (3, 2, 4, 16, 16)
+    for (t, c), vol in vols.items():
+        np.testing.assert_array_equal(data[t, c], vol)